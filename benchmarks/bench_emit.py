@@ -0,0 +1,93 @@
+import argparse
+import io
+import os
+import sys
+import tempfile
+import time
+
+import astor
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+import metap
+
+# Compare the emitters (see metap/emit.py) with the way metap used to print
+# the output: astor.to_source() on the whole module. E.g.:
+#
+#   python benchmarks/bench_emit.py --sizes 50 100 200 400
+
+FUNC = """
+def f{i}(x, y):
+  if x > y:
+    return g(x, h(y)) + {i}
+  for i in range(x):
+    y = g(i, y) if i % 2 else h(i)
+  return y
+"""
+
+def gen_source(n):
+  return "".join(FUNC.format(i=i) for i in range(n))
+
+def prepare(path, recipe):
+  mp = metap.MetaP(filename=path)
+  for step in recipe:
+    getattr(mp, step)()
+  return mp
+
+def whole_astor(mp):
+  t = mp.final_ast()
+  maxline = 10_000 if mp.log_se_called else 79
+  return astor.to_source(t, indent_with=' ' * 2, maxline=maxline)
+
+def streamed(emitter):
+  def run(mp):
+    out = io.StringIO()
+    mp.write(out, emitter=emitter)
+    return out.getvalue()
+  return run
+
+EMITTERS = [
+  ("astor (whole module)", whole_astor),
+  ("astor (streamed)", streamed("astor")),
+]
+if sys.version_info >= (3, 9):
+  EMITTERS.append(("unparse (streamed)", streamed("unparse")))
+
+def time_it(path, recipe, fn, repeat):
+  best = float('inf')
+  for _ in range(repeat):
+    mp = prepare(path, recipe)
+    # Don't count the transforms.
+    mp.run_passes()
+    start = time.perf_counter()
+    fn(mp)
+    best = min(best, time.perf_counter() - start)
+  ### END FOR ###
+  return best
+
+def main():
+  parser = argparse.ArgumentParser()
+  parser.add_argument("--sizes", type=int, nargs='+', default=[50, 100, 200, 400],
+                      help="Number of functions in the synthetic input.")
+  parser.add_argument("--repeat", type=int, default=3)
+  args = parser.parse_args()
+
+  recipes = [[], ["log_calls_start_end"]]
+  with tempfile.TemporaryDirectory() as d:
+    path = os.path.join(d, "bench_mp.py")
+    for recipe in recipes:
+      print(f"recipe: {recipe}")
+      print(f"{'funcs':>6} {'lines':>7}  " +
+            "  ".join(f"{name:>22}" for name, _ in EMITTERS))
+      for n in args.sizes:
+        src = gen_source(n)
+        with open(path, 'w') as fp:
+          fp.write(src)
+        times = [time_it(path, recipe, fn, args.repeat) for _, fn in EMITTERS]
+        print(f"{n:>6} {src.count(chr(10)):>7}  " +
+              "  ".join(f"{t*1000:>20.1f}ms" for t in times))
+      ### END FOR ###
+    ### END FOR ###
+  # END WITH #
+
+if __name__ == '__main__':
+  main()
@@ -0,0 +1,100 @@
+import argparse
+import os
+import sys
+import tempfile
+import timeit
+from contextlib import contextmanager
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+import metap
+
+# Compare the indentation tracking of `indent=True` with the way it used to be
+# done: a module global and a generator-based context manager, i.e.,
+# `with metap.indent_ctx():` around the body. The logs go to a sink that drops
+# them. E.g.:
+#
+#   python benchmarks/bench_indent.py --number 1000000
+
+SRC = """
+def f(x):
+  return x
+
+def g(n):
+  for i in range(n):
+    f(i)
+"""
+
+class NullSink(metap.sink.Sink):
+  def write(self, text: str):
+    pass
+
+class OldHelpers:
+  counter = 0
+
+  @staticmethod
+  @contextmanager
+  def indent_ctx():
+    OldHelpers.counter += 1
+    try:
+      yield
+    finally:
+      OldHelpers.counter -= 1
+
+  @staticmethod
+  def indent_print():
+    metap.get_sink().write("  " * OldHelpers.counter)
+
+  log = staticmethod(metap.log)
+
+OLD_SRC = """
+def f(x):
+  metap.indent_print()
+  metap.log('metap::FuncDef(ln=2,func=f)')
+  with metap.indent_ctx():
+    return x
+
+def g(n):
+  for i in range(n):
+    f(i)
+"""
+
+def time_g(code, globs, number, repeat):
+  exec(code, globs)
+  g = globs['g']
+  return min(timeit.repeat(lambda: g(number), number=1, repeat=repeat))
+
+def main():
+  parser = argparse.ArgumentParser()
+  parser.add_argument("--number", type=int, default=200_000,
+                      help="Number of calls.")
+  parser.add_argument("--repeat", type=int, default=5)
+  args = parser.parse_args()
+
+  with tempfile.TemporaryDirectory() as d:
+    path = os.path.join(d, "bench_mp.py")
+    with open(path, 'w') as fp:
+      fp.write(SRC)
+    mp = metap.MetaP(filename=path)
+    mp.log_func_defs(indent=True)
+    code = mp.to_code()
+  # END WITH #
+
+  metap.set_sink(NullSink())
+  variants = [
+    ("original", compile(SRC, "original", 'exec'), {}),
+    ("indent_ctx()", compile(OLD_SRC, "old", 'exec'), {'metap': OldHelpers}),
+    ("try/finally", code, {}),
+  ]
+  base = None
+  for name, code, globs in variants:
+    secs = time_g(code, globs, args.number, args.repeat)
+    if base is None:
+      base = secs
+    ns_per_call = (secs - base) / args.number * 1e9
+    print(f"{name:<14} {secs*1000:9.1f}ms {secs/base:6.2f}x "
+          f"{ns_per_call:7.1f}ns/call overhead")
+  ### END FOR ###
+  metap.set_sink("print")
+
+if __name__ == '__main__':
+  main()
@@ -0,0 +1,86 @@
+import argparse
+import os
+import sys
+import tempfile
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+import metap
+
+# Compare the code that log_calls() generates with the way it used to log a
+# call: by wrapping it in a lambda, i.e., `metap.log_call(lambda: f(x), info)`.
+# The logs go to a sink that drops them, so that only the overhead of the
+# instrumentation is measured. E.g.:
+#
+#   python benchmarks/bench_log_calls.py --number 1000000
+
+SRC = """
+def f(x):
+  return x
+
+def g(n):
+  for i in range(n):
+    y = f(i)
+    f(y)
+"""
+
+class NullSink(metap.sink.Sink):
+  def write(self, text: str):
+    pass
+
+def log_call_lambda(lam, log_info, sampler=None):
+  if sampler is None or sampler():
+    metap.log(log_info)
+  return lam()
+
+LAMBDA_SRC = """
+def f(x):
+  return x
+
+def g(n):
+  for i in range(n):
+    y = log_call_lambda(lambda : f(i), 'metap::Call(ln=7,call=f(i))')
+    log_call_lambda(lambda : f(y), 'metap::Call(ln=8,call=f(y))')
+"""
+
+def time_g(code, globs, number, repeat):
+  exec(code, globs)
+  g = globs['g']
+  return min(timeit.repeat(lambda: g(number), number=1, repeat=repeat))
+
+def main():
+  parser = argparse.ArgumentParser()
+  parser.add_argument("--number", type=int, default=200_000,
+                      help="Iterations of the loop (2 calls each).")
+  parser.add_argument("--repeat", type=int, default=5)
+  args = parser.parse_args()
+
+  with tempfile.TemporaryDirectory() as d:
+    path = os.path.join(d, "bench_mp.py")
+    with open(path, 'w') as fp:
+      fp.write(SRC)
+    mp = metap.MetaP(filename=path)
+    mp.log_calls()
+    code = mp.to_code()
+  # END WITH #
+
+  metap.set_sink(NullSink())
+  variants = [
+    ("original", compile(SRC, "original", 'exec'), {}),
+    ("lambda", compile(LAMBDA_SRC, "lambda", 'exec'),
+     {'log_call_lambda': log_call_lambda}),
+    ("log_calls()", code, {}),
+  ]
+  base = None
+  for name, code, globs in variants:
+    secs = time_g(code, globs, args.number, args.repeat)
+    if base is None:
+      base = secs
+    ns_per_call = (secs - base) / (2 * args.number) * 1e9
+    print(f"{name:<12} {secs*1000:9.1f}ms {secs/base:6.2f}x "
+          f"{ns_per_call:7.1f}ns/call overhead")
+  ### END FOR ###
+  metap.set_sink("print")
+
+if __name__ == '__main__':
+  main()
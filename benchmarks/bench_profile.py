@@ -0,0 +1,68 @@
+import argparse
+import cProfile
+import contextlib
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+import metap
+from suite import RUNTIME_WORKLOAD
+
+# Compare the overhead of profile_funcs() with cProfile on the runtime
+# workload of suite.py, once profiling all the functions and once only
+# `find()`. cProfile always sees every call. E.g.:
+#
+#   python benchmarks/bench_profile.py --iters 2000
+
+def run(code, iters, profile=None):
+  globs = {'__name__': '__bench__'}
+  exec(code, globs)
+  ctx = profile if profile is not None else contextlib.nullcontext()
+  start = time.perf_counter()
+  with ctx:
+    globs['main'](iters)
+  return time.perf_counter() - start
+
+def main():
+  parser = argparse.ArgumentParser()
+  parser.add_argument("--iters", type=int, default=1000,
+                      help="Iterations of the workload.")
+  parser.add_argument("--repeat", type=int, default=5,
+                      help="Take the best of this many runs.")
+  args = parser.parse_args()
+
+  with tempfile.TemporaryDirectory() as d:
+    path = os.path.join(d, "bench_mp.py")
+    with open(path, 'w') as fp:
+      fp.write(RUNTIME_WORKLOAD)
+    orig = compile(RUNTIME_WORKLOAD, path, 'exec')
+    codes = []
+    for name, range_ in [("profile_funcs (all)", []),
+                         ("profile_funcs (find)", [(10, 19)])]:
+      mp = metap.MetaP(filename=path)
+      mp.profile_funcs(range=range_)
+      codes.append((name, mp.to_code()))
+    ### END FOR ###
+  # END WITH #
+
+  run(orig, args.iters)
+  results = {"original": float('inf'), "cProfile": float('inf')}
+  results.update({name: float('inf') for name, _ in codes})
+  for _ in range(args.repeat):
+    results["original"] = min(results["original"], run(orig, args.iters))
+    results["cProfile"] = min(results["cProfile"],
+                              run(orig, args.iters, cProfile.Profile()))
+    for name, code in codes:
+      results[name] = min(results[name], run(code, args.iters))
+    metap.reset_profile()
+  ### END FOR ###
+
+  base = results["original"]
+  for name, secs in results.items():
+    print(f"{name:<22} {secs*1000:9.1f}ms {secs/base:6.2f}x")
+  ### END FOR ###
+
+if __name__ == '__main__':
+  main()
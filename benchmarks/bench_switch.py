@@ -0,0 +1,88 @@
+import argparse
+import os
+import sys
+import tempfile
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+import metap
+import metap.timing as timing
+from suite import RUNTIME_WORKLOAD, run_workload
+
+# The cost of the kill switch (see metap/switch.py): For every logging
+# feature, compare the original workload of suite.py with the code generated
+# with `switch=True`, when the switch is off and when it's on, and with the
+# code generated without it. When the switch is off, the generated code should
+# be about as fast as the original. The exit code is 1 if it's slower by more
+# than the threshold. E.g.:
+#
+#   python benchmarks/bench_switch.py --iters 2000 --threshold 0.1
+
+# (label, feature, kwargs)
+FEATURES = [
+  ("log_returns", "log_returns", {}),
+  ("log_breaks", "log_breaks", {}),
+  ("log_continues", "log_continues", {}),
+  ("log_calls", "log_calls", {}),
+  ("log_calls_start_end", "log_calls_start_end", {}),
+  ("  timing", "log_calls_start_end", {"timing": True}),
+  ("log_func_defs", "log_func_defs", {}),
+  ("  indent", "log_func_defs", {"indent": True}),
+  ("log_ifs", "log_ifs", {}),
+]
+
+def generate(path, feature, kwargs, switch):
+  mp = metap.MetaP(filename=path)
+  getattr(mp, feature)(**kwargs)
+  return mp.to_code(switch=switch)
+
+def main():
+  parser = argparse.ArgumentParser()
+  parser.add_argument("--iters", type=int, default=1000,
+                      help="Iterations of the workload.")
+  parser.add_argument("--repeat", type=int, default=5,
+                      help="Take the best of this many runs.")
+  parser.add_argument("--threshold", type=float, default=0.25,
+                      help="How much slower than the original the code can be "
+                      "when the switch is off (a fraction, default: 0.25).")
+  args = parser.parse_args()
+
+  with tempfile.TemporaryDirectory() as d:
+    path = os.path.join(d, "bench_mp.py")
+    with open(path, 'w') as fp:
+      fp.write(RUNTIME_WORKLOAD)
+    orig = compile(RUNTIME_WORKLOAD, path, 'exec')
+    codes = [(label, generate(path, feature, kwargs, False),
+              generate(path, feature, kwargs, True))
+             for label, feature, kwargs in FEATURES]
+  # END WITH #
+
+  # Warm up.
+  run_workload(orig, args.iters)
+  print(f"{'feature':<22} {'original':>10} {'off':>16} {'on':>16} {'no switch':>16}")
+  regressions = []
+  for label, plain, switched in codes:
+    # Alternate the runs so that the noise affects all of them the same way.
+    base = off = on = no_switch = float('inf')
+    for _ in range(args.repeat):
+      base = min(base, run_workload(orig, args.iters))
+      metap.disable()
+      off = min(off, run_workload(switched, args.iters))
+      metap.enable()
+      on = min(on, run_workload(switched, args.iters))
+      no_switch = min(no_switch, run_workload(plain, args.iters))
+    ### END FOR ###
+    cols = "".join(f" {t*1000:8.1f}ms {t/base:5.2f}x" for t in [off, on, no_switch])
+    print(f"{label:<22} {base*1000:8.1f}ms{cols}")
+    # Don't report the timers of every run at exit.
+    timing._timers.clear()
+    if off > base * (1 + args.threshold):
+      regressions.append(label.strip())
+  ### END FOR ###
+  for label in regressions:
+    print(f"REGRESSION {label}: off is more than {args.threshold*100:.0f}% "
+          "slower than the original")
+  ### END FOR ###
+  return 1 if len(regressions) != 0 else 0
+
+if __name__ == '__main__':
+  sys.exit(main())
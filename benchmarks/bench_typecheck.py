@@ -0,0 +1,71 @@
+import argparse
+import os
+import sys
+import tempfile
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+import metap
+from suite import run_workload
+
+# The per-call cost of the checks of dyn_typecheck(), for a function and for a
+# method with a return annotation. E.g.:
+#
+#   python benchmarks/bench_typecheck.py --iters 200000
+
+TYPED_WORKLOAD = """
+from typing import Optional
+
+def add(a: int, b: int) -> int:
+  return a + b
+
+class Acc:
+  def __init__(self):
+    self.total = 0
+
+  def push(self, x: int) -> Optional[int]:
+    self.total += x
+    if x < 0:
+      return None
+    return self.total
+
+def main(iters):
+  acc = Acc()
+  for i in range(iters):
+    add(i, 1)
+    acc.push(i)
+"""
+
+CALLS_PER_ITER = 2
+
+def main():
+  parser = argparse.ArgumentParser()
+  parser.add_argument("--iters", type=int, default=100000,
+                      help="Iterations of the workload.")
+  parser.add_argument("--repeat", type=int, default=5,
+                      help="Take the best of this many runs.")
+  args = parser.parse_args()
+
+  with tempfile.TemporaryDirectory() as d:
+    path = os.path.join(d, "bench_mp.py")
+    with open(path, 'w') as fp:
+      fp.write(TYPED_WORKLOAD)
+    orig = compile(TYPED_WORKLOAD, path, 'exec')
+    mp = metap.MetaP(filename=path)
+    mp.dyn_typecheck()
+    checked = mp.to_code()
+  # END WITH #
+
+  # Warm up.
+  run_workload(orig, args.iters)
+  base = secs = float('inf')
+  for _ in range(args.repeat):
+    base = min(base, run_workload(orig, args.iters))
+    secs = min(secs, run_workload(checked, args.iters))
+  ### END FOR ###
+  calls = args.iters * CALLS_PER_ITER
+  print(f"original {base/calls*1e9:8.1f}ns/call")
+  print(f"checked  {secs/calls*1e9:8.1f}ns/call "
+        f"(+{(secs-base)/calls*1e9:.1f}ns, {secs/base:.2f}x)")
+
+if __name__ == '__main__':
+  main()
@@ -0,0 +1,321 @@
+import argparse
+import contextlib
+import gc
+import json
+import os
+import platform
+import sys
+import sysconfig
+import tempfile
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+import metap
+
+# The benchmark suite. It measures:
+# - transform: The time and the peak memory it takes to apply each feature and
+#   generate the source, on synthetic inputs of increasing size and on some
+#   files of the standard library.
+# - runtime: How much slower the generated code is compared to the original,
+#   for each feature, on a small workload.
+#
+# The results can be stored as a baseline, and later runs can be compared
+# against it. E.g.:
+#
+#   python benchmarks/suite.py --save benchmarks/baseline.json
+#   python benchmarks/suite.py --compare benchmarks/baseline.json
+#
+# A comparison fails (exit code 1) if any metric got worse than the baseline by
+# more than its threshold (see THRESHOLDS). Absolute times depend on the
+# machine, so only compare against a baseline from the same machine.
+
+FEATURES = [
+  "log_returns",
+  "log_breaks",
+  "log_continues",
+  "log_calls",
+  "log_calls_start_end",
+  "log_func_defs",
+  "log_ifs",
+  "dyn_typecheck",
+  "expand_asserts",
+  "profile_funcs",
+  "compile",
+]
+
+# By how much (as a fraction) a metric can grow before it's a regression.
+THRESHOLDS = {
+  "time": 0.25,
+  "peak_kb": 0.10,
+  "slowdown": 0.15,
+}
+
+# Differences smaller than these are noise.
+ABS_TOLERANCE = {
+  "time": 0.002,
+  "peak_kb": 64,
+  "slowdown": 0.05,
+}
+
+STDLIB_FILES = [
+  "json/decoder.py",
+  "json/encoder.py",
+  "textwrap.py",
+  "difflib.py",
+  "argparse.py",
+]
+
+### Corpora ###
+
+SYNTH_FUNC = """
+def f{i}(xs: List[int], k: int) -> int:
+  total = 0
+  for x in xs:
+    if x < 0:
+      continue
+    if x > k:
+      break
+    assert x >= 0
+    total += g(x, k)
+  if total > {i}:
+    return total
+  return h(total)
+"""
+
+SYNTH_HEADER = """
+from typing import List
+
+def g(a: int, b: int) -> int:
+  return a + b
+
+def h(a: int) -> int:
+  return a
+"""
+
+def synthetic_source(n):
+  return SYNTH_HEADER + "".join(SYNTH_FUNC.format(i=i) for i in range(n))
+
+def stdlib_sources():
+  stdlib = sysconfig.get_paths()['stdlib']
+  res = []
+  for rel in STDLIB_FILES:
+    path = os.path.join(stdlib, rel)
+    if not os.path.exists(path):
+      continue
+    with open(path) as fp:
+      res.append((rel, fp.read()))
+  ### END FOR ###
+  return res
+
+RUNTIME_WORKLOAD = """
+from typing import Dict, List, Optional
+
+def fib(n: int) -> int:
+  if n < 2:
+    return n
+  return fib(n - 1) + fib(n - 2)
+
+def find(xs: List[int], target: int) -> Optional[int]:
+  for i, x in enumerate(xs):
+    if x < 0:
+      continue
+    if x == target:
+      break
+  else:
+    return None
+  return i
+
+def count(d: Dict[str, int]) -> int:
+  total = 0
+  for k in d:
+    assert isinstance(k, str)
+    total += d[k]
+  return total
+
+def main(iters):
+  xs = list(range(100))
+  d = {str(i): i for i in range(50)}
+  res = 0
+  for _ in range(iters):
+    res += fib(10)
+    res += find(xs, 75) or 0
+    res += count(d)
+  return res
+"""
+
+### Measurements ###
+
+def transform(path, feature, emitter):
+  mp = metap.MetaP(filename=path)
+  getattr(mp, feature)()
+  return mp.to_source(emitter=emitter)
+
+def measure_transform(path, feature, emitter, repeat):
+  best = float('inf')
+  for _ in range(repeat):
+    gc.collect()
+    start = time.perf_counter()
+    transform(path, feature, emitter)
+    best = min(best, time.perf_counter() - start)
+  ### END FOR ###
+
+  gc.collect()
+  tracemalloc.start()
+  try:
+    transform(path, feature, emitter)
+    _, peak = tracemalloc.get_traced_memory()
+  finally:
+    tracemalloc.stop()
+  return {"time": best, "peak_kb": peak / 1024}
+
+def transform_suite(sizes, emitter, repeat, out):
+  results = dict()
+  with tempfile.TemporaryDirectory() as d:
+    path = os.path.join(d, "bench_mp.py")
+    inputs = [(f"synthetic/{n}", synthetic_source(n)) for n in sizes]
+    inputs += [(f"stdlib/{rel}", src) for rel, src in stdlib_sources()]
+    for name, src in inputs:
+      with open(path, 'w') as fp:
+        fp.write(src)
+      lines = src.count('\n')
+      for feature in FEATURES:
+        key = f"transform/{name}/{feature}"
+        try:
+          res = measure_transform(path, feature, emitter, repeat)
+        except Exception as e:
+          # E.g., dyn_typecheck() doesn't support some annotation.
+          print(f"{key:<60} skipped: {type(e).__name__}: {e}", file=out)
+          continue
+        results[key] = res
+        us_per_line = res["time"] / lines * 1e6
+        print(f"{key:<60} {res['time']*1000:9.1f}ms {us_per_line:7.1f}us/line "
+              f"{res['peak_kb']:10.0f}KB", file=out)
+      ### END FOR ###
+    ### END FOR ###
+  # END WITH #
+  return results
+
+def run_workload(code, iters):
+  globs = {'__name__': '__bench__'}
+  with open(os.devnull, 'w') as devnull:
+    with contextlib.redirect_stdout(devnull):
+      exec(code, globs)
+      start = time.perf_counter()
+      globs['main'](iters)
+      secs = time.perf_counter() - start
+    # END WITH #
+  # END WITH #
+  return secs
+
+def runtime_suite(iters, repeat, out):
+  results = dict()
+  with tempfile.TemporaryDirectory() as d:
+    path = os.path.join(d, "bench_mp.py")
+    with open(path, 'w') as fp:
+      fp.write(RUNTIME_WORKLOAD)
+    orig = compile(RUNTIME_WORKLOAD, path, 'exec')
+    # Warm up.
+    run_workload(orig, iters)
+
+    for feature in FEATURES:
+      mp = metap.MetaP(filename=path)
+      getattr(mp, feature)()
+      code = mp.to_code()
+      # Alternate the runs so that the noise affects both the same way.
+      base = secs = float('inf')
+      for _ in range(repeat):
+        base = min(base, run_workload(orig, iters))
+        secs = min(secs, run_workload(code, iters))
+      ### END FOR ###
+      key = f"runtime/{feature}"
+      results[key] = {"slowdown": secs / base}
+      print(f"{key:<60} {secs*1000:9.1f}ms {secs/base:7.2f}x "
+            f"(original: {base*1000:.1f}ms)", file=out)
+    ### END FOR ###
+  # END WITH #
+  return results
+
+### Baselines ###
+
+def machine_info():
+  return {
+    "python": platform.python_version(),
+    "implementation": platform.python_implementation(),
+    "machine": platform.machine(),
+    "metap": metap.__version__,
+  }
+
+def save_baseline(path, results):
+  with open(path, 'w') as fp:
+    json.dump({"info": machine_info(), "results": results}, fp, indent=2,
+              sort_keys=True)
+    fp.write('\n')
+
+# Returns the list of regressions.
+def compare(baseline, results, thresholds, out):
+  regressions = []
+  for key, metrics in sorted(results.items()):
+    if key not in baseline:
+      continue
+    for metric, cur in metrics.items():
+      base = baseline[key].get(metric)
+      if base is None:
+        continue
+      limit = base * (1 + thresholds[metric])
+      if cur > limit and cur - base > ABS_TOLERANCE[metric]:
+        change = (cur / base - 1) * 100 if base != 0 else float('inf')
+        regressions.append(key)
+        print(f"REGRESSION {key} {metric}: {base:.4g} -> {cur:.4g} "
+              f"(+{change:.0f}%, threshold {thresholds[metric]*100:.0f}%)",
+              file=out)
+    ### END FOR ###
+  ### END FOR ###
+  return regressions
+
+def main(argv=None):
+  parser = argparse.ArgumentParser(description="metap's benchmark suite.")
+  parser.add_argument("--suite", choices=["transform", "runtime", "all"],
+                      default="all")
+  parser.add_argument("--sizes", type=int, nargs='+', default=[100, 200, 400, 800],
+                      help="Number of functions in the synthetic inputs.")
+  parser.add_argument("--emitter", default="astor",
+                      help="The emitter for the transform suite (default: astor).")
+  parser.add_argument("--iters", type=int, default=1000,
+                      help="Iterations of the runtime workload.")
+  parser.add_argument("--repeat", type=int, default=3,
+                      help="Take the best of this many runs.")
+  parser.add_argument("--save", metavar="PATH",
+                      help="Store the results as a baseline.")
+  parser.add_argument("--compare", metavar="PATH",
+                      help="Compare the results against a baseline.")
+  parser.add_argument("--threshold", type=float, default=None,
+                      help="Use this threshold (a fraction, e.g., 0.2) for all metrics.")
+  args = parser.parse_args(argv)
+
+  out = sys.stdout
+  results = dict()
+  if args.suite in ("transform", "all"):
+    results.update(transform_suite(args.sizes, args.emitter, args.repeat, out))
+  if args.suite in ("runtime", "all"):
+    results.update(runtime_suite(args.iters, args.repeat, out))
+
+  if args.save:
+    save_baseline(args.save, results)
+  if args.compare:
+    with open(args.compare) as fp:
+      baseline = json.load(fp)
+    if baseline["info"] != machine_info():
+      print(f"warning: the baseline is from {baseline['info']}, this is "
+            f"{machine_info()}", file=out)
+    thresholds = dict(THRESHOLDS)
+    if args.threshold is not None:
+      thresholds = {metric: args.threshold for metric in thresholds}
+    regressions = compare(baseline["results"], results, thresholds, out)
+    print(f"{len(regressions)} regressions", file=out)
+    if len(regressions) != 0:
+      return 1
+  return 0
+
+if __name__ == '__main__':
+  sys.exit(main())
@@ -6,17 +6,23 @@ class RandomVisitor(ast.NodeVisitor):
 
   def visit_Assign(self, asgn: ast.Assign):
     metap.indent_print()
-    print('metap::FuncDef(ln=4,func=visit_Assign)')
-    with metap.indent_ctx():
+    metap.log('metap::FuncDef(ln=4,func=visit_Assign)')
+    metap.indent_enter()
+    try:
       for t in asgn.targets:
         self.visit(t)
       self.visit(asgn.value)
+    finally:
+      metap.indent_exit()
 
   def visit_BinOp(self, binop: ast.BinOp):
     metap.indent_print()
-    print('metap::FuncDef(ln=10,func=visit_BinOp)')
-    with metap.indent_ctx():
+    metap.log('metap::FuncDef(ln=10,func=visit_BinOp)')
+    metap.indent_enter()
+    try:
       self.visit(binop.left)
+    finally:
+      metap.indent_exit()
 
 
 code = 'a = 2 + 3'
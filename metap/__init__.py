@@ -1,2 +1,6 @@
 # from . import test
-from .metap import *
\ No newline at end of file
+from .version import __version__
+from .metap import *
+from .import_hook import install_import_hook, uninstall_import_hook
+from .cache import TransformCache
+from .watch import Watcher
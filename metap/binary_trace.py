@@ -0,0 +1,173 @@
+import atexit
+import hashlib
+import json
+import os
+import struct
+import sys
+import threading
+import time
+
+from . import errors_warns
+
+# Binary traces. In trace mode (e.g., `mp.dump(trace="run.trace")`), the
+# generated code doesn't log any text. Every log site gets an id and, every
+# time it executes, it appends a fixed-width record of (site id, timestamp in
+# ns, thread id) to the trace file. The description of every site (its kind,
+# line, etc., and the text it would log) goes to a side table, which is written
+# at dump time, next to the trace: `<trace>.sites.json`.
+#
+# decode() (or `python -m metap.decode run.trace`) turns a trace back to the
+# usual text logs.
+
+MAGIC = b"METAPTR1"
+RECORD = struct.Struct('<IQQ')
+DIGEST_LEN = hashlib.sha256().digest_size
+DEFAULT_CAPACITY = 1 << 20
+
+def sites_path(trace_path):
+  return trace_path + ".sites.json"
+
+def sites_digest(sites_json: str) -> bytes:
+  return hashlib.sha256(sites_json.encode('utf-8')).digest()
+
+def write_sites(trace_path, sites):
+  sites_json = json.dumps(sites, indent=1)
+  with open(sites_path(trace_path), 'w') as fp:
+    fp.write(sites_json)
+  return sites_digest(sites_json)
+
+# The trace of one generated module. The module keeps it in `_metap_trace`
+# and its sites call its trace*() methods, so that the site ids of every
+# module go to the trace of their own site table.
+class TraceWriter:
+  def __init__(self, path, digest: bytes, capacity=DEFAULT_CAPACITY):
+    self.fp = open(path, 'wb')
+    self.fp.write(MAGIC + digest)
+    self.digest = digest
+    self.capacity = capacity
+    self.buf = bytearray()
+    self.lock = threading.Lock()
+
+  def write(self, site, pack=RECORD.pack, now=time.perf_counter_ns,
+            ident=threading.get_ident):
+    self.buf += pack(site, now(), ident())
+    if len(self.buf) >= self.capacity:
+      self.flush()
+
+  # We never replace the buffer, so that a record that another thread appends
+  # while we flush is not lost.
+  def flush(self):
+    with self.lock:
+      data = bytes(self.buf)
+      del self.buf[:len(data)]
+      # A module whose trace was reopened by another one with the same path
+      # (see init_trace()) drops its records.
+      if self.fp.closed:
+        return
+      self.fp.write(data)
+      self.fp.flush()
+    # END WITH #
+
+  def close(self):
+    self.flush()
+    with self.lock:
+      self.fp.close()
+
+  ### HELPERS called from the generated program ###
+
+  trace = write
+
+  # `sampler` is like in metap.log_ret().
+  def trace_ret(self, e, site, sampler=None):
+    if sampler is None or sampler():
+      self.write(site)
+    return e
+
+  # Returns None, like metap.log_call().
+  def trace_call(self, site, sampler=None):
+    if sampler is None or sampler():
+      self.write(site)
+
+  def trace_call_deco(self, site, sampler=None, on=True):
+    if on:
+      self.trace_call(site, sampler)
+    return keep_deco
+
+  ### END HELPERS ###
+
+def keep_deco(f):
+  return f
+
+# Path -> the TraceWriter.
+_writers = dict()
+
+# Called by the generated program, which keeps the result in `_metap_trace`.
+# `digest` is the hex digest of the site table. METAP_TRACE overrides the path
+# given at dump time. Modules with the same path and site table (e.g., a module
+# that is run twice) share the trace. Otherwise, the last one gets the path.
+def init_trace(path, digest: str):
+  path = os.environ.get('METAP_TRACE', path)
+  digest = bytes.fromhex(digest)
+  writer = _writers.get(path)
+  if writer is not None:
+    if writer.digest == digest:
+      return writer
+    writer.close()
+  # END IF #
+  writer = TraceWriter(path, digest)
+  _writers[path] = writer
+  return writer
+
+def flush_trace():
+  for writer in list(_writers.values()):
+    writer.flush()
+  ### END FOR ###
+
+@atexit.register
+def close_trace():
+  for writer in list(_writers.values()):
+    writer.close()
+  ### END FOR ###
+  _writers.clear()
+
+### Decoding ###
+
+def read_records(trace_path, digest=None):
+  with open(trace_path, 'rb') as fp:
+    header = fp.read(len(MAGIC) + DIGEST_LEN)
+    if not header.startswith(MAGIC):
+      raise errors_warns.APIError(f"{trace_path} is not a metap trace.")
+    if digest is not None and header[len(MAGIC):] != digest:
+      raise errors_warns.APIError(f"{trace_path} doesn't match its site table.")
+    while True:
+      data = fp.read(RECORD.size * 4096)
+      # A partial record at the end means the program was killed while
+      # writing it.
+      usable = len(data) - len(data) % RECORD.size
+      yield from RECORD.iter_unpack(data[:usable])
+      if len(data) < RECORD.size * 4096:
+        break
+    ### END WHILE ###
+  # END WITH #
+
+# Write the text logs of the trace to `out`, one per line. With `timestamps`,
+# every log is prefixed with the time (in ns, relative to the first record)
+# and the thread id.
+def decode(trace_path, out=None, sites=None, timestamps=False):
+  if out is None:
+    out = sys.stdout
+  if sites is None:
+    sites = sites_path(trace_path)
+  with open(sites) as fp:
+    sites_json = fp.read()
+  table = json.loads(sites_json)
+
+  start = None
+  for site, ts, tid in read_records(trace_path, sites_digest(sites_json)):
+    text = table[site]["text"]
+    if timestamps:
+      if start is None:
+        start = ts
+      text = f"[{ts - start:>12} {tid}] {text}"
+    out.write(text + "\n")
+  ### END FOR ###
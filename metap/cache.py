@@ -0,0 +1,181 @@
+import hashlib
+import importlib.util
+import marshal
+import os
+import sys
+
+from . import metap as metap_
+from .recipe import Recipe, apply_recipe, recipe_key
+
+# An on-disk cache of generated programs. Identical inputs always produce
+# identical outputs, so an entry is addressed by the hash of everything that
+# determines the output: the source, the recipe (the transforms, in order, with
+# their arguments, and the contents of any macro/typedef files they read) and
+# metap's version. E.g.:
+#
+#   cache = metap.TransformCache()
+#   src = cache.source("test_mp.py", ["compile", "log_returns"])
+#
+# When the cache grows beyond `max_size` bytes, the least recently used
+# entries are evicted, until it's below LOW_WATER of it, so that the next puts
+# don't evict again. To avoid scanning the cache on every put, we keep a
+# running total of its size, which we get from a scan the first time and
+# after every eviction. Entries that other processes add in the meantime are
+# not counted until then.
+
+DEFAULT_MAX_SIZE = 256 * 1024 * 1024
+LOW_WATER = 0.9
+
+def default_cache_dir():
+  if 'METAP_CACHE_DIR' in os.environ:
+    return os.environ['METAP_CACHE_DIR']
+  base = os.environ.get('XDG_CACHE_HOME',
+                        os.path.join(os.path.expanduser('~'), '.cache'))
+  return os.path.join(base, 'metap')
+
+class TransformCache:
+  def __init__(self, directory=None, max_size=DEFAULT_MAX_SIZE):
+    if directory is None:
+      directory = default_cache_dir()
+    self.directory = directory
+    self.max_size = max_size
+    # The size of the cache, or None if we haven't scanned it yet.
+    self.total = None
+
+  def key(self, source: bytes, recipe: Recipe, extra: bytes=b""):
+    h = hashlib.sha256()
+    for part in [source, recipe_key(recipe), extra]:
+      # Length-prefix the parts so that they can't run into each other.
+      h.update(len(part).to_bytes(8, 'little'))
+      h.update(part)
+    ### END FOR ###
+    return h.hexdigest()
+
+  def entry_path(self, key, kind):
+    return os.path.join(self.directory, key[:2], f"{key}.{kind}")
+
+  def get(self, key, kind):
+    path = self.entry_path(key, kind)
+    try:
+      with open(path, 'rb') as fp:
+        data = fp.read()
+      # Mark it as recently used.
+      os.utime(path)
+    except OSError:
+      return None
+    return data
+
+  def put(self, key, kind, data: bytes):
+    if self.total is None:
+      self.total = self.size()
+    path = self.entry_path(key, kind)
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    try:
+      old_size = os.stat(path).st_size
+    except OSError:
+      old_size = 0
+    try:
+      os.makedirs(os.path.dirname(path), exist_ok=True)
+      with open(tmp_path, 'wb') as fp:
+        fp.write(data)
+      os.replace(tmp_path, path)
+    except OSError:
+      try:
+        os.remove(tmp_path)
+      except OSError:
+        pass
+      return
+    self.total += len(data) - old_size
+    if self.total > self.max_size:
+      self.evict()
+
+  def entries(self):
+    res = []
+    for root, _, files in os.walk(self.directory):
+      for f in files:
+        if f.endswith('.tmp'):
+          continue
+        path = os.path.join(root, f)
+        try:
+          st = os.stat(path)
+        except OSError:
+          continue
+        res.append((st.st_mtime, st.st_size, path))
+      ### END FOR ###
+    ### END FOR ###
+    return res
+
+  def size(self):
+    return sum(size for _, size, _ in self.entries())
+
+  def evict(self):
+    entries = self.entries()
+    total = sum(size for _, size, _ in entries)
+    if total > self.max_size:
+      # Least recently used first.
+      entries.sort()
+      for _, size, path in entries:
+        if total <= self.max_size * LOW_WATER:
+          break
+        try:
+          os.remove(path)
+        except OSError:
+          continue
+        total -= size
+      ### END FOR ###
+    # END IF #
+    self.total = total
+
+  def clear(self):
+    for _, _, path in self.entries():
+      try:
+        os.remove(path)
+      except OSError:
+        pass
+    ### END FOR ###
+    self.total = None
+
+  def transform(self, filename, recipe: Recipe):
+    mp = metap_.MetaP(filename=filename)
+    apply_recipe(mp, recipe)
+    return mp
+
+  # The generated source for `filename` (as dump() would write it). `emitter`
+  # is the name of an emitter (see emit.py) and `sink` a sink spec (see
+  # sink.py).
+  def source(self, filename, recipe: Recipe, emitter="astor", sink=None) -> str:
+    with open(filename, 'rb') as fp:
+      source = fp.read()
+    extra = emitter.encode()
+    if sink is not None:
+      extra += b"\0" + sink.encode()
+    key = self.key(source, recipe, extra)
+    data = self.get(key, 'py')
+    if data is not None:
+      return data.decode('utf-8')
+
+    src = self.transform(filename, recipe).to_source(emitter=emitter,
+                                                     sink=sink)
+    self.put(key, 'py', src.encode('utf-8'))
+    return src
+
+  # The code object for `filename` (as to_code() would return it).
+  def code(self, filename, recipe: Recipe):
+    with open(filename, 'rb') as fp:
+      source = fp.read()
+    # The code object records the filename, so it's part of the key, and
+    # `python -O` compiles it differently.
+    optimize = sys.flags.optimize
+    extra = (importlib.util.MAGIC_NUMBER + os.path.abspath(filename).encode() +
+             f"\0{optimize}".encode())
+    key = self.key(source, recipe, extra)
+    data = self.get(key, 'code')
+    if data is not None:
+      try:
+        return marshal.loads(data)
+      except (EOFError, ValueError, TypeError):
+        pass
+
+    code = self.transform(filename, recipe).to_code(optimize=optimize)
+    self.put(key, 'code', marshal.dumps(code))
+    return code
@@ -0,0 +1,158 @@
+import argparse
+import concurrent.futures
+import json
+import os
+import pathlib
+import sys
+import time
+import traceback
+
+from . import emit
+from . import errors_warns
+from . import sink
+from . import metap as metap_
+from .cache import TransformCache
+from .recipe import apply_recipe, normalize_recipe
+from .watch import Watcher
+
+# Batch mode: apply a recipe to every matching file under a directory, in
+# parallel, and write the outputs to a mirror tree. E.g.:
+#
+#   python -m metap src/ out/ -t compile -t 'log_returns:{"range": [[1, 50]]}'
+#
+# With --watch, it instead watches a single file (see watch.py).
+
+def parse_step(step: str):
+  name, sep, kwargs = step.partition(':')
+  if not sep:
+    return name
+  try:
+    kwargs = json.loads(kwargs)
+  except json.JSONDecodeError as e:
+    raise errors_warns.APIError(f"Invalid arguments for {name}: {e}")
+  if not isinstance(kwargs, dict):
+    raise errors_warns.APIError(f"The arguments for {name} must be a JSON object.")
+  return (name, kwargs)
+
+# Runs in a worker process. Errors are returned, not raised, so that one bad
+# file doesn't stop the batch.
+def transform_file(src_path, out_path, recipe, cache_dir, emitter="astor",
+                   sink=None):
+  start = time.perf_counter()
+  try:
+    os.makedirs(os.path.dirname(out_path), exist_ok=True)
+    if cache_dir is not None:
+      src = TransformCache(directory=cache_dir).source(src_path, recipe,
+                                                       emitter, sink)
+      with open(out_path, 'w') as fp:
+        fp.write(src)
+    else:
+      mp = metap_.MetaP(filename=src_path)
+      apply_recipe(mp, recipe)
+      mp.dump(out_path, emitter=emitter, sink=sink)
+    err = None
+  except Exception as e:
+    err = "".join(traceback.format_exception_only(type(e), e)).strip()
+  return time.perf_counter() - start, err
+
+def find_files(src_dir, pattern, out_dir):
+  src_dir = pathlib.Path(src_dir)
+  out_dir = pathlib.Path(out_dir).resolve()
+  res = []
+  for path in sorted(src_dir.glob(pattern)):
+    if not path.is_file():
+      continue
+    # Don't pick up our own outputs if the output is inside the input.
+    if out_dir in path.resolve().parents:
+      continue
+    res.append(path.relative_to(src_dir))
+  ### END FOR ###
+  return res
+
+def run_batch(src_dir, out_dir, recipe, pattern="**/*.py", jobs=None,
+              cache_dir=None, emitter="astor", sink=None, out=sys.stdout):
+  recipe = normalize_recipe(recipe)
+  files = find_files(src_dir, pattern, out_dir)
+
+  results = dict()
+  with concurrent.futures.ProcessPoolExecutor(max_workers=jobs) as ex:
+    futures = dict()
+    for rel in files:
+      fut = ex.submit(transform_file, os.path.join(src_dir, rel),
+                      os.path.join(out_dir, rel), recipe, cache_dir, emitter,
+                      sink)
+      futures[fut] = rel
+    ### END FOR ###
+    for fut in concurrent.futures.as_completed(futures):
+      rel = futures[fut]
+      try:
+        results[rel] = fut.result()
+      except Exception as e:
+        # E.g., the worker died.
+        results[rel] = (0.0, f"{type(e).__name__}: {e}")
+      secs, err = results[rel]
+      if err is None:
+        print(f"ok    {secs:8.3f}s  {rel}", file=out)
+      else:
+        print(f"FAIL  {secs:8.3f}s  {rel}: {err}", file=out)
+    ### END FOR ###
+  # END WITH #
+
+  failed = [rel for rel, (_, err) in results.items() if err is not None]
+  total = sum(secs for secs, _ in results.values())
+  print(f"metap: {len(files) - len(failed)} succeeded, {len(failed)} failed, "
+        f"{total:.3f}s total transform time", file=out)
+  return results
+
+def main(argv=None):
+  parser = argparse.ArgumentParser(
+    prog="metap",
+    description="Apply metap transforms to every matching file in a directory.")
+  parser.add_argument("src_dir", help="The directory with the meta-programs (with --watch, the meta-program).")
+  parser.add_argument("out_dir", help="Where to write the generated programs, mirroring src_dir (with --watch, the generated program).")
+  parser.add_argument("-t", "--transform", action="append", default=[],
+                      metavar="NAME[:JSON]", required=True,
+                      help="A MetaP transform (e.g., compile), optionally with its keyword arguments as a JSON object. Repeat for more transforms; they run in the given order.")
+  parser.add_argument("-g", "--glob", default="**/*.py",
+                      help="Which files to process, relative to src_dir (default: **/*.py).")
+  parser.add_argument("-j", "--jobs", type=int, default=None,
+                      help="Number of worker processes (default: number of CPUs).")
+  parser.add_argument("--cache-dir", default=None,
+                      help="Use a TransformCache in this directory.")
+  parser.add_argument("-e", "--emitter", default="astor",
+                      choices=sorted(emit.EMITTERS),
+                      help="How to print the generated programs (default: astor).")
+  parser.add_argument("--sink", default=None,
+                      help="The sink the generated programs log to (e.g., stderr or file:trace.log).")
+  parser.add_argument("-w", "--watch", action="store_true",
+                      help="Watch src_dir, which is a file, and regenerate out_dir whenever it changes.")
+  parser.add_argument("--interval", type=float, default=0.5,
+                      help="With --watch, how often to check for changes, in seconds (default: 0.5).")
+  args = parser.parse_args(argv)
+
+  try:
+    recipe = [parse_step(step) for step in args.transform]
+    recipe = normalize_recipe(recipe)
+    if args.sink is not None:
+      sink.check_spec(args.sink)
+  except errors_warns.APIError as e:
+    parser.error(e.message)
+
+  if args.watch:
+    # Watch mode has its own (per-statement) cache and transforms one file.
+    if args.cache_dir is not None:
+      parser.error("--cache-dir can't be used with --watch")
+    if args.jobs is not None:
+      parser.error("-j/--jobs can't be used with --watch")
+    try:
+      Watcher(args.src_dir, recipe, args.out_dir, emitter=args.emitter,
+              sink=args.sink).run(interval=args.interval)
+    except KeyboardInterrupt:
+      pass
+    return 0
+
+  results = run_batch(args.src_dir, args.out_dir, recipe, pattern=args.glob,
+                      jobs=args.jobs, cache_dir=args.cache_dir,
+                      emitter=args.emitter, sink=args.sink)
+  failed = any(err is not None for _, err in results.values())
+  return 1 if failed else 0
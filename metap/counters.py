@@ -0,0 +1,69 @@
+import atexit
+from array import array
+
+from . import errors_warns
+from .sink import log
+
+# The count mode of the log sites (e.g., `mp.log_ifs(mode="count")`). Instead
+# of logging every time it executes, a site increments its slot in an array of
+# counters, which the generated module allocates once, at the top:
+#
+#   _metap_counts = metap.make_counters(['metap::If(ln=3)', 'metap::Else(ln=3)'])
+#   ...
+#   if x:
+#     _metap_counts[0] += 1
+#
+# So, the memory is constant per site, no matter how many times it executes.
+# The histogram of all the sites is logged at exit, or on demand with
+# dump_counts(). The increments are not atomic, so with threads some counts may
+# be lost.
+
+MODES = ["log", "count"]
+
+def check_mode(mode):
+  if mode not in MODES:
+    raise errors_warns.APIError(f"Unknown mode: {mode!r}. Expected one of: "
+                                f"{', '.join(MODES)}.")
+
+# The (texts, counters) of every generated module.
+_groups = []
+
+### HELPERS called from the generated program ###
+
+# `texts` are the descriptions of the sites.
+def make_counters(texts):
+  counts = array('Q', bytes(8 * len(texts)))
+  _groups.append((texts, counts))
+  return counts
+
+### END HELPERS ###
+
+# A list of (text, count) for all the sites, most frequent first.
+def get_counts():
+  res = []
+  for texts, counts in _groups:
+    res.extend(zip(texts, counts))
+  ### END FOR ###
+  res.sort(key=lambda tc: (-tc[1], tc[0]))
+  return res
+
+def reset_counts():
+  for _, counts in _groups:
+    for i in range(len(counts)):
+      counts[i] = 0
+  ### END FOR ###
+
+# Write the histogram to `out`, or log it, if `out` is None.
+def dump_counts(out=None):
+  lines = ["metap: Counts:"]
+  lines.extend(f"{count:>12} {text}" for text, count in get_counts())
+  if out is None:
+    for line in lines:
+      log(line)
+  else:
+    out.write("\n".join(lines) + "\n")
+
+@atexit.register
+def report_counts():
+  if len(_groups) != 0:
+    dump_counts()
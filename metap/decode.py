@@ -0,0 +1,31 @@
+import argparse
+import sys
+
+from . import errors_warns
+from .binary_trace import decode
+
+# Decode a binary trace (see binary_trace.py) to the text logs. E.g.:
+#
+#   python -m metap.decode run.trace
+
+def main(argv=None):
+  parser = argparse.ArgumentParser(
+    prog="python -m metap.decode",
+    description="Decode a binary metap trace to the text logs.")
+  parser.add_argument("trace", help="The trace file.")
+  parser.add_argument("--sites", default=None,
+                      help="The site table (default: <trace>.sites.json).")
+  parser.add_argument("-t", "--timestamps", action="store_true",
+                      help="Prefix the logs with the time (in ns, since the first log) and the thread id.")
+  args = parser.parse_args(argv)
+  try:
+    decode(args.trace, sites=args.sites, timestamps=args.timestamps)
+  except errors_warns.APIError as e:
+    parser.error(e.message)
+  except BrokenPipeError:
+    # E.g., piped to `head`.
+    pass
+  return 0
+
+if __name__ == '__main__':
+  sys.exit(main())
@@ -0,0 +1,127 @@
+import ast
+import sys
+
+import astor
+
+from . import errors_warns
+
+# Emitters turn the final AST into source code. They print one top-level
+# statement at a time, so that the output can be streamed to a file (see
+# write()) instead of being built as one big string, and the time it takes is
+# linear to the number of top-level statements. There are two:
+# - "astor" (the default): What metap has always used.
+# - "unparse": Based on the standard library's unparser (ast.unparse()), which
+#   doesn't try to fit lines in 79 columns and so it's faster. It requires
+#   Python 3.9+.
+#
+# An emitter is anything that has:
+# - `stmt(node) -> str`: The source of a top-level statement, which ends with
+#   a newline.
+# - `sep(prev, cur) -> str`: What goes between two top-level statements.
+
+DEFS = (ast.FunctionDef, ast.AsyncFunctionDef, ast.ClassDef)
+
+# Macros may expand to a whole Module.
+def flatten_stmts(stmts):
+  res = []
+  for s in stmts:
+    if isinstance(s, ast.Module):
+      res.extend(flatten_stmts(s.body))
+    else:
+      res.append(s)
+  ### END FOR ###
+  return res
+
+class AstorEmitter:
+  # astor fails with all the craziness by log_calls_start_end(). To fix it,
+  # we allow too long lines with `long_lines`. Note that this requires
+  # baziotis/astor version. The upstream astor doesn't allow to pass `maxline`
+  # to `to_source()`.
+  def __init__(self, long_lines=False):
+    self.maxline = 10_000 if long_lines else 79
+
+  def stmt(self, node):
+    return astor.to_source(node, indent_with=' ' * 2, maxline=self.maxline)
+
+  # Two blank lines around definitions.
+  def sep(self, prev, cur):
+    if isinstance(prev, DEFS) or isinstance(cur, DEFS):
+      return "\n\n"
+    return ""
+
+if sys.version_info >= (3, 9):
+  # ast.unparse() expects an AST that compile() would accept, but our
+  # transforms produce some nodes that only astor can print (see Legalize in
+  # metap.py). Instead of legalizing the whole tree, which costs more than
+  # printing it, we handle these nodes while printing. We also indent with 2
+  # spaces, like astor.
+  class Unparser(ast._Unparser):
+    def fill(self, text=""):
+      self.maybe_newline()
+      self.write("  " * self._indent + text)
+
+    # Generated nodes don't have a lineno.
+    def get_type_comment(self, node):
+      comment = (self._type_ignores.get(getattr(node, 'lineno', None)) or
+                 getattr(node, 'type_comment', None))
+      if comment is not None:
+        return f" # type: {comment}"
+
+    # `or`, `and` and comparisons as a BinOp.
+    def visit_BinOp(self, node):
+      if isinstance(node.op, ast.boolop):
+        new_node = ast.BoolOp(op=node.op, values=[node.left, node.right])
+      elif isinstance(node.op, ast.cmpop):
+        new_node = ast.Compare(left=node.left, ops=[node.op],
+                               comparators=[node.right])
+      else:
+        return ast._Unparser.visit_BinOp(self, node)
+      self.set_precedence(self.get_precedence(node), new_node)
+      self.traverse(new_node)
+
+    # log_calls_start_end() passes print() statements as arguments.
+    def visit_Call(self, node):
+      if any(isinstance(a, ast.Expr) for a in node.args):
+        node = ast.Call(func=node.func, keywords=node.keywords,
+                        args=[a.value if isinstance(a, ast.Expr) else a
+                              for a in node.args])
+      ast._Unparser.visit_Call(self, node)
+# END IF #
+
+class UnparseEmitter:
+  def __init__(self, long_lines=False):
+    if sys.version_info < (3, 9):
+      raise errors_warns.APIError("The unparse emitter requires Python 3.9+.")
+
+  def stmt(self, node):
+    return Unparser().visit(node) + "\n"
+
+  # One blank line before definitions.
+  def sep(self, prev, cur):
+    if isinstance(cur, DEFS):
+      return "\n"
+    return ""
+
+EMITTERS = {
+  "astor": AstorEmitter,
+  "unparse": UnparseEmitter,
+}
+
+# `emitter` is either the name of one of the EMITTERS or an emitter object.
+def get_emitter(emitter, long_lines=False):
+  if not isinstance(emitter, str):
+    return emitter
+  if emitter not in EMITTERS:
+    raise errors_warns.APIError(f"Unknown emitter: {emitter}. Available: "
+                                f"{', '.join(EMITTERS)}")
+  return EMITTERS[emitter](long_lines=long_lines)
+
+# Write the source of `tree` (a Module) to `fp`, one statement at a time.
+def write(tree: ast.Module, fp, emitter):
+  prev = None
+  for stmt in flatten_stmts(tree.body):
+    if prev is not None:
+      fp.write(emitter.sep(prev, stmt))
+    fp.write(emitter.stmt(stmt))
+    prev = stmt
+  ### END FOR ###
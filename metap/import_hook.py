@@ -0,0 +1,121 @@
+import fnmatch
+import hashlib
+import importlib.abc
+import importlib.machinery
+import importlib.util
+import marshal
+import os
+import sys
+from typing import List
+
+from . import metap as metap_
+from .recipe import Recipe, normalize_recipe, apply_recipe, recipe_key
+
+# Applies a metap recipe to modules when they are imported, so that there's no
+# need to run a client and keep the generated files around. E.g.:
+#
+#   import metap
+#   metap.install_import_hook(["compile", "dyn_typecheck"], ["mypkg.*"])
+#   import mypkg.foo   # foo is transformed on import
+#
+# The compiled code is cached in __pycache__ (next to the usual .pyc) and it is
+# reused as long as the source, the recipe, metap's version and the
+# optimization level (e.g., `python -O`) don't change.
+
+# The cache file: the usual magic number followed by the key digest, and then
+# the marshalled code.
+KEY_LEN = hashlib.sha256().digest_size
+
+# `optimize` is the optimization level, which is part of the name, like in the
+# usual .pyc files.
+def cache_path(source_path, optimize=None):
+  if optimize is None:
+    optimize = sys.flags.optimize
+  return importlib.util.cache_from_source(source_path,
+                                          optimization=f'metap{optimize}')
+
+class MetaPLoader(importlib.machinery.SourceFileLoader):
+  def __init__(self, fullname, path, recipe, key):
+    importlib.machinery.SourceFileLoader.__init__(self, fullname, path)
+    self.recipe = recipe
+    self.key = key
+
+  def read_cache(self, path, digest):
+    try:
+      with open(path, 'rb') as fp:
+        data = fp.read()
+    except OSError:
+      return None
+    header = importlib.util.MAGIC_NUMBER + digest
+    if not data.startswith(header):
+      return None
+    try:
+      return marshal.loads(data[len(header):])
+    except (EOFError, ValueError, TypeError):
+      return None
+
+  def write_cache(self, path, digest, code):
+    if sys.dont_write_bytecode:
+      return
+    data = importlib.util.MAGIC_NUMBER + digest + marshal.dumps(code)
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    try:
+      os.makedirs(os.path.dirname(path), exist_ok=True)
+      with open(tmp_path, 'wb') as fp:
+        fp.write(data)
+      os.replace(tmp_path, path)
+    except OSError:
+      # E.g., a read-only directory. We just don't cache.
+      try:
+        os.remove(tmp_path)
+      except OSError:
+        pass
+
+  def get_code(self, fullname):
+    source_path = self.get_filename(fullname)
+    source = self.get_data(source_path)
+    optimize = sys.flags.optimize
+    digest = hashlib.sha256(self.key + f"\0{optimize}\0".encode() +
+                            source).digest()
+
+    path = cache_path(source_path, optimize)
+    code = self.read_cache(path, digest)
+    if code is not None:
+      return code
+
+    mp = metap_.MetaP(filename=source_path)
+    apply_recipe(mp, self.recipe)
+    code = mp.to_code(optimize=optimize)
+    self.write_cache(path, digest, code)
+    return code
+
+class MetaPFinder(importlib.abc.MetaPathFinder):
+  def __init__(self, recipe: Recipe, patterns: List[str]):
+    self.recipe = normalize_recipe(recipe)
+    self.key = recipe_key(self.recipe)
+    self.patterns = patterns
+
+  def matches(self, fullname):
+    # Never transform metap itself.
+    if fullname == 'metap' or fullname.startswith('metap.'):
+      return False
+    return any(fnmatch.fnmatchcase(fullname, patt) for patt in self.patterns)
+
+  def find_spec(self, fullname, path, target=None):
+    if not self.matches(fullname):
+      return None
+    spec = importlib.machinery.PathFinder.find_spec(fullname, path)
+    if spec is None or not isinstance(spec.loader,
+                                      importlib.machinery.SourceFileLoader):
+      return None
+    spec.loader = MetaPLoader(fullname, spec.origin, self.recipe, self.key)
+    return spec
+
+def install_import_hook(recipe: Recipe, patterns: List[str]):
+  finder = MetaPFinder(recipe, patterns)
+  sys.meta_path.insert(0, finder)
+  return finder
+
+def uninstall_import_hook(finder: MetaPFinder):
+  if finder in sys.meta_path:
+    sys.meta_path.remove(finder)
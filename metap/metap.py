@@ -1,4 +1,9 @@
 import ast, astor
+import bisect
+import hashlib
+import contextvars
+import io
+import os
 import sys
 from contextlib import contextmanager
 import copy
@@ -11,16 +16,57 @@ from .macros import rt_lib
 from .macros import default_impl
 
 from . import errors_warns
+from .pass_manager import Pass, PassManager
+from . import emit
+from . import sink as sink_mod
+from .sink import log, flush, get_sink, set_sink, init_sink
+from . import binary_trace
+from .binary_trace import init_trace, flush_trace, decode as decode_trace
+from . import sampling
+from .sampling import make_samplers, sampling_stats
+from . import counters
+from .counters import make_counters, get_counts, reset_counts, dump_counts
+from . import timing
+from .timing import (now_ns, make_timers, log_start_end_timed, get_timings,
+                     dump_timings)
+from . import profiler
+from .profiler import (init_profile, prof_enter, prof_exit, get_profile,
+                       dump_profile, reset_profile)
+from . import switch
+from .switch import enable, disable, is_enabled, register_switch
+from . import typecheck
+from .typecheck import (first_k, random_k, was_checked, mark_checked,
+                        seed_typecheck, reset_checked, register_typecheck,
+                        enable_typechecks, disable_typechecks,
+                        typechecks_enabled)
+from . import violations
+from .violations import (record_violation, get_violations, violation_counts,
+                         reset_violations, dump_violations, flush_violations)
 
 ### HELPERS called from the generated program ###
 
-def log_ret(e, log_info):
-  print(log_info)
+# `sampler` decides whether to log (see sampling.py).
+def log_ret(e, log_info, sampler=None):
+  if sampler is None or sampler():
+    log(log_info)
   return e
 
-def log_call(lam, log_info):
-  print(log_info)
-  return lam()
+# A call site is logged as `metap.log_call(log_info) or <call>`, so this must
+# return None.
+def log_call(log_info, sampler=None):
+  if sampler is None or sampler():
+    log(log_info)
+
+def keep_deco(f):
+  return f
+
+# A call in a decorator is logged by a decorator that comes before it (the
+# decorator expressions are evaluated top to bottom), and does nothing. `on`
+# is the kill switch (see switch.py).
+def log_call_deco(log_info, sampler=None, on=True):
+  if on:
+    log_call(log_info, sampler)
+  return keep_deco
 
 def cvar(cond, globs, var, ift_e_lam):
   if cond:
@@ -31,20 +77,33 @@ def cvar2(cond, globs, var):
   globs[var] = cond
   return cond
 
-__metap_indent_counter = 0
+# The nesting depth of `indent=True`. It's a context variable so that every
+# thread and every asyncio task has its own.
+indent_depth = contextvars.ContextVar('metap_indent_depth', default=0)
+
+# The generated code does:
+#   metap.indent_enter()
+#   try:
+#     ...
+#   finally:
+#     metap.indent_exit()
+def indent_enter(depth=indent_depth):
+  depth.set(depth.get() + 1)
 
+def indent_exit(depth=indent_depth):
+  depth.set(depth.get() - 1)
+
+# Used by code generated by older versions.
 @contextmanager
 def indent_ctx():
-  global __metap_indent_counter
-  __metap_indent_counter += 1   # Increment on entering
+  indent_enter()
   try:
     yield
   finally:
-    __metap_indent_counter -= 1  # Decrement on exiting
+    indent_exit()
 
 def indent_print():
-  for _ in range(__metap_indent_counter):
-    print("  ", end="")
+  get_sink().write("  " * indent_depth.get())
     
 
 def time_exec(code, globals_):
@@ -54,9 +113,11 @@ def time_exec(code, globals_):
   assert '__metap_total_ns' in globals_
   return globals_['__metap_res'], globals_['__metap_total_ns']
 
+# Code generated with the kill switch (see switch.py) by older versions passes
+# False for the prints when it's off.
 def log_start_end(started_print, val, finished_print):
-  assert started_print is None
-  assert finished_print is None
+  assert not started_print
+  assert not finished_print
   return val
 
 ### END HELPERS #
@@ -71,51 +132,327 @@ def fmt_log_info(log_info):
   res += main
   return res
 
-def in_range(lineno, range):
-  if len(range) == 0:
-    return True
-  in_r = False
-  for r in range:
-    if isinstance(r, int) and lineno == r:
-      in_r = True
-      break
-    elif isinstance(r, tuple) and r[0] <= lineno <= r[1]:
-      in_r = True
-      break
-  ### END FOR ###
-  return in_r
+# The log sites of a program. Normally, a site logs its description as text
+# (e.g., `metap::Return(ln=5)`). In trace mode, a site logs only its index in
+# `table`, where its description is kept, to the trace of the module,
+# `_metap_trace` (see binary_trace.py).
+class Sites:
+  TRACE_HELPERS = {
+    "log": "trace",
+    "log_ret": "trace_ret",
+    "log_call": "trace_call",
+    "log_call_deco": "trace_call_deco",
+  }
 
+  def __init__(self):
+    self.binary = False
+    self.table = []
+    # The [sample, max_per_sec] of every sampler (see sampling.py).
+    self.samplers = []
+    # Whether the sites check the kill switch (see switch.py).
+    self.switch = False
+    # The texts of the sites in count mode (see counters.py).
+    self.counted = []
+    # The [name, log_durations] of every timer (see timing.py).
+    self.timers = []
+    # Where the profile goes (see profiler.py).
+    self.profile_out = None
+    # The checker functions of dyn_typecheck(), by name.
+    self.checkers = dict()
+    # Those of the code before ours (see fork()), whose names we can't use
+    # for other annotations.
+    self.outer_checkers = dict()
+    # Whether the checks of dyn_typecheck() check `_metap_typecheck` (see
+    # typecheck.py).
+    self.typecheck_toggle = False
+
+  # What the site passes to the helper. `text` is what it logs, if it's not
+  # the formatted `log_info`.
+  def arg(self, log_info, text=None):
+    if text is None:
+      text = fmt_log_info(log_info)
+    if not self.binary:
+      return ast.Constant(value=text)
+    self.table.append(dict(log_info, text=text))
+    return ast.Constant(value=len(self.table) - 1)
+
+  # The helper to call (e.g., metap.log_ret() or _metap_trace.trace_ret()).
+  def helper(self, name):
+    if self.binary:
+      return ast.Attribute(value=ast.Name(id="_metap_trace"),
+                           attr=self.TRACE_HELPERS[name])
+    return ast.Attribute(value=ast.Name(id="metap"), attr=name)
+
+  # A new sampler, if there's anything to sample. The generated module keeps
+  # its samplers in `_metap_samplers`.
+  def sampler(self, sample, max_per_sec):
+    if sample is None and max_per_sec is None:
+      return None
+    self.samplers.append([sample, max_per_sec])
+    return ast.Subscript(value=ast.Name(id='_metap_samplers'),
+                         slice=ast.Constant(value=len(self.samplers) - 1))
+
+  def log_call(self, log_info, text=None):
+    return ast.Call(
+      func=self.helper('log'),
+      args=[self.arg(log_info, text)],
+      keywords=[]
+    )
 
-class LogReturnWalker(astor.TreeWalk):
-  def __init__(self, range=[]):
-    astor.TreeWalk.__init__(self)
-    self.stef_range = range
+  def log_stmt(self, log_info, text=None):
+    return self.guard_stmt(ast.Expr(value=self.log_call(log_info, text)))
+
+  # `_metap_counts[<site>] += 1`
+  def count_stmt(self, log_info):
+    self.counted.append(fmt_log_info(log_info))
+    slot = ast.Subscript(value=ast.Name(id='_metap_counts'),
+                         slice=ast.Constant(value=len(self.counted) - 1))
+    inc = ast.AugAssign(target=slot, op=ast.Add(), value=ast.Constant(value=1))
+    return self.guard_stmt(inc)
+
+  # A new timer. The generated module keeps its timers in `_metap_timers`.
+  def timer(self, name, log_durations):
+    self.timers.append([name, log_durations])
+    return ast.Subscript(value=ast.Name(id='_metap_timers'),
+                         slice=ast.Constant(value=len(self.timers) - 1))
+
+  # The statements at the top of the generated module that set up the sites
+  # (e.g., `_metap_counts = metap.make_counters([...])`), after the sink and
+  # the trace.
+  def prologue(self):
+    res = []
+    if len(self.samplers) != 0:
+      configs = ast.List(elts=[
+        ast.List(elts=[ast.Constant(value=v) for v in config])
+        for config in self.samplers
+      ])
+      make = ast.Call(
+        func=ast.Attribute(value=ast.Name(id="metap"), attr='make_samplers'),
+        args=[configs],
+        keywords=[]
+      )
+      res.append(ast.Assign(targets=[ast.Name(id='_metap_samplers')],
+                           value=make))
+    if len(self.counted) != 0:
+      make = ast.Call(
+        func=ast.Attribute(value=ast.Name(id="metap"), attr='make_counters'),
+        args=[ast.List(elts=[ast.Constant(value=t)
+                             for t in self.counted])],
+        keywords=[]
+      )
+      res.append(ast.Assign(targets=[ast.Name(id='_metap_counts')],
+                           value=make))
+    if len(self.timers) != 0:
+      configs = ast.List(elts=[
+        ast.List(elts=[ast.Constant(value=v) for v in config])
+        for config in self.timers
+      ])
+      make = ast.Call(
+        func=ast.Attribute(value=ast.Name(id="metap"), attr='make_timers'),
+        args=[configs],
+        keywords=[]
+      )
+      res.append(ast.Assign(targets=[ast.Name(id='_metap_timers')],
+                           value=make))
+    if self.profile_out is not None:
+      init = ast.Call(
+        func=ast.Attribute(value=ast.Name(id="metap"), attr='init_profile'),
+        args=[ast.Constant(value=self.profile_out)],
+        keywords=[]
+      )
+      res.append(ast.Expr(value=init))
+    if self.switch:
+      register = ast.Call(
+        func=ast.Attribute(value=ast.Name(id="metap"), attr='register_switch'),
+        args=[globals_call()],
+        keywords=[]
+      )
+      res.append(ast.Assign(targets=[ast.Name(id='_metap_on')],
+                           value=register))
+    if self.typecheck_toggle:
+      register = ast.Call(
+        func=ast.Attribute(value=ast.Name(id="metap"), attr='register_typecheck'),
+        args=[globals_call()],
+        keywords=[]
+      )
+      res.append(ast.Assign(targets=[ast.Name(id='_metap_typecheck')],
+                           value=register))
+    res.extend(self.checkers.values())
+    return res
+
+  # The number of samplers, counted sites and timers, which the next ones are
+  # numbered after.
+  def offsets(self):
+    return (len(self.samplers), len(self.counted), len(self.timers))
+
+  # The sites of code that follows ours (e.g., the next top-level statement in
+  # watch mode). Its samplers, counted sites and timers are numbered after
+  # ours, and it has its own checkers.
+  def fork(self):
+    res = Sites()
+    res.binary = self.binary
+    res.switch = self.switch
+    res.samplers = list(self.samplers)
+    res.counted = list(self.counted)
+    res.timers = list(self.timers)
+    res.outer_checkers = dict(self.outer_checkers, **self.checkers)
+    return res
+
+  # The annotation (see check_exp()) that the checker `name` checks, if any.
+  def checker_key(self, name):
+    fdef = self.checkers.get(name, self.outer_checkers.get(name))
+    if fdef is None:
+      return None
+    return fdef._metap_key
+
+  # Add the sites of `other`, which was forked from us when we had `offsets`.
+  def join(self, other, offsets):
+    samplers, counted, timers = offsets
+    self.samplers.extend(other.samplers[samplers:])
+    self.counted.extend(other.counted[counted:])
+    self.timers.extend(other.timers[timers:])
+    if other.profile_out is not None:
+      self.profile_out = other.profile_out
+    self.typecheck_toggle = self.typecheck_toggle or other.typecheck_toggle
+    for name, fdef in other.checkers.items():
+      assert self.checker_key(name) in (None, fdef._metap_key)
+      self.checkers.setdefault(name, fdef)
+    ### END FOR ###
 
-  def post_Return(self):
-    assert hasattr(self.cur_node, 'lineno')
-    lineno = self.cur_node.lineno
+  # `mode` is "log" or "count".
+  def site_stmt(self, log_info, mode):
+    if mode == "count":
+      return self.count_stmt(log_info)
+    return self.log_stmt(log_info)
+
+  # With the kill switch, `if _metap_on: <stmt>`.
+  def guard_stmt(self, stmt):
+    if not self.switch:
+      return stmt
+    if_ = ast.If(test=ast.Name(id='_metap_on'), body=[stmt], orelse=[])
+    if_._metap_guard = True
+    return if_
 
-    if not in_range(lineno, self.stef_range):
-      return
+  # With the kill switch, `_metap_on and <e>`.
+  def guard_expr(self, e):
+    if not self.switch:
+      return e
+    return ast.BoolOp(op=ast.And(), values=[ast.Name(id='_metap_on'), e])
+
+# The line ranges given by the user (a list of either single lines or
+# `(from, to)` pairs), normalized to sorted, non-overlapping intervals, so
+# that lookups are logarithmic in the number of ranges.
+class LineRanges:
+  def __init__(self, range):
+    intervals = []
+    for r in range:
+      if isinstance(r, int):
+        intervals.append((r, r))
+      elif isinstance(r, (tuple, list)):
+        intervals.append((r[0], r[1]))
+    ### END FOR ###
+    intervals.sort()
+
+    self.starts = []
+    self.ends = []
+    for first, last in intervals:
+      if len(self.ends) != 0 and first <= self.ends[-1] + 1:
+        self.ends[-1] = max(self.ends[-1], last)
+      else:
+        self.starts.append(first)
+        self.ends.append(last)
+    ### END FOR ###
+    
+    # An empty list means "everything".
+    self.all = len(range) == 0
+
+  def __contains__(self, lineno):
+    if self.all:
+      return True
+    idx = bisect.bisect_right(self.starts, lineno) - 1
+    return idx >= 0 and lineno <= self.ends[idx]
+
+  def overlaps(self, first, last):
+    if self.all:
+      return True
+    idx = bisect.bisect_right(self.starts, last) - 1
+    return idx >= 0 and first <= self.ends[idx]
+
+def in_range(lineno, range):
+  if not isinstance(range, LineRanges):
+    range = LineRanges(range)
+  return lineno in range
+
+# Whether we can skip a whole function or class, because none of its lines is
+# in range.
+def outside_range(node, range: LineRanges):
+  if not isinstance(node, (ast.FunctionDef, ast.AsyncFunctionDef, ast.ClassDef)):
+    return False
+  if not (hasattr(node, 'lineno') and hasattr(node, 'end_lineno')):
+    return False
+  # Decorators come before the `def`.
+  first = min([node.lineno] + [d.lineno for d in node.decorator_list
+                               if hasattr(d, 'lineno')])
+  return not range.overlaps(first, node.end_lineno)
+
+# A pass that only transforms nodes within the given line ranges.
+class RangedPass(Pass):
+  def __init__(self, range):
+    Pass.__init__(self)
+    self.range = LineRanges(range)
+
+  def descends(self, node):
+    return not outside_range(node, self.range)
+
+
+class LogReturnWalker(RangedPass):
+  def __init__(self, range=[], sites=None, sample=None, max_per_sec=None,
+               mode="log"):
+    RangedPass.__init__(self, range)
+    self.sites = sites if sites is not None else Sites()
+    sampling.check_config(sample, max_per_sec)
+    counters.check_mode(mode)
+    if mode == "count" and (sample is not None or max_per_sec is not None):
+      raise errors_warns.APIError("Sampling doesn't apply to the count mode.")
+    self.sample = sample
+    self.max_per_sec = max_per_sec
+    self.mode = mode
+
+  def visit_Return(self, ret: ast.Return):
+    assert hasattr(ret, 'lineno')
+    lineno = ret.lineno
+
+    if not in_range(lineno, self.range):
+      return ret
           
     log_info = {"name": "Return"}
     log_info["ln"] = lineno
 
-    out_log = fmt_log_info(log_info)
+    # The return is counted right before its value is evaluated.
+    if self.mode == "count":
+      return [self.sites.count_stmt(log_info), ret]
 
-    val = self.cur_node.value
+    val = ret.value
     if val is None:
       # `return` and `return None` are the same
       val = ast.Constant(value=None, kind=None)
 
-    new_node = ast.Return(
-      value=ast.Call(
-        func=ast.Attribute(value=ast.Name(id="metap"), attr='log_ret'),
-        args=[val, ast.Constant(value=out_log)],
-        keywords=[]
-      )
+    args = [val, self.sites.arg(log_info)]
+    sampler = self.sites.sampler(self.sample, self.max_per_sec)
+    if sampler is not None:
+      args.append(sampler)
+
+    new_val = ast.Call(
+      func=self.sites.helper('log_ret'),
+      args=args,
+      keywords=[]
     )
-    self.replace(new_node)
+    # With the kill switch, `<log_ret> if _metap_on else <val>`.
+    if self.sites.switch:
+      new_val = ast.IfExp(test=ast.Name(id='_metap_on'), body=new_val,
+                          orelse=copy.deepcopy(val))
+    new_node = ast.Return(value=new_val)
+    return new_node
 
 def get_print(arg):
   print_call = ast.Call(
@@ -127,12 +464,7 @@ def get_print(arg):
   
   return print_e
 
-def get_print_str(arg:str):
-  assert isinstance(arg, str)
-
-  return get_print(ast.Constant(value=arg))
-
-def break_cont(cur_node, kind, range):
+def break_cont(cur_node, kind, range, sites: Sites, mode):
   assert hasattr(cur_node, 'lineno')
   lineno = cur_node.lineno
 
@@ -142,34 +474,48 @@ def break_cont(cur_node, kind, range):
   log_info = {"name": kind}
   log_info["ln"] = lineno
 
-  out_log = fmt_log_info(log_info)
-  
-  print_before = get_print_str(out_log)
+  print_before = sites.site_stmt(log_info, mode)
   
   return [print_before, cur_node]
 
-class LogBreakCont(ast.NodeTransformer):
-  def __init__(self, kind, range):
-    ast.NodeTransformer.__init__(self)
+class LogBreakCont(RangedPass):
+  def __init__(self, kind, range, sites=None, mode="log"):
+    RangedPass.__init__(self, range)
     self.kind = kind
-    self.range = range
+    self.sites = sites if sites is not None else Sites()
+    counters.check_mode(mode)
+    self.mode = mode
 
   def visit_Continue(self, node):
     if self.kind == "Continue":
-      return break_cont(node, self.kind, self.range)
+      return break_cont(node, self.kind, self.range, self.sites, self.mode)
     else:
       return node
 
   def visit_Break(self, node):
     if self.kind == "Break":
-      return break_cont(node, self.kind, self.range)
+      return break_cont(node, self.kind, self.range, self.sites, self.mode)
     else:
       return node
 
-class LogCallSite(ast.NodeTransformer):
-  def __init__(self, range=[]):
-    ast.NodeTransformer.__init__(self)
-    self.range = range
+class LogCallSite(RangedPass):
+  def __init__(self, range=[], sites=None, sample=None, max_per_sec=None):
+    RangedPass.__init__(self, range)
+    self.sites = sites if sites is not None else Sites()
+    sampling.check_config(sample, max_per_sec)
+    self.sample = sample
+    self.max_per_sec = max_per_sec
+
+  # We don't log calls nested inside other calls. For the calls we log, we want
+  # the text of the call as it was before any later pass changed it.
+  def descends(self, node):
+    return not isinstance(node, ast.Call) and RangedPass.descends(self, node)
+
+  def holds(self, node):
+    if (isinstance(node, ast.Call) and hasattr(node, 'lineno') and
+        in_range(node.lineno, self.range)):
+      return node._fields
+    return ()
 
   def visit_Call(self, node):
     assert hasattr(node, 'lineno')
@@ -182,32 +528,67 @@ class LogCallSite(ast.NodeTransformer):
     log_info["ln"] = lineno
     log_info["call"] = astor.to_source(node).strip()
 
-    out_log = fmt_log_info(log_info)
-    
-    # Here we have to do some gymnastics. The problem is that we want the log
-    # info to be printed _before_ the call happens. So, we can't just pass the
-    # original node as an argument to log_call() because it will be evaluated
-    # before log_call() is called, and thus before log_call() prints the info.
-    # So, we wrap the original call in a lambda that we call inside log_call()
-    # after we print the info.
-    
-    lambda_args = ast.arguments(
-      args=[],
-      defaults=[],
-      kw_defaults=[],
-      kwarg=None,
-      kwonlyargs=[],
-      posonlyargs=[],
-      vararg=None
-    )
-    
-    new_node = ast.Call(
-        func=ast.Attribute(value=ast.Name(id="metap"), attr='log_call'),
-        args=[ast.Lambda(args=lambda_args, body=node), ast.Constant(value=out_log)],
+    # We want the log info to be printed _before_ the call happens. So, we
+    # can't pass the original call as an argument to log_call(), because it
+    # would be evaluated first. Instead, we generate:
+    #   metap.log_call(<info>) or <call>
+    # log_call() returns None, so the result is that of the call. Unlike
+    # wrapping the call in a lambda, this doesn't allocate a closure or add a
+    # frame, and the call stays in its scope (e.g., super() works).
+    args = [self.sites.arg(log_info)]
+    sampler = self.sites.sampler(self.sample, self.max_per_sec)
+    if sampler is not None:
+      args.append(sampler)
+
+    log_e = ast.Call(
+        func=self.sites.helper('log_call'),
+        args=args,
         keywords=[]
       )
+    new_node = ast.BoolOp(op=ast.Or(),
+                          values=[self.sites.guard_expr(log_e), node])
+    new_node._metap_logged_call = log_e
     return new_node
 
+  # When the call is a statement on its own, we log in a separate statement.
+  def visit_Expr(self, node):
+    if not is_logged_call(node.value):
+      return node
+    log_e = node.value._metap_logged_call
+    call = node.value.values[1]
+    log_stmt = self.sites.guard_stmt(ast.Expr(value=log_e))
+    return [ast.copy_location(log_stmt, node),
+            ast.copy_location(ast.Expr(value=call), node)]
+
+  # Before Python 3.9, a decorator can only be a (dotted) name or a call to
+  # one, so calls in decorators are logged with log_call_deco().
+  def log_decorators(self, node):
+    decos = []
+    for d in node.decorator_list:
+      if not is_logged_call(d):
+        decos.append(d)
+        continue
+      log_e = d._metap_logged_call
+      log_e.func = self.sites.helper('log_call_deco')
+      if self.sites.switch:
+        log_e.keywords = [ast.keyword(arg='on', value=ast.Name(id='_metap_on'))]
+      decos.extend([log_e, d.values[1]])
+    ### END FOR ###
+    node.decorator_list = decos
+    return node
+
+  def visit_FunctionDef(self, node):
+    return self.log_decorators(node)
+
+  def visit_AsyncFunctionDef(self, node):
+    return self.log_decorators(node)
+
+  def visit_ClassDef(self, node):
+    return self.log_decorators(node)
+
+def is_logged_call(node):
+  return getattr(node, '_metap_logged_call', None) is not None
+
 def globals_call():
   call = ast.Call(
     func=ast.Name(id="globals"),
@@ -315,9 +696,9 @@ def structural_introspection(loop):
     not_exists_directive(loop, _no_break_ln, ast.Break)
   # END IF #
 
-class NecessaryTransformer(ast.NodeTransformer):
+class NecessaryTransformer(Pass):
   def __init__(self, macro_defs_ast=None):
-    ast.NodeTransformer.__init__(self)
+    Pass.__init__(self)
     self.macro_defs = set()
     if macro_defs_ast is None:
       return
@@ -345,6 +726,27 @@ class NecessaryTransformer(ast.NodeTransformer):
     # TODO:Delete the file here.
     pass
 
+  def is_macro_call(self, e):
+    if not (isinstance(e, ast.Expr) and isinstance(e.value, ast.Call)):
+      return False
+    func = e.value.func
+    if not isinstance(func, ast.Name):
+      return False
+    return func.id in self.macro_defs or func.id in default_impl.macro_defs
+
+  # A macro needs the ASTs of what the user passes, untouched. Similarly,
+  # _time_e() needs the text of its argument, and the _cvar()'s inside an `if`
+  # condition are handled when we visit the `if`.
+  def holds(self, node):
+    if self.is_macro_call(node):
+      return node._fields
+    if (isinstance(node, ast.Call) and isinstance(node.func, ast.Name) and
+        node.func.id == '_time_e'):
+      return node._fields
+    if isinstance(node, ast.If):
+      return ('test',)
+    return ()
+
   # We won't change the node, but since we're anyway visiting the tree, we can
   # perform the necessary checks here.
 
@@ -353,26 +755,18 @@ class NecessaryTransformer(ast.NodeTransformer):
 
   def visit_For(self, for_):
     structural_introspection(for_)
-    # generic_visit() to visit the children but not the node itself, so that we
-    # don't get into infinite recursion.
-    self.generic_visit(for_)
     return for_
 
   def visit_While(self, whil):
     structural_introspection(whil)
-    self.generic_visit(whil)
     return whil
 
   # Handle macros
   def visit_Expr(self, e):
-    if not isinstance(e.value, ast.Call):
-      self.generic_visit(e)
+    if not self.is_macro_call(e):
       return e
     call = e.value
     func = call.func
-    if not isinstance(func, ast.Name):
-      self.generic_visit(e)
-      return e
 
     # A macro needs the ASTs of what the user passes (not the evaluated code,
     # which is the default). Conveniently, these are already in `call.args`.
@@ -381,15 +775,11 @@ class NecessaryTransformer(ast.NodeTransformer):
     if func.id in self.macro_defs:  
       assert func.id in globals()
       return globals()[func.id](*call.args)
-    elif func.id in default_impl.macro_defs:
-      return getattr(default_impl, func.id)(*call.args)
     else:
-      self.generic_visit(e)
-      return e
+      return getattr(default_impl, func.id)(*call.args)
   
   def visit_Call(self, call: ast.Call):
     if not isinstance(call.func, ast.Name):
-      self.generic_visit(call)
       return call
 
     # Verify correct usage of macros and _cvar
@@ -425,7 +815,6 @@ __metap_total_ns = __metap_end_ns - __metap_start_ns
       return new_call
     # END IF #
     
-    self.generic_visit(call)
     return call
 
   # _cvar
@@ -502,16 +891,10 @@ __metap_total_ns = __metap_end_ns - __metap_start_ns
     # `or`. And in general, it needs much more gymnastics.
     
 
-    new_body = []
-    new_orelse = []
-    # WARNING: We call visit() and _not_ generic_visit(), because the latter
-    # will visit the children but not the node itself. So, in an `if-elif`, in
-    # which case the `if`'s orelse has an if inside, the innermost `if` will not
-    # be visited.
-    for b in if_.body:
-      new_body.append(self.visit(b))
-    for s in if_.orelse:
-      new_orelse.append(self.visit(s))
+    # Note that the body and the orelse have already been visited (including
+    # any `if` in the orelse, in an `if-elif`).
+    new_body = if_.body
+    new_orelse = if_.orelse
 
     cvar_tr = CVarTransformer()
     if_test = cvar_tr.visit(if_.test)
@@ -557,7 +940,8 @@ __metap_total_ns = __metap_end_ns - __metap_start_ns
 
     return if_
 
-def indent_triple(body, print_log_e):
+# In trace mode, the indentation is not recorded.
+def indent_triple(body, print_log_e, sites: Sites):
   print_indent = ast.Call(
     func=ast.Attribute(value=ast.Name(id="metap"), attr='indent_print'),
     args=[],
@@ -565,23 +949,60 @@ def indent_triple(body, print_log_e):
   )
   print_indent_e = ast.Expr(value=print_indent)
 
-  indent_ctx = ast.Call(
-    func=ast.Attribute(value=ast.Name(id="metap"), attr='indent_ctx'),
+  if sites.binary:
+    return [print_log_e] + body
+
+  # Instead of `with metap.indent_ctx():`, which costs a generator, we inline
+  # the try/finally.
+  enter = ast.Call(
+    func=ast.Attribute(value=ast.Name(id="metap"), attr='indent_enter'),
     args=[],
     keywords=[]
   )
-  with_ = ast.With(
-    items=[ast.withitem(context_expr=indent_ctx, optional_vars=None)],
-    body=body
+  exit_ = ast.Call(
+    func=ast.Attribute(value=ast.Name(id="metap"), attr='indent_exit'),
+    args=[],
+    keywords=[]
   )
   
-  return [print_indent_e, print_log_e, with_]
-
-class LogFuncDef(ast.NodeTransformer):
-  def __init__(self, range=[], indent=False):
-    ast.NodeTransformer.__init__(self)
-    self.range = range
+  # With the kill switch, the switch is read once, when the function starts,
+  # and the indentation goes inside the same guard:
+  #   _metap_indent = _metap_on
+  #   if _metap_indent:
+  #     metap.indent_print()
+  #     metap.log('metap::FuncDef(ln=2,func=foo)')
+  #     metap.indent_enter()
+  #   try:
+  #     <body>
+  #   finally:
+  #     if _metap_indent:
+  #       metap.indent_exit()
+  # So, the indentation is restored even if the switch flips during the call.
+  if sites.switch:
+    read = ast.Assign(targets=[ast.Name(id='_metap_indent', ctx=ast.Store())],
+                      value=ast.Name(id='_metap_on'))
+    print_log_e.test = ast.Name(id='_metap_indent')
+    print_log_e.body = ([print_indent_e] + print_log_e.body +
+                        [ast.Expr(value=enter)])
+    exit_guard = ast.If(test=ast.Name(id='_metap_indent'),
+                        body=[ast.Expr(value=exit_)], orelse=[])
+    exit_guard._metap_guard = True
+    try_ = ast.Try(body=body, handlers=[], orelse=[], finalbody=[exit_guard])
+    return [read, print_log_e, try_]
+  try_ = ast.Try(body=body, handlers=[], orelse=[],
+                 finalbody=[ast.Expr(value=exit_)])
+  return [print_indent_e, print_log_e, ast.Expr(value=enter), try_]
+
+class LogFuncDef(RangedPass):
+  def __init__(self, range=[], indent=False, sites=None):
+    RangedPass.__init__(self, range)
     self.indent = indent
+    self.sites = sites if sites is not None else Sites()
+
+  # We don't log nested functions.
+  def descends(self, node):
+    return (not isinstance(node, ast.FunctionDef) and
+            RangedPass.descends(self, node))
 
   def visit_FunctionDef(self, fdef:ast.FunctionDef):
     assert hasattr(fdef, 'lineno')
@@ -596,25 +1017,107 @@ class LogFuncDef(ast.NodeTransformer):
     log_info["ln"] = lineno
     log_info["func"] = fname
 
-    out_log = fmt_log_info(log_info)
-
-    print_log_e = get_print_str(out_log)
+    print_log_e = self.sites.log_stmt(log_info)
 
     if not self.indent:
       fdef.body = [print_log_e] + fdef.body
       return fdef
     else:
-      new_body = indent_triple(body=fdef.body, print_log_e=print_log_e)
+      new_body = indent_triple(body=fdef.body, print_log_e=print_log_e,
+                               sites=self.sites)
       fdef.body = new_body
       return fdef
 
-class LogIfs(ast.NodeTransformer):
-  def __init__(self, range=[], indent=False):
-    ast.NodeTransformer.__init__(self)
-    self.range = range
+# Whether `node` has a yield outside of any nested function or class.
+def yields_directly(node):
+  for child in ast.iter_child_nodes(node):
+    if isinstance(child, (ast.FunctionDef, ast.AsyncFunctionDef, ast.ClassDef,
+                          ast.Lambda)):
+      continue
+    if isinstance(child, (ast.Yield, ast.YieldFrom)) or yields_directly(child):
+      return True
+  ### END FOR ###
+  return False
+
+class ProfileFuncs(RangedPass):
+  def __init__(self, module, range=[]):
+    RangedPass.__init__(self, range)
+    self.module = module
+
+  # We don't profile nested functions.
+  def descends(self, node):
+    return (not isinstance(node, ast.FunctionDef) and
+            RangedPass.descends(self, node))
+
+  def visit_FunctionDef(self, fdef: ast.FunctionDef):
+    assert hasattr(fdef, 'lineno')
+    if not in_range(fdef.lineno, self.range):
+      return fdef
+    if yields_directly(fdef):
+      return fdef
+
+    name = ast.Constant(value=f"{self.module}:{fdef.name}")
+    enter = ast.Call(
+      func=ast.Attribute(value=ast.Name(id="metap"), attr='prof_enter'),
+      args=[name],
+      keywords=[]
+    )
+    exit_ = ast.Call(
+      func=ast.Attribute(value=ast.Name(id="metap"), attr='prof_exit'),
+      args=[ast.Name(id='_metap_start')],
+      keywords=[]
+    )
+    body = fdef.body
+    # Keep the docstring first.
+    doc = []
+    if (isinstance(body[0], ast.Expr) and isinstance(body[0].value, ast.Constant)
+        and isinstance(body[0].value.value, str)):
+      doc, body = body[:1], body[1:]
+    # END IF #
+    if len(body) == 0:
+      body = [ast.Pass()]
+    try_ = ast.Try(body=body, handlers=[], orelse=[],
+                   finalbody=[ast.Expr(value=exit_)])
+    start = ast.Assign(targets=[ast.Name(id='_metap_start')], value=enter)
+    fdef.body = doc + [start, try_]
+    # The classes around it will qualify the name.
+    fdef._metap_prof_names = [(name, fdef.name)]
+    return fdef
+
+  # Methods are named `<module>:<class>.<method>`.
+  def visit_ClassDef(self, cls: ast.ClassDef):
+    names = []
+    for stmt in cls.body:
+      for const, qualname in getattr(stmt, '_metap_prof_names', []):
+        qualname = f"{cls.name}.{qualname}"
+        const.value = f"{self.module}:{qualname}"
+        names.append((const, qualname))
+      ### END FOR ###
+    ### END FOR ###
+    cls._metap_prof_names = names
+    return cls
+
+class LogIfs(RangedPass):
+  def __init__(self, range=[], indent=False, sites=None, mode="log"):
+    RangedPass.__init__(self, range)
+    counters.check_mode(mode)
+    if mode == "count" and indent:
+      raise errors_warns.APIError("indent doesn't apply to the count mode.")
     self.indent = indent
+    self.sites = sites if sites is not None else Sites()
+    self.mode = mode
+
+  # We don't log `if`s nested inside an `if` that is not in range.
+  def descends(self, node):
+    if isinstance(node, ast.If) and hasattr(node, 'lineno'):
+      return in_range(node.lineno, self.range)
+    return RangedPass.descends(self, node)
 
   def visit_If(self, if_:ast.If):
+    # The kill switch of another log site.
+    if getattr(if_, '_metap_guard', False):
+      return if_
+
     assert hasattr(if_, 'lineno')
     then_lineno = if_.lineno
 
@@ -624,37 +1127,35 @@ class LogIfs(ast.NodeTransformer):
     log_info_then = {"name": "If"}
     log_info_then["ln"] = then_lineno
     
-    out_log_then = fmt_log_info(log_info_then)
-    
     log_info_else = {"name": "Else"}
     log_info_else["ln"] = then_lineno
-    
-    out_log_else = fmt_log_info(log_info_else)
 
-    new_then = []
-    new_else = []
-    for b in if_.body:
-      new_then.append(self.visit(b))
-    ### END FOR ###
-    for s in if_.orelse:
-      new_else.append(self.visit(s))
-    ### END FOR ###
+    # An `elif` is logged as an `If`.
+    log_else = (len(if_.orelse) != 0 and
+                not isinstance(if_.orelse[0], ast.If))
+
+    # The body and the orelse have already been visited.
+    new_then = if_.body
+    new_else = if_.orelse
     
-    print_then = get_print_str(out_log_then)
-    print_else = get_print_str(out_log_else)
+    print_then = self.sites.site_stmt(log_info_then, self.mode)
+    if log_else:
+      print_else = self.sites.site_stmt(log_info_else, self.mode)
 
     if not self.indent:
       new_then = [print_then] + new_then
-      new_else = [print_else] + new_else
+      if log_else:
+        new_else = [print_else] + new_else
     else:
-      
-      new_then = indent_triple(body=new_then, print_log_e=print_then)
-      new_else = indent_triple(body=new_else, print_log_e=print_else)
+      new_then = indent_triple(body=new_then, print_log_e=print_then,
+                               sites=self.sites)
+      if log_else:
+        new_else = indent_triple(body=new_else, print_log_e=print_else,
+                                 sites=self.sites)
     # END IF #
 
     if_.body = new_then
-    if len(if_.orelse) != 0 and not isinstance(if_.orelse[0], ast.If):
-      if_.orelse = new_else
+    if_.orelse = new_else
     
     return if_
 
@@ -693,8 +1194,45 @@ def ann_id(curr: List[int]):
   curr[0] = curr[0] + 1
   return curr[0]
 
-# Generate expression that goes into an assert that `obj` is of type `ann`
-def exp_for_ann(obj, ann, id_curr):
+# `all(<elt> for <target> in <iter>)`, for the elements of the container `obj`,
+# as `check` (a (container_check, container_k), see typecheck.py) says.
+def all_elems(obj, elt, target, iter, check):
+  container_check, k = check
+  if container_check in ("first_k", "random_k"):
+    iter = ast.Call(
+      func=ast.Attribute(value=ast.Name(id='metap'), attr=container_check),
+      args=[iter, ast.Constant(value=k)],
+      keywords=[]
+    )
+  gen = ast.GeneratorExp(
+    elt=elt,
+    generators=[ast.comprehension(target=target, iter=iter, ifs=[], is_async=False)]
+  )
+  all_call = ast.Call(
+    func=ast.Name(id='all'),
+    args=[gen],
+    keywords=[]
+  )
+  if container_check != "once_per_object":
+    return all_call
+  # `metap.was_checked(obj) or metap.mark_checked(obj, <all_call>)`
+  was = ast.Call(
+    func=ast.Attribute(value=ast.Name(id='metap'), attr='was_checked'),
+    args=[obj],
+    keywords=[]
+  )
+  mark = ast.Call(
+    func=ast.Attribute(value=ast.Name(id='metap'), attr='mark_checked'),
+    args=[obj, all_call],
+    keywords=[]
+  )
+  return ast.BinOp(left=was, op=ast.Or(), right=mark)
+
+FULL_CHECK = ("full", None)
+
+# Generate expression that goes into an assert that `obj` is of type `ann`.
+# `check` is how containers are checked (see all_elems()).
+def exp_for_ann(obj, ann, id_curr, check=FULL_CHECK):
   if isinstance(ann, ast.Constant):
     return ast.Compare(left=obj, ops=[ast.Eq()], comparators=[ann])
   
@@ -711,7 +1249,7 @@ def exp_for_ann(obj, ann, id_curr):
   if cons.id not in acceptable_constructors:
     raise errors_warns.UnsupportedError(f"dyn_typecheck: {optional_lineno(ann)}{astor.to_source(cons).strip()} annotation is not supported.")
   if cons.id == 'Optional':
-    is_ty = exp_for_ann(obj, slice, id_curr)
+    is_ty = exp_for_ann(obj, slice, id_curr, check)
     is_none = isnone_cond(obj)
     or_ = ast.BinOp(left=is_ty, op=ast.Or(), right=is_none)
     return or_ 
@@ -724,14 +1262,14 @@ def exp_for_ann(obj, ann, id_curr):
       raise errors_warns.APIError(f"dyn_typecheck:{optional_lineno(ann)}Union requires at least two arguments.")
     l = elts[0]
     r = elts[1]
-    is_l = exp_for_ann(obj, l, id_curr)
-    is_r = exp_for_ann(obj, r, id_curr)
+    is_l = exp_for_ann(obj, l, id_curr, check)
+    is_r = exp_for_ann(obj, r, id_curr, check)
     or_ = ast.BinOp(left=is_l, op=ast.Or(), right=is_r)
     curr = or_
     
     for i, elt in enumerate(elts[2:]):
-      check = exp_for_ann(obj, elt, id_curr)
-      curr = ast.BinOp(left=curr, op=ast.Or(), right=check)
+      is_elt = exp_for_ann(obj, elt, id_curr, check)
+      curr = ast.BinOp(left=curr, op=ast.Or(), right=is_elt)
     return curr
   elif cons.id == 'Tuple':
     elts = slice.elts
@@ -756,7 +1294,7 @@ def exp_for_ann(obj, ann, id_curr):
         value=obj,
         slice=ast.Constant(value=i)
       )
-      curr = ast.BinOp(left=curr, op=ast.And(), right=exp_for_ann(sub, elt, id_curr))
+      curr = ast.BinOp(left=curr, op=ast.And(), right=exp_for_ann(sub, elt, id_curr, check))
     ### END FOR ###
     and_isinst = ast.BinOp(left=isinst, op=ast.And(), right=curr)
     return and_isinst
@@ -768,16 +1306,8 @@ def exp_for_ann(obj, ann, id_curr):
     isinst = isinst_call(obj, ast.Name(id='list'))
     
     iter_el = ast.Name(id='__metap_x' + str(ann_id(id_curr)))
-    el_ty = exp_for_ann(iter_el, slice, id_curr)
-    list_comp = ast.ListComp(
-      elt=el_ty,
-      generators=[ast.comprehension(target=iter_el, iter=obj, ifs=[], is_async=False)]
-    )
-    all_call = ast.Call(
-      func=ast.Name(id='all'),
-      args=[list_comp],
-      keywords=[]
-    )
+    el_ty = exp_for_ann(iter_el, slice, id_curr, check)
+    all_call = all_elems(obj, el_ty, iter_el, obj, check)
     and_ = ast.BinOp(left=isinst, op=ast.And(), right=all_call)
     return and_
   elif cons.id == 'Dict':
@@ -793,23 +1323,15 @@ def exp_for_ann(obj, ann, id_curr):
     key_iter = ast.Name(id='_metap_k' + str(ann_id(id_curr)))
     val_iter = ast.Name(id='_metap_v' + str(ann_id(id_curr)))
     iter = ast.Tuple(elts=[key_iter, val_iter])
-    key_ty = exp_for_ann(key_iter, key_ann, id_curr)
-    val_ty = exp_for_ann(val_iter, val_ann, id_curr)
+    key_ty = exp_for_ann(key_iter, key_ann, id_curr, check)
+    val_ty = exp_for_ann(val_iter, val_ann, id_curr, check)
     and_ = ast.BinOp(left=key_ty, op=ast.And(), right=val_ty)
     items = ast.Call(
       func=ast.Attribute(value=obj, attr='items'),
       args=[],
       keywords=[]
     )
-    list_comp = ast.ListComp(
-      elt=and_,
-      generators=[ast.comprehension(target=iter, iter=items, ifs=[], is_async=False)]
-    )
-    all_call = ast.Call(
-      func=ast.Name(id='all'),
-      args=[list_comp],
-      keywords=[]
-    )
+    all_call = all_elems(obj, and_, iter, items, check)
     and_ = ast.BinOp(left=isinst, op=ast.And(), right=all_call)
     return and_
   elif cons.id == 'Type':
@@ -827,25 +1349,95 @@ def get_type_call(obj):
     keywords=[]
   )
 
-def ann_if(obj, ann, id_curr):
+# A compound annotation (e.g., `Dict[str, List[int]]`) is checked by a
+# function at the top of the module, which is shared by all the annotations
+# that are the same, so the code grows with the number of distinct types and
+# not with the number of annotations:
+#   def _metap_check_<hash>(obj):
+#     return <exp_for_ann(obj, ann)>
+# The name doesn't start with `__` because it would be mangled in classes.
+# It has the first 8 hex digits of the hash, unless another annotation got
+# them, in which case it has all of them. Simpler annotations are checked
+# inline.
+def check_exp(obj, ann, sites, check):
+  if not isinstance(ann, ast.Subscript):
+    return exp_for_ann(obj, ann, [0], check)
+  key = ast.dump(ann)
+  if check != FULL_CHECK:
+    key = f"{check}:{key}"
+  digest = hashlib.sha1(key.encode('utf-8')).hexdigest()
+  name = '_metap_check_' + digest[:8]
+  if sites.checker_key(name) not in (None, key):
+    name = '_metap_check_' + digest
+  if name not in sites.checkers:
+    # Parse it, so that the FunctionDef has the fields of this Python version.
+    fdef = ast.parse(f"def {name}(obj):\n  return None").body[0]
+    fdef.body[0].value = exp_for_ann(ast.Name(id='obj'), ann, [0], check)
+    fdef._metap_key = key
+    sites.checkers[name] = fdef
+  # END IF #
+  return ast.Call(func=ast.Name(id=name), args=[obj], keywords=[])
+
+# `metap.record_violation(<site>, <values>)` (see violations.py)
+def record_stmt(site, values):
+  call = ast.Call(
+    func=ast.Attribute(value=ast.Name(id='metap'), attr='record_violation'),
+    args=[ast.Constant(value=site)] + values,
+    keywords=[]
+  )
+  return ast.Expr(value=call)
+
+# `guards` are the names that must be true for the check to run (e.g.,
+# `__debug__`). If `site` is given, a violation is recorded instead of failing.
+def ann_if(obj, ann, sites, check=FULL_CHECK, guards=[], site=None):
   type_call = get_type_call(obj)
   print_ty = get_print(type_call)
   print_obj = get_print(obj)
   assert_f = ast.Assert(
     test=ast.Constant(value=False)
   )
+  body = [print_obj, print_ty, assert_f]
+  if site is not None:
+    body = [record_stmt(site, [obj])]
+  test = ast.UnaryOp(op=ast.Not(), operand=check_exp(obj, ann, sites, check))
+  if len(guards) != 0:
+    guard = ast.Name(id=guards[0])
+    for name in guards[1:]:
+      guard = ast.BinOp(left=guard, op=ast.And(), right=ast.Name(id=name))
+    test = ast.BinOp(left=guard, op=ast.And(), right=test)
+  # END IF #
   if_ = ast.If(
-    test=ast.UnaryOp(op=ast.Not(), operand=exp_for_ann(obj, ann, id_curr)),
-    body=[print_obj, print_ty, assert_f],
+    test=test,
+    body=body,
     orelse=[]
   )
   return if_
 
-class DynTypecheck(ast.NodeTransformer):
-  def __init__(self, skip_funcs: Optional[List[str]]):
-    ast.NodeTransformer.__init__(self)
+class DynTypecheck(Pass):
+  def __init__(self, skip_funcs: Optional[List[str]], sites=None,
+               check=FULL_CHECK, debug_only=False, toggle=False,
+               on_violation="assert"):
+    Pass.__init__(self)
     self.skip_funcs = skip_funcs
-    self.id_curr = [0]
+    self.sites = sites if sites is not None else Sites()
+    self.check = check
+    self.on_violation = on_violation
+    self.guards = []
+    if debug_only:
+      self.guards.append('__debug__')
+    if toggle:
+      self.guards.append('_metap_typecheck')
+      self.sites.typecheck_toggle = True
+
+  # The check that `obj`, which is `var` at line `ln`, is an `ann`.
+  def ann_if(self, obj, ann, ln, var):
+    site = None
+    if self.on_violation == "record":
+      site = fmt_log_info({"name": "TypeCheck", "ln": ln, "var": var})
+    return ann_if(obj, ann, self.sites, self.check, self.guards, site)
+
+  def descends(self, node):
+    return not isinstance(node, ast.FunctionDef)
 
   def visit_AnnAssign(self, node: ast.AnnAssign):
     target = node.target
@@ -859,7 +1451,7 @@ class DynTypecheck(ast.NodeTransformer):
       return node
 
     ann = node.annotation
-    if_ = ann_if(target, ann, self.id_curr)
+    if_ = self.ann_if(target, ann, node.lineno, target.id)
     return [node, if_]
 
   def visit_FunctionDef(self, fdef:ast.FunctionDef):
@@ -877,53 +1469,76 @@ class DynTypecheck(ast.NodeTransformer):
     
     args = fdef.args.args
     
-    in_class = False
     if len(args) > 0 and args[0].arg == 'self':
       args = args[1:]
-      in_class = True
     
     for arg in args:
       assert isinstance(arg, ast.arg)
       ann = arg.annotation
       if ann is not None:
         id_ = ast.Name(id=arg.arg)
-        if_ = ann_if(id_, ann, self.id_curr)
+        if_ = self.ann_if(id_, ann, arg.lineno, arg.arg)
         ifs.append(if_)
     ### END FOR ###
     
     new_body = ifs + fdef.body
 
     ret_ann = fdef.returns
+    # The value a generator returns is not what the caller gets.
     if ret_ann is not None:
-      helper_func = copy.deepcopy(fdef)
-      helper_name = '__metap_'+fdef.name
-      helper_func.name = helper_name
-      helper_func.body = new_body
-      how_to_call = ast.Name(id=helper_name)
-      if in_class:
-        how_to_call = ast.Attribute(ast.Name(id='self'), attr=helper_name)
-      call_helper = ast.Call(
-        func=how_to_call,
-        args=[
-          ast.Name(id=arg.arg, ctx=ast.Load())
-          for arg in args
-        ],
-        keywords=[]
-      )
-      ret_var = ast.Name(id='__metap_retv')
-      asgn = ast.Assign(
-        targets=[ret_var],
-        value=call_helper
-      )
-      ret = ast.Return(
-        value=ret_var
-      )
-      if_ = ann_if(ret_var, ret_ann, self.id_curr)
-      fdef.body = [asgn, if_, ret]
-      return [helper_func, fdef]
-    else:
-      fdef.body = new_body
-      return fdef
+      # Reject unsupported annotations even if there's no return to check.
+      exp_for_ann(ast.Name(id='obj'), ret_ann, [0], self.check)
+    if ret_ann is not None and not yields_directly(fdef):
+      # Falling off the end returns None, which has to be checked too.
+      if not isinstance(new_body[-1], (ast.Return, ast.Raise)):
+        new_body.append(ast.Return(value=None))
+      # The return we add has no line.
+      make_check = lambda ret_var, ret: self.ann_if(
+        ret_var, ret_ann, getattr(ret, 'lineno', fdef.lineno), "return")
+      checks = RetChecks(make_check)
+      checked = []
+      for stmt in new_body:
+        out = checks.visit(stmt)
+        if isinstance(out, list):
+          checked.extend(out)
+        else:
+          checked.append(out)
+      ### END FOR ###
+      new_body = checked
+    # END IF #
+    fdef.body = new_body
+    return fdef
+
+# Checks the value of every return of a function in place:
+#   __metap_retv = <value>
+#   <check of __metap_retv>
+#   return __metap_retv
+# It doesn't go into nested functions and classes.
+class RetChecks(ast.NodeTransformer):
+  def __init__(self, make_check):
+    ast.NodeTransformer.__init__(self)
+    self.make_check = make_check
+
+  def visit_FunctionDef(self, fdef):
+    return fdef
+
+  def visit_AsyncFunctionDef(self, fdef):
+    return fdef
+
+  def visit_ClassDef(self, cls):
+    return cls
+
+  def visit_Lambda(self, lam):
+    return lam
+
+  def visit_Return(self, ret: ast.Return):
+    value = ret.value
+    if value is None:
+      value = ast.Constant(value=None)
+    asgn = ast.Assign(targets=[ast.Name(id='__metap_retv')], value=value)
+    check = self.make_check(ast.Name(id='__metap_retv'), ret)
+    new_ret = ast.Return(value=ast.Name(id='__metap_retv'))
+    return [asgn, check, new_ret]
 
 class TypedefGather(ast.NodeTransformer):
   def __init__(self):
@@ -957,9 +1572,9 @@ class TypedefGather(ast.NodeTransformer):
     return name_node
 
 
-class TypedefTransform(ast.NodeTransformer):
+class TypedefTransform(Pass):
   def __init__(self, typedefs: Dict[str, ast.AST]):
-    ast.NodeTransformer.__init__(self)
+    Pass.__init__(self)
     self.typedefs = typedefs
 
   def visit_Name(self, name_node: ast.Name):
@@ -971,11 +1586,27 @@ class TypedefTransform(ast.NodeTransformer):
     return name_node
 
 
-class CallStartEnd(ast.NodeTransformer):
-  def __init__(self, patt, range):
-    ast.NodeTransformer.__init__(self)
+# Replaces the sites of log_calls_start_end() with the calls they wrap.
+class StripStartEnd(ast.NodeTransformer):
+  def visit_IfExp(self, node):
+    plain = getattr(node, '_metap_plain', None)
+    if plain is not None:
+      return plain
+    return self.generic_visit(node)
+
+class CallStartEnd(RangedPass):
+  def __init__(self, patt, range, sites=None, timing=False,
+               log_durations=False):
+    RangedPass.__init__(self, range)
     self.patt = patt
-    self.range = range
+    self.sites = sites if sites is not None else Sites()
+    self.timing = timing or log_durations
+    self.log_durations = log_durations
+
+  def descends(self, node):
+    if isinstance(node, ast.Call) and hasattr(node, 'lineno'):
+      return in_range(node.lineno, self.range)
+    return RangedPass.descends(self, node)
 
   def visit_Call(self, call: ast.Call):
     # TODO: Add filename
@@ -989,30 +1620,64 @@ class CallStartEnd(ast.NodeTransformer):
     # function that used exec() with globals() and locals() but that didn't
     # work.
     
-    self.generic_visit(call)
+    # Note that the arguments have already been visited.
 
     e = ast.Expr(value=call)
     e_src = astor.to_source(e).strip()
     if self.patt is not None and not re.match(self.patt, e_src):
       return call
 
-    log = f'{lineno}:{astor.to_source(call.func).strip()}'
+    func_src = astor.to_source(call.func).strip()
+    log = f'{lineno}:{func_src}'
 
     started_log = f"metap: Started: {log}"
     finished_log = f"metap: Finished: {log}"
-    started_print = get_print_str(started_log)
-    finished_print = get_print_str(finished_log)
+    started_print = ast.Expr(value=self.sites.log_call(
+      {"name": "Started", "ln": lineno, "call": func_src}, started_log))
+    finished_print = ast.Expr(value=self.sites.log_call(
+      {"name": "Finished", "ln": lineno, "call": func_src}, finished_log))
 
+    if not self.timing:
+      new_call = ast.Call(
+        func=ast.Attribute(value=ast.Name(id="metap"), attr='log_start_end'),
+        args=[started_print, call, finished_print],
+        keywords=[]
+      )
+      return self.guard(new_call, call)
+
+    # The arguments are evaluated in order, so the timestamps are taken right
+    # before and right after the call, and don't include the logging.
+    now = ast.Call(
+      func=ast.Attribute(value=ast.Name(id="metap"), attr='now_ns'),
+      args=[],
+      keywords=[]
+    )
+    timer = self.sites.timer(log, self.log_durations)
     new_call = ast.Call(
-      func=ast.Attribute(value=ast.Name(id="metap"), attr='log_start_end'),
-      args=[started_print, call, finished_print],
+      func=ast.Attribute(value=ast.Name(id="metap"), attr='log_start_end_timed'),
+      args=[started_print, now, call, copy.deepcopy(now), finished_print,
+            timer],
       keywords=[]
     )
     # print(astor.dump_tree(new_call, indentation="  "))
     # print('******')
     # # print(astor.to_source(new_call, indent_with="  "))
     # print('--------------------------------------------')
-    return new_call
+    return self.guard(new_call, call)
+
+  # With the kill switch, `<new_call> if _metap_on else <call>`, so when it's
+  # off, there's no logging, no clock reading and no helper call. The call is
+  # evaluated once either way. In the else branch, the sites in the arguments
+  # are replaced by their calls too, so the output grows linearly, not
+  # exponentially, with how deeply the sites nest.
+  def guard(self, new_call, call):
+    if not self.sites.switch:
+      return new_call
+    plain = StripStartEnd().visit(copy.deepcopy(call))
+    res = ast.IfExp(test=ast.Name(id='_metap_on'), body=new_call,
+                    orelse=plain)
+    res._metap_plain = plain
+    return res
 
 # Expand:
 # - assert isinstance(a, b) to
@@ -1025,7 +1690,21 @@ class CallStartEnd(ast.NodeTransformer):
 #     print(a)
 #     print(b)
 #     assert False
-class ExpandAsserts(ast.NodeTransformer):
+# With `on_violation="record"`, a failed assert is recorded (see
+# violations.py) instead of failing.
+class ExpandAsserts(Pass):
+  def __init__(self, on_violation="assert"):
+    Pass.__init__(self)
+    self.on_violation = on_violation
+
+  # What a failed assert does, given the statements that print `values`.
+  def fail_body(self, ass, values, prints):
+    if self.on_violation == "record":
+      site = fmt_log_info({"name": "Assert", "ln": ass.lineno})
+      return [record_stmt(site, values)]
+    ass_f = ast.Assert(ast.Constant(value=False), msg=ass.msg)
+    return prints + [ass_f]
+
   def visit_Assert(self, ass: ast.Assert):
     if isinstance(ass.test, ast.Compare):
       cmp = ass.test
@@ -1054,8 +1733,8 @@ class ExpandAsserts(ast.NodeTransformer):
       assert new_op is not None
       new_test = ast.Compare(left=l_name, ops=[new_op],
                              comparators=[r_name])
-      ass_f = ast.Assert(ast.Constant(value=False), msg=ass.msg)
-      if_ = ast.If(test=new_test, body=[print_l, print_r, ass_f], orelse=[])
+      body = self.fail_body(ass, [l_name, r_name], [print_l, print_r])
+      if_ = ast.If(test=new_test, body=body, orelse=[])
       return [asgn_l, asgn_r, if_]
     elif isinstance(ass.test, ast.Call):
       call = ass.test
@@ -1073,7 +1752,6 @@ class ExpandAsserts(ast.NodeTransformer):
       asgn = ast.Assign(targets=[var_name], value=obj)
       print_obj = get_print(var_name)
       print_obj_ty = get_print(get_type_call(var_name))
-      ass_f = ast.Assert(ast.Constant(value=False), msg=ass.msg)
       new_isinstance = ast.Call(
         func=ast.Name(id="isinstance"),
         args=[var_name, ty],
@@ -1081,59 +1759,199 @@ class ExpandAsserts(ast.NodeTransformer):
       )
       new_test = ast.UnaryOp(op=ast.Not(), operand=new_isinstance)
       if_ = ast.If(test=new_test,
-                   body=[print_obj, print_obj_ty, ass_f],
+                   body=self.fail_body(ass, [var_name],
+                                       [print_obj, print_obj_ty]),
                    orelse=[])
       return [asgn, if_]
     # END IF #
     
     return ass
 
+def replace_directives(contents):
+  # TODO: This needs to be in the same place as the other array with
+  # directives.
+  directive_replacements = {
+    "@no_continue": "__metap_no_continue",
+    "@no_break": "__metap_no_break"
+  }
+  for old, new in directive_replacements.items():
+    contents = contents.replace(old, new)
+  ### END FOR ###
+  return contents
+
+# The transforms build ASTs that are good enough for astor to print but that
+# compile() rejects (e.g., no `ctx`, `or` as a BinOp, macros that expand to a
+# whole Module). Fix them up so that we can compile the AST directly.
+class Legalize(ast.NodeTransformer):
+  EXPR_CTX = (ast.Name, ast.Attribute, ast.Subscript, ast.Starred, ast.List,
+              ast.Tuple)
+
+  def store(self, target):
+    if not isinstance(target, self.EXPR_CTX):
+      return self.visit(target)
+    # Our generated code may use the same node both as a target and as a
+    # value, so we don't change the node in place.
+    new_target = copy.copy(target)
+    new_target.ctx = ast.Store()
+    if isinstance(new_target, (ast.Tuple, ast.List)):
+      new_target.elts = [self.store(elt) for elt in new_target.elts]
+    elif isinstance(new_target, ast.Starred):
+      new_target.value = self.store(new_target.value)
+    else:
+      # The subexpressions (e.g., `a` in `a.b = 1`) are loaded.
+      for field, value in ast.iter_fields(new_target):
+        if isinstance(value, ast.AST) and field != 'ctx':
+          setattr(new_target, field, self.visit(value))
+    return new_target
+
+  def generic_visit(self, node):
+    if isinstance(node, self.EXPR_CTX) and getattr(node, 'ctx', None) is None:
+      node.ctx = ast.Load()
+    node = ast.NodeTransformer.generic_visit(self, node)
+    for field, value in ast.iter_fields(node):
+      if not isinstance(value, list):
+        continue
+      if not any(isinstance(v, ast.Module) for v in value):
+        continue
+      new_value = []
+      for v in value:
+        if isinstance(v, ast.Module):
+          new_value.extend(v.body)
+        else:
+          new_value.append(v)
+      ### END FOR ###
+      setattr(node, field, new_value)
+    ### END FOR ###
+    return node
+
+  def visit_Assign(self, asgn: ast.Assign):
+    asgn.targets = [self.store(t) for t in asgn.targets]
+    asgn.value = self.visit(asgn.value)
+    return asgn
+
+  def visit_AugAssign(self, asgn: ast.AugAssign):
+    asgn.target = self.store(asgn.target)
+    asgn.value = self.visit(asgn.value)
+    return asgn
+
+  def visit_AnnAssign(self, asgn: ast.AnnAssign):
+    asgn.target = self.store(asgn.target)
+    asgn.annotation = self.visit(asgn.annotation)
+    if asgn.value is not None:
+      asgn.value = self.visit(asgn.value)
+    return asgn
+
+  def visit_For(self, for_):
+    for_.target = self.store(for_.target)
+    for_.iter = self.visit(for_.iter)
+    return self.generic_visit(for_)
+
+  visit_AsyncFor = visit_For
+
+  def visit_comprehension(self, comp: ast.comprehension):
+    comp.target = self.store(comp.target)
+    return self.generic_visit(comp)
+
+  def visit_withitem(self, item: ast.withitem):
+    if item.optional_vars is not None:
+      item.optional_vars = self.store(item.optional_vars)
+    return self.generic_visit(item)
+
+  # log_calls_start_end() passes print() statements as arguments.
+  def visit_Call(self, call: ast.Call):
+    call.args = [a.value if isinstance(a, ast.Expr) else a for a in call.args]
+    return self.generic_visit(call)
+
+  def visit_BinOp(self, binop: ast.BinOp):
+    self.generic_visit(binop)
+    if isinstance(binop.op, ast.boolop):
+      return ast.BoolOp(op=binop.op, values=[binop.left, binop.right])
+    if isinstance(binop.op, ast.cmpop):
+      return ast.Compare(left=binop.left, ops=[binop.op],
+                         comparators=[binop.right])
+    return binop
+
+  def visit_Subscript(self, sub: ast.Subscript):
+    self.generic_visit(sub)
+    if (sys.version_info < (3, 9) and
+        not isinstance(sub.slice, (ast.Index, ast.Slice, ast.ExtSlice))):
+      sub.slice = ast.Index(value=sub.slice)
+    return sub
+
 class MetaP:
-  def __init__(self, filename) -> None:
+  # If `source` is given, it is used instead of the contents of `filename`.
+  def __init__(self, filename, source=None) -> None:
     self.filename = filename
-    with open(filename, 'r') as fp:
-      contents = fp.read()
-
-    # TODO: This needs to be in the same place as the other array with
-    # directives.
-    directive_replacements = {
-      "@no_continue": "__metap_no_continue",
-      "@no_break": "__metap_no_break"
-    }
+    if source is None:
+      with open(filename, 'r') as fp:
+        contents = fp.read()
+    else:
+      contents = source
+
     # First replace the directives
-    for old, new in directive_replacements.items():
-      contents = contents.replace(old, new)
-    ### END FOR ###
+    contents = replace_directives(contents)
 
     self.ast = ast.parse(contents)
     
     self.log_se_called = False
 
-  def log_returns(self, range=[]):
-    walker = LogReturnWalker(range=range)
-    walker.walk(self.ast)
-
-  def log_breaks(self, range=[]):
-    transformer = LogBreakCont("Break", range)
-    transformer.visit(self.ast)
+    # The transforms are not applied immediately. They are queued and they all
+    # run fused, in a single traversal, in the order they were requested, when
+    # the output is needed (e.g., in dump()).
+    self.pass_manager = PassManager()
+    self.passes_run = False
+
+    # The log sites of the generated program.
+    self.sites = Sites()
+
+  def run_passes(self):
+    if self.pass_manager.pending():
+      self.passes_run = True
+    self.ast = self.pass_manager.run(self.ast)
+
+  # With `sample` (1-in-N if an int, a probability if a float) and/or
+  # `max_per_sec`, only some returns are logged (see sampling.py).
+  # `mode` is "log" or "count" (see counters.py).
+  def log_returns(self, range=[], sample=None, max_per_sec=None, mode="log"):
+    self.pass_manager.add(LogReturnWalker(range=range, sites=self.sites,
+                                          sample=sample,
+                                          max_per_sec=max_per_sec,
+                                          mode=mode))
+
+  def log_breaks(self, range=[], mode="log"):
+    self.pass_manager.add(LogBreakCont("Break", range, sites=self.sites,
+                                       mode=mode))
   
-  def log_continues(self, range=[]):
-    transformer = LogBreakCont("Continue", range)
-    transformer.visit(self.ast)
+  def log_continues(self, range=[], mode="log"):
+    self.pass_manager.add(LogBreakCont("Continue", range, sites=self.sites,
+                                       mode=mode))
   
-  def log_calls(self, range=[]):
-    transformer = LogCallSite(range=range)
-    transformer.visit(self.ast)
+  # `sample` and `max_per_sec` are like in log_returns().
+  def log_calls(self, range=[], sample=None, max_per_sec=None):
+    self.pass_manager.add(LogCallSite(range=range, sites=self.sites,
+                                      sample=sample, max_per_sec=max_per_sec))
   
   def log_func_defs(self, range=[], indent=False):
-    transformer = LogFuncDef(range=range, indent=indent)
-    transformer.visit(self.ast)
+    self.pass_manager.add(LogFuncDef(range=range, indent=indent,
+                                     sites=self.sites))
   
-  def log_ifs(self, range=[], indent=False):
-    transformer = LogIfs(range=range, indent=indent)
-    transformer.visit(self.ast)
+  def log_ifs(self, range=[], indent=False, mode="log"):
+    self.pass_manager.add(LogIfs(range=range, indent=indent, sites=self.sites,
+                                 mode=mode))
     
-  def dyn_typecheck(self, typedefs_path=None, skip_funcs: Optional[List[str]]=None):
+  # `container_check` and `container_k` say how the elements of containers are
+  # checked. With `debug_only`, `python -O` removes the checks. With `toggle`,
+  # they can be turned on and off at runtime, per module (see typecheck.py).
+  # With `on_violation="record"`, failed checks are recorded instead (see
+  # violations.py).
+  def dyn_typecheck(self, typedefs_path=None, skip_funcs: Optional[List[str]]=None,
+                    container_check="full", container_k=10, debug_only=False,
+                    toggle=False, on_violation="assert"):
+    typecheck.check_container_check(container_check, container_k)
+    violations.check_on_violation(on_violation)
+    check = (container_check, container_k)
+    if container_check == "full":
+      check = FULL_CHECK
     if typedefs_path is not None:
       with open(typedefs_path, 'r') as fp:
         tdef_ast = ast.parse(fp.read())
@@ -1141,20 +1959,32 @@ class MetaP:
       t = TypedefGather()
       t.visit(tdef_ast)
 
-      t2 = TypedefTransform(t.typedefs)
-      t2.visit(self.ast)
+      self.pass_manager.add(TypedefTransform(t.typedefs))
     # END IF #
-    t = DynTypecheck(skip_funcs)
-    t.visit(self.ast)
+    self.pass_manager.add(DynTypecheck(skip_funcs, self.sites, check,
+                                       debug_only, toggle, on_violation))
   
-  def log_calls_start_end(self, patt=None, range=[]):
+  # With `timing`, keep per-call-site statistics of the durations (see
+  # timing.py). With `log_durations`, also log every duration.
+  def log_calls_start_end(self, patt=None, range=[], timing=False,
+                          log_durations=False):
     self.log_se_called = True
-    t = CallStartEnd(patt=patt, range=range)
-    t.visit(self.ast)
-
-  def expand_asserts(self):
-    t = ExpandAsserts()
-    t.visit(self.ast)
+    self.pass_manager.add(CallStartEnd(patt=patt, range=range,
+                                       sites=self.sites, timing=timing,
+                                       log_durations=log_durations))
+
+  # With `on_violation="record"`, failed asserts are recorded instead (see
+  # violations.py).
+  def expand_asserts(self, on_violation="assert"):
+    violations.check_on_violation(on_violation)
+    self.pass_manager.add(ExpandAsserts(on_violation))
+
+  # `out` is where the folded stacks are written at exit (see profiler.py).
+  def profile_funcs(self, range=[], out=None):
+    module = os.path.splitext(os.path.basename(self.filename))[0]
+    self.pass_manager.add(ProfileFuncs(module, range=range))
+    if out is not None:
+      self.sites.profile_out = out
 
   # Handles anything that is required to be transformed for the code to run
   # (i.e., any code that uses metap features)
@@ -1163,23 +1993,83 @@ class MetaP:
     if macro_defs_path is not None:
       macro_defs_ast = macros_gen.gen_macros(macro_defs_path)
     # END IF #
-    transformer = NecessaryTransformer(macro_defs_ast)
-    transformer.visit(self.ast)
-
-  def dump(self, filename=None):
+    self.pass_manager.add(NecessaryTransformer(macro_defs_ast))
+
+  # The final program, with an import to metap on the top. If `sink` is given
+  # (a spec, see sink.py), the program starts by selecting it. If `trace` is
+  # given, the program writes a binary trace to this path and the site table
+  # is written next to it (see binary_trace.py). With `switch`, the log sites
+  # can be turned off at runtime (see switch.py).
+  def final_ast(self, import_metap=True, sink=None, trace=None, switch=False):
+    if trace is not None:
+      if self.passes_run and not self.sites.binary:
+        raise errors_warns.APIError("The trace mode must be selected the first time the program is generated.")
+      self.sites.binary = True
+    if switch:
+      if self.passes_run and not self.sites.switch:
+        raise errors_warns.APIError("The kill switch must be selected the first time the program is generated.")
+      self.sites.switch = True
+    self.run_passes()
+    prologue = []
+    if import_metap:
+      prologue = [ast.Import(names=[ast.alias(name="metap", asname=None)])]
+    if sink is not None:
+      sink_mod.check_spec(sink)
+      init = ast.Call(
+        func=ast.Attribute(value=ast.Name(id="metap"), attr='init_sink'),
+        args=[ast.Constant(value=sink)],
+        keywords=[]
+      )
+      prologue.append(ast.Expr(value=init))
+    if trace is not None:
+      digest = binary_trace.write_sites(trace, self.sites.table)
+      init = ast.Call(
+        func=ast.Attribute(value=ast.Name(id="metap"), attr='init_trace'),
+        args=[ast.Constant(value=trace), ast.Constant(value=digest.hex())],
+        keywords=[]
+      )
+      prologue.append(ast.Assign(targets=[ast.Name(id='_metap_trace')],
+                                 value=init))
+    prologue.extend(self.sites.prologue())
+    return ast.Module(body=prologue + self.ast.body, type_ignores=[])
+
+  # Compile the generated program straight to a code object, without going
+  # through the source. Line numbers point to the meta-program. `optimize` is
+  # as in compile() (by default, that of the interpreter).
+  def to_code(self, sink=None, trace=None, switch=False, optimize=-1):
+    t = self.final_ast(sink=sink, trace=trace, switch=switch)
+    prologue_len = len(t.body) - len(self.ast.body)
+    t = Legalize().visit(t)
+    ast.fix_missing_locations(t)
+    self.ast.body = t.body[prologue_len:]
+    return compile(t, self.filename, 'exec', optimize=optimize)
+
+  def exec(self, globals=None):
+    if globals is None:
+      globals = {'__name__': '__main__'}
+    exec(self.to_code(), globals)
+    return globals
+
+  # Write the generated program to `fp`, one top-level statement at a time.
+  # `emitter` is "astor", "unparse" or an emitter object (see emit.py).
+  # `sink` is a sink spec (see sink.py), and `trace` and `switch` are as in
+  # final_ast().
+  def write(self, fp, import_metap=True, emitter="astor", sink=None,
+            trace=None, switch=False):
+    emitter = emit.get_emitter(emitter, long_lines=self.log_se_called)
+    emit.write(self.final_ast(import_metap, sink, trace, switch), fp, emitter)
+
+  # The generated program, as source code.
+  def to_source(self, import_metap=True, emitter="astor", sink=None,
+                trace=None, switch=False):
+    out = io.StringIO()
+    self.write(out, import_metap, emitter, sink, trace, switch)
+    return out.getvalue()
+
+  def dump(self, filename=None, emitter="astor", sink=None, trace=None,
+           switch=False):
     if not filename:
       filename = self.filename.split('.')[0] + ".metap.py"
 
-    # Add an import to metap on the top
-    self.ast.body.insert(0, ast.Import(names=[ast.Name(id="metap")]))
-
-    maxline=79
-    if self.log_se_called:
-      # astor fails with all the craziness by log_calls_start_end(). To fix it,
-      # we allow too long lines. Note that this requires baziotis/astor version.
-      # The upstream astor doesn't allow to pass `maxline` to `to_source()`
-      maxline=10_000
-
     with open(filename, 'w') as fp:
-      src = astor.to_source(self.ast, indent_with=' ' * 2, maxline=maxline)
-      fp.write(src)
\ No newline at end of file
+      self.write(fp, emitter=emitter, sink=sink, trace=trace, switch=switch)
\ No newline at end of file
@@ -0,0 +1,157 @@
+import ast
+import itertools
+
+# A transform that can be fused with other transforms in a single traversal.
+#
+# Subclasses define `visit_<NodeType>(node)` hooks, like an
+# ast.NodeTransformer, with two differences:
+# - A hook must _not_ visit the children of the node. By the time it is called,
+#   the children have already been processed (post-order) by all the passes
+#   that descend into them.
+# - Like in a NodeTransformer, a hook returns the replacement, which can be the
+#   node itself, a new node, a list of nodes, or None.
+#
+# `descends()` and `holds()` control the traversal:
+# - If `descends(node)` is False, this pass does not visit the children of
+#   `node` (other passes are not affected).
+# - `holds(node)` returns the fields of `node` that this pass wants to see
+#   _before_ any later pass touches them. Later passes will visit these fields
+#   only after this pass's hook has run on `node`, so they see its output, as
+#   if the passes had been run one after the other.
+class Pass:
+  def descends(self, node):
+    return True
+
+  def holds(self, node):
+    return ()
+
+_run_ids = itertools.count()
+
+# Queues passes and runs them fused, in a single post-order traversal. The
+# passes are applied in the order they were added: at every node, the hook of
+# the first pass runs first, and anything it produces is processed only by the
+# passes after it.
+class PassManager:
+  def __init__(self):
+    self.passes = []
+
+  def add(self, pass_):
+    self.passes.append(pass_)
+
+  def pending(self):
+    return len(self.passes) != 0
+
+  def run(self, tree):
+    if not self.pending():
+      return tree
+    self.run_id = next(_run_ids)
+    self.hooks = [dict() for _ in self.passes]
+    res = self.visit(tree, list(range(len(self.passes))))
+    assert isinstance(res, ast.AST)
+    self.passes = []
+    return res
+
+  # The index of the last pass that has been applied to `node` (and so, to its
+  # whole subtree) during the current run. Whatever a pass produces should not
+  # be seen by the passes before it, so a node is never visited by any pass up
+  # to this index.
+  def applied(self, node):
+    mark = getattr(node, '_metap_applied', None)
+    if mark is None or mark[0] != self.run_id:
+      return -1
+    return mark[1]
+
+  def mark_applied(self, node, idx):
+    if self.applied(node) < idx:
+      node._metap_applied = (self.run_id, idx)
+
+  def hook(self, idx, node):
+    ty = type(node)
+    hooks = self.hooks[idx]
+    if ty not in hooks:
+      hooks[ty] = getattr(self.passes[idx], 'visit_' + ty.__name__, None)
+    return hooks[ty]
+
+  def visit(self, node, active):
+    applied = self.applied(node)
+    active = [i for i in active if i > applied]
+    if len(active) == 0:
+      return node
+
+    any_held = self.visit_fields(node, active)
+
+    for pos, idx in enumerate(active):
+      hook = self.hook(idx, node)
+      res = node if hook is None else hook(node)
+      roots = res if isinstance(res, list) else [res]
+      for r in roots:
+        if isinstance(r, ast.AST):
+          self.mark_applied(r, idx)
+      ### END FOR ###
+
+      rest = active[pos+1:]
+      if hook is None and not any_held:
+        continue
+      # The hook may have replaced or changed the node, so the rest of the
+      # passes have to visit whatever it produced. Already processed subtrees
+      # are skipped.
+      if len(rest) == 0:
+        return res
+      if res is None:
+        return None
+      if isinstance(res, list):
+        new_values = []
+        for r in res:
+          out = self.visit(r, rest) if isinstance(r, ast.AST) else r
+          if out is None:
+            continue
+          elif isinstance(out, list):
+            new_values.extend(out)
+          else:
+            new_values.append(out)
+        ### END FOR ###
+        return new_values
+      return self.visit(res, rest)
+    ### END FOR ###
+    return node
+
+  # Returns whether any of the passes holds a field of `node`.
+  def visit_fields(self, node, active):
+    passes = [self.passes[i] for i in active]
+    holds = [p.holds(node) for p in passes]
+    descends = [p.descends(node) for p in passes]
+    any_held = any(len(h) != 0 for h in holds)
+
+    for field, old_value in ast.iter_fields(node):
+      field_active = []
+      for idx, h, d in zip(active, holds, descends):
+        if field in h:
+          break
+        if d:
+          field_active.append(idx)
+      ### END FOR ###
+      if len(field_active) == 0:
+        continue
+
+      if isinstance(old_value, list):
+        new_values = []
+        for value in old_value:
+          if isinstance(value, ast.AST):
+            value = self.visit(value, field_active)
+            if value is None:
+              continue
+            elif not isinstance(value, ast.AST):
+              new_values.extend(value)
+              continue
+          new_values.append(value)
+        ### END FOR ###
+        old_value[:] = new_values
+      elif isinstance(old_value, ast.AST):
+        new_node = self.visit(old_value, field_active)
+        if new_node is None:
+          delattr(node, field)
+        else:
+          setattr(node, field, new_node)
+      # END IF #
+    ### END FOR ###
+    return any_held
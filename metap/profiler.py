@@ -0,0 +1,153 @@
+import atexit
+import os
+import threading
+import time
+
+from .sink import log
+
+# A function profiler (`mp.profile_funcs()`). Every selected function becomes:
+#
+#   def foo(x):
+#     _metap_start = metap.prof_enter('test_mp:foo')
+#     try:
+#       ...
+#     finally:
+#       metap.prof_exit(_metap_start)
+#
+# Every thread keeps an explicit stack of the profiled functions that are
+# running. Each frame is a node in a tree of call paths (e.g., main -> foo ->
+# bar), so entering and exiting a function takes constant time, and every node
+# keeps the total time spent in its calls. Everything else is computed from
+# this tree when we dump. The time spent in a path itself (i.e., exclusive) is
+# its total minus the totals of its children. Then:
+# - The folded stacks (`main;foo;bar 1234`), one line per call path with the
+#   exclusive time in microseconds, which is what flamegraph tools (e.g.,
+#   flamegraph.pl, speedscope) read.
+# - The calls, inclusive and exclusive time per function. Recursive calls are
+#   counted once in the inclusive time.
+#
+# At exit, the per-function statistics are logged and, if the program was
+# generated with an output path, the folded stacks are written there. The
+# METAP_PROFILE environment variable overrides this path. Functions that
+# don't return (generators) are not profiled, because their frames would not
+# be nested.
+
+class Node:
+  __slots__ = ('name', 'children', 'total_ns', 'calls')
+
+  def __init__(self, name):
+    self.name = name
+    self.children = dict()
+    self.total_ns = 0
+    self.calls = 0
+
+class ThreadState(threading.local):
+  def __init__(self):
+    self.root = Node(None)
+    # The root is always at the bottom.
+    self.stack = [self.root]
+    with _lock:
+      _roots.append(self.root)
+
+_lock = threading.Lock()
+_roots = []
+_state = ThreadState()
+_out_path = None
+
+### HELPERS called from the generated program ###
+
+def init_profile(path):
+  global _out_path
+  _out_path = os.environ.get('METAP_PROFILE', path)
+
+# Returns the start time, which is passed to prof_exit().
+def prof_enter(name, state=_state, now=time.perf_counter_ns):
+  stack = state.stack
+  children = stack[-1].children
+  node = children.get(name)
+  if node is None:
+    node = children[name] = Node(name)
+  stack.append(node)
+  return now()
+
+def prof_exit(start, state=_state, now=time.perf_counter_ns):
+  end = now()
+  node = state.stack.pop()
+  node.total_ns += end - start
+  node.calls += 1
+
+### END HELPERS ###
+
+# `active` are the functions in `path`, before `node`.
+def walk(node, path, folded, funcs, active):
+  fresh = node.name not in active
+  active.add(node.name)
+  self_ns = node.total_ns
+  for child in list(node.children.values()):
+    self_ns -= child.total_ns
+    walk(child, path + [child.name], folded, funcs, active)
+  ### END FOR ###
+  if fresh:
+    active.discard(node.name)
+
+  key = ";".join(path)
+  folded[key] = folded.get(key, 0) + self_ns
+  stats = funcs.setdefault(node.name, {"calls": 0, "inclusive": 0,
+                                       "exclusive": 0})
+  stats["calls"] += node.calls
+  stats["exclusive"] += self_ns
+  # Recursive calls are already included in the outer one.
+  if fresh:
+    stats["inclusive"] += node.total_ns
+
+# Returns (folded, funcs): the exclusive time (in ns) of every call path (as a
+# `;`-separated string) and the stats of every function.
+def get_profile():
+  folded = dict()
+  funcs = dict()
+  with _lock:
+    roots = list(_roots)
+  for root in roots:
+    for child in list(root.children.values()):
+      walk(child, [child.name], folded, funcs, set())
+  ### END FOR ###
+  return folded, funcs
+
+# Write the folded stacks to `out` (a file object).
+def write_folded(out):
+  folded, _ = get_profile()
+  for key, ns in sorted(folded.items()):
+    us = ns // 1000
+    if us != 0:
+      out.write(f"{key} {us}\n")
+  ### END FOR ###
+
+def dump_profile(out=None):
+  _, funcs = get_profile()
+  width = max([len(name) for name in funcs] + [8])
+  lines = ["metap: Profile:",
+           f"{'function':<{width}}{'calls':>10}{'inclusive':>14}{'exclusive':>14}"]
+  for name, s in sorted(funcs.items(), key=lambda nf: -nf[1]["inclusive"]):
+    lines.append(f"{name:<{width}}{s['calls']:>10}"
+                 f"{s['inclusive'] / 1e6:>12.3f}ms{s['exclusive'] / 1e6:>12.3f}ms")
+  ### END FOR ###
+  if out is None:
+    for line in lines:
+      log(line)
+  else:
+    out.write("\n".join(lines) + "\n")
+
+def reset_profile():
+  with _lock:
+    for root in _roots:
+      root.children.clear()
+  ### END FOR ###
+
+@atexit.register
+def report_profile():
+  if not any(len(root.children) != 0 for root in _roots):
+    return
+  dump_profile()
+  if _out_path is not None:
+    with open(_out_path, 'w') as fp:
+      write_folded(fp)
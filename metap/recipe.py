@@ -0,0 +1,55 @@
+import hashlib
+from typing import Any, Dict, List, Tuple, Union
+
+from . import errors_warns
+from .version import __version__
+
+# A recipe is the list of MetaP transforms to apply, in order, e.g.:
+#   ["compile", ("dyn_typecheck", {"skip_funcs": ["foo"]})]
+# Each entry is either the name of a MetaP method or a (name, kwargs) pair.
+
+Recipe = List[Union[str, Tuple[str, Dict[str, Any]]]]
+
+TRANSFORMS = ["log_returns", "log_breaks", "log_continues", "log_calls",
+              "log_calls_start_end", "log_func_defs", "log_ifs",
+              "dyn_typecheck", "expand_asserts", "profile_funcs", "compile"]
+
+# Arguments that name files that the output depends on.
+PATH_ARGS = ["macro_defs_path", "typedefs_path"]
+
+def normalize_recipe(recipe: Recipe) -> List[Tuple[str, Dict[str, Any]]]:
+  res = []
+  for step in recipe:
+    if isinstance(step, str):
+      name, kwargs = step, {}
+    elif isinstance(step, (tuple, list)) and len(step) == 2:
+      name, kwargs = step
+    else:
+      raise errors_warns.APIError(f"Invalid recipe step: {step!r}. Expected a transform name or a (name, kwargs) pair.")
+    if name not in TRANSFORMS:
+      raise errors_warns.APIError(f"Unknown transform in recipe: {name}")
+    res.append((name, dict(kwargs)))
+  ### END FOR ###
+  return res
+
+def apply_recipe(mp, recipe: Recipe):
+  for name, kwargs in normalize_recipe(recipe):
+    getattr(mp, name)(**kwargs)
+
+def file_digest(path):
+  with open(path, 'rb') as fp:
+    return hashlib.sha256(fp.read()).hexdigest()
+
+# Everything, except for the source, that determines the output: the steps and
+# their arguments, the contents of any file they read, and metap's version.
+def recipe_key(recipe: Recipe) -> bytes:
+  parts = [__version__]
+  for name, kwargs in normalize_recipe(recipe):
+    parts.append(name)
+    for arg in sorted(kwargs):
+      parts.append(f"{arg}={kwargs[arg]!r}")
+      if arg in PATH_ARGS and kwargs[arg] is not None:
+        parts.append(file_digest(kwargs[arg]))
+    ### END FOR ###
+  ### END FOR ###
+  return "\n".join(parts).encode()
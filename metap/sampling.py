@@ -0,0 +1,98 @@
+import atexit
+import random
+import time
+
+from . import errors_warns
+from .sink import log
+
+# Sampling and rate limiting of log sites. A site with a sampler passes it to
+# its helper (e.g., `metap.log_ret(e, log_info, sampler)`), which logs only if
+# the sampler says so. The samplers of a generated module are created once, at
+# the top of the module:
+#
+#   _metap_samplers = metap.make_samplers([[10, None], [None, 100]])
+#
+# A sampler is configured with:
+# - `sample`: Either an int N, to log 1 every N executions, or a float in
+#   (0, 1], to log with this probability.
+# - `max_per_sec`: Log at most that many times per second.
+#
+# The number of dropped logs is reported at exit.
+
+class Sampler:
+  __slots__ = ('every', 'prob', 'max_per_sec', 'count', 'left', 'window_end',
+               'total', 'dropped')
+
+  def __init__(self, sample=None, max_per_sec=None):
+    self.every = None
+    self.prob = None
+    if isinstance(sample, int):
+      self.every = sample
+    elif isinstance(sample, float):
+      self.prob = sample
+    self.max_per_sec = max_per_sec
+    # Log the first execution.
+    self.count = 0
+    self.left = 0
+    self.window_end = 0.0
+    self.total = 0
+    self.dropped = 0
+
+  def __call__(self):
+    self.total += 1
+    if self.every is not None:
+      count = self.count
+      self.count = count + 1 if count + 1 < self.every else 0
+      if count != 0:
+        self.dropped += 1
+        return False
+    elif self.prob is not None and random.random() >= self.prob:
+      self.dropped += 1
+      return False
+    if self.max_per_sec is not None:
+      now = time.monotonic()
+      if now >= self.window_end:
+        self.window_end = now + 1.0
+        self.left = self.max_per_sec
+      if self.left == 0:
+        self.dropped += 1
+        return False
+      self.left -= 1
+    return True
+
+def check_config(sample, max_per_sec):
+  if sample is not None:
+    if isinstance(sample, bool) or not isinstance(sample, (int, float)):
+      raise errors_warns.APIError(f"sample must be an int or a float, not {sample!r}.")
+    if isinstance(sample, int) and sample < 1:
+      raise errors_warns.APIError(f"sample must be at least 1, not {sample}.")
+    if isinstance(sample, float) and not 0 < sample <= 1:
+      raise errors_warns.APIError(f"sample must be in (0, 1], not {sample}.")
+  if max_per_sec is not None:
+    if (isinstance(max_per_sec, bool) or not isinstance(max_per_sec, int) or
+        max_per_sec < 1):
+      raise errors_warns.APIError(f"max_per_sec must be a positive int, not {max_per_sec!r}.")
+
+_samplers = []
+
+### HELPERS called from the generated program ###
+
+# `configs` is a list of [sample, max_per_sec].
+def make_samplers(configs):
+  res = [Sampler(sample, max_per_sec) for sample, max_per_sec in configs]
+  _samplers.extend(res)
+  return res
+
+### END HELPERS ###
+
+# Returns (dropped, total) over all the samplers.
+def sampling_stats():
+  dropped = sum(s.dropped for s in _samplers)
+  total = sum(s.total for s in _samplers)
+  return dropped, total
+
+@atexit.register
+def report_dropped():
+  dropped, total = sampling_stats()
+  if dropped != 0:
+    log(f"metap: Sampling dropped {dropped} of {total} logs.")
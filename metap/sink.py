@@ -0,0 +1,408 @@
+import atexit
+import collections
+import json
+import os
+import queue
+import signal
+import sys
+import threading
+import time
+
+from . import errors_warns
+
+# Where the logs of the generated program go. All the logging that metap
+# generates goes through the current sink. A sink is chosen with a spec:
+# - "print" (default): Write every record to stdout immediately, like print().
+#   The logs interleave correctly with the program's own output.
+# - "stdout", "stderr", "file:<path>": Collect the records in memory and write
+#   them in bulk, when the buffer fills up, on flush() and at exit.
+# - "thread:<target>": Like the above (e.g., "thread:file:trace.log"), but the
+#   writes happen in a background thread.
+# - "chrome:<path>": Write the records as Chrome trace events, which can be
+#   viewed on a timeline (e.g., in Perfetto or chrome://tracing).
+# - "dedup:<spec>": Like <spec> (e.g., "dedup:file:trace.log"), but a run of
+#   identical records becomes one record, e.g., "metap::Continue(ln=12) x 1000".
+#
+# The spec can be given at dump time (e.g., `mp.dump(sink="stderr")`), in
+# which case the generated program selects it with init_sink(), or with the
+# METAP_SINK environment variable, which takes precedence. The sink of
+# METAP_SINK is created on first use (see EnvSink), so importing metap doesn't
+# fail on a bad spec or, e.g., truncate a trace file.
+
+DEFAULT_CAPACITY = 4096
+
+class Sink:
+  def write(self, text: str):
+    raise NotImplementedError
+
+  def flush(self):
+    pass
+
+  def close(self):
+    self.flush()
+
+  # Close from a signal handler, which may have interrupted a write() or a
+  # flush() of this sink. Whatever would wait for that to finish is skipped.
+  def close_on_signal(self):
+    self.close()
+
+class PrintSink(Sink):
+  def write(self, text: str):
+    sys.stdout.write(text)
+
+# `open_stream` returns the stream to write to. It's called at flush time, so
+# that, e.g., a redirected sys.stdout is respected.
+#
+# write() appends to a deque without the lock, and take() pops from the other
+# end, so a record that is appended while we take is left for the next flush.
+# The lock serializes the flushes, so that the batches are written in order and
+# one at a time.
+class BufferedSink(Sink):
+  def __init__(self, open_stream, capacity=DEFAULT_CAPACITY):
+    self.open_stream = open_stream
+    self.capacity = capacity
+    self.buf = collections.deque()
+    self.lock = threading.Lock()
+
+  def write(self, text: str):
+    self.buf.append(text)
+    if len(self.buf) >= self.capacity:
+      self.flush()
+
+  # Called with the lock held.
+  def take(self):
+    popleft = self.buf.popleft
+    return "".join([popleft() for _ in range(len(self.buf))])
+
+  def write_out(self, data: str):
+    stream = self.open_stream()
+    stream.write(data)
+    stream.flush()
+
+  # Called with the lock held.
+  def send(self, data: str):
+    self.write_out(data)
+
+  def flush(self):
+    with self.lock:
+      data = self.take()
+      if len(data) != 0:
+        self.send(data)
+    # END WITH #
+
+  def close_on_signal(self):
+    if not self.lock.acquire(blocking=False):
+      return
+    try:
+      data = self.take()
+      if len(data) != 0:
+        self.write_out(data)
+    finally:
+      self.lock.release()
+
+# The batches are written by a background thread, so the program only pays for
+# appending to the buffer.
+class ThreadedSink(BufferedSink):
+  def __init__(self, open_stream, capacity=DEFAULT_CAPACITY):
+    BufferedSink.__init__(self, open_stream, capacity)
+    self.queue = queue.Queue()
+    self.thread = threading.Thread(target=self.run, name="metap-sink",
+                                   daemon=True)
+    self.thread.start()
+
+  def run(self):
+    while True:
+      data = self.queue.get()
+      if data is None:
+        break
+      self.write_out(data)
+    ### END WHILE ###
+
+  def send(self, data: str):
+    self.queue.put(data)
+
+  def close(self):
+    self.flush()
+    self.queue.put(None)
+    self.thread.join()
+
+class FileOpener:
+  def __init__(self, path):
+    self.path = path
+    self.fp = None
+
+  def __call__(self):
+    if self.fp is None:
+      self.fp = open(self.path, 'w')
+    return self.fp
+
+# Records in the Chrome trace-event format (the JSON array one). The
+# Started/Finished records of log_calls_start_end() become begin/end ("B"/"E")
+# events, and any other record (e.g., the FuncDef of log_func_defs()) an
+# instant ("i") event, with the time it was written, the process id and the
+# thread id. The events are buffered (in a deque, like BufferedSink, so that
+# write() doesn't need the lock) and the parts of a record (e.g., the
+# indentation) are joined per thread. Every event after the first starts with
+# a comma and the closing `]` is written on close, which viewers don't require,
+# so the file is usable even if the program crashes. On SIGTERM and SIGHUP,
+# the events are flushed before the program dies.
+class ChromeTraceSink(Sink):
+  STARTED = "metap: Started: "
+  FINISHED = "metap: Finished: "
+
+  def __init__(self, path, capacity=DEFAULT_CAPACITY):
+    self.fp = open(path, 'w')
+    self.fp.write("[\n")
+    self.fp.flush()
+    self.capacity = capacity
+    self.events = collections.deque()
+    self.first = True
+    # `partial` is what the thread has written from its current record (e.g.,
+    # the indentation).
+    self.local = threading.local()
+    self.pid = os.getpid()
+    self.lock = threading.Lock()
+    flush_on_signals()
+
+  def event(self, record: str, ts_ns):
+    ev = {"ph": "i", "s": "t", "name": record}
+    if record.startswith(self.STARTED):
+      ev = {"ph": "B", "name": record[len(self.STARTED):]}
+    elif record.startswith(self.FINISHED):
+      ev = {"ph": "E", "name": record[len(self.FINISHED):]}
+    elif record.startswith("metap::"):
+      ev["name"] = record[len("metap::"):]
+    ev["ts"] = ts_ns / 1000
+    ev["pid"] = self.pid
+    ev["tid"] = threading.get_native_id()
+    return json.dumps(ev)
+
+  def write(self, text: str, now=time.perf_counter_ns):
+    partial = getattr(self.local, 'partial', None)
+    if not text.endswith("\n"):
+      if partial is None:
+        self.local.partial = partial = []
+      partial.append(text)
+      return
+    if partial:
+      text = "".join(partial) + text
+      partial.clear()
+    self.events.append(self.event(text[:-1].strip(), now()))
+    if len(self.events) >= self.capacity:
+      self.flush()
+
+  def flush(self):
+    with self.lock:
+      self.write_events()
+
+  # Called with the lock held. The events appended while we're here are left
+  # for the next flush.
+  def write_events(self):
+    popleft = self.events.popleft
+    events = [popleft() for _ in range(len(self.events))]
+    if len(events) == 0 or self.fp.closed:
+      return
+    data = ",\n".join(events)
+    if not self.first:
+      data = ",\n" + data
+    self.first = False
+    self.fp.write(data)
+    self.fp.flush()
+
+  def close(self):
+    self.flush()
+    with self.lock:
+      self.finish()
+
+  def finish(self):
+    if not self.fp.closed:
+      self.fp.write("\n]\n")
+      self.fp.close()
+
+  # If the signal interrupted a flush(), we can't wait for it to release the
+  # lock. The file then lacks the last events and the closing `]`.
+  def close_on_signal(self):
+    if not self.lock.acquire(blocking=False):
+      return
+    try:
+      self.write_events()
+      self.finish()
+    finally:
+      self.lock.release()
+
+# Collapses consecutive identical records into one, which is followed by the
+# number of times it was logged (if more than 1), e.g.:
+#   metap::Continue(ln=12) x 1000000
+# The collapsed records go to `inner`. A run ends when a different record is
+# logged or on flush().
+#
+# The records of all the threads go through the lock, so a run may contain
+# the records of many threads, and the parts of a record (e.g., the
+# indentation) are joined in the order they are written.
+class DedupSink(Sink):
+  def __init__(self, inner: Sink):
+    self.inner = inner
+    self.last = None
+    self.count = 0
+    # What has been written from the current record (e.g., the indentation).
+    self.partial = []
+    self.lock = threading.Lock()
+
+  # Called with the lock held.
+  def emit(self):
+    if self.last is None:
+      return
+    if self.count == 1:
+      self.inner.write(self.last)
+    else:
+      self.inner.write(f"{self.last[:-1]} x {self.count}\n")
+    self.last = None
+
+  def write(self, text: str):
+    with self.lock:
+      if not text.endswith("\n"):
+        self.partial.append(text)
+        return
+      if len(self.partial) != 0:
+        text = "".join(self.partial) + text
+        self.partial = []
+      if text == self.last:
+        self.count += 1
+        return
+      self.emit()
+      self.last = text
+      self.count = 1
+    # END WITH #
+
+  def flush(self):
+    with self.lock:
+      self.emit()
+    self.inner.flush()
+
+  def close(self):
+    with self.lock:
+      self.emit()
+    self.inner.close()
+
+  def close_on_signal(self):
+    if self.lock.acquire(blocking=False):
+      try:
+        self.emit()
+      finally:
+        self.lock.release()
+    # END IF #
+    self.inner.close_on_signal()
+
+_signals_installed = False
+
+# Close the sink before a signal that would otherwise kill the program
+# without running the atexit handlers, and then let the signal kill it.
+# Handlers that the program has installed are left alone.
+def flush_on_signals():
+  global _signals_installed
+  if _signals_installed or threading.current_thread() is not threading.main_thread():
+    return
+  _signals_installed = True
+  for name in ["SIGTERM", "SIGHUP"]:
+    signum = getattr(signal, name, None)
+    if signum is None or signal.getsignal(signum) != signal.SIG_DFL:
+      continue
+    signal.signal(signum, close_and_die)
+  ### END FOR ###
+
+def close_and_die(signum, frame):
+  try:
+    _sink.close_on_signal()
+  finally:
+    signal.signal(signum, signal.SIG_DFL)
+    os.kill(os.getpid(), signum)
+
+def stream_opener(target: str):
+  if target == "stdout":
+    return lambda: sys.stdout
+  if target == "stderr":
+    return lambda: sys.stderr
+  if target.startswith("file:") and len(target) > len("file:"):
+    return FileOpener(target[len("file:"):])
+  raise errors_warns.APIError(f"Invalid sink: {target}. Expected print, "
+                              "stdout, stderr, file:<path>, chrome:<path>, "
+                              "thread:<target> or dedup:<spec>.")
+
+def chrome_path(spec: str):
+  if spec.startswith("chrome:") and len(spec) > len("chrome:"):
+    return spec[len("chrome:"):]
+  return None
+
+def from_spec(spec: str) -> Sink:
+  if spec.startswith("dedup:"):
+    return DedupSink(from_spec(spec[len("dedup:"):]))
+  if spec == "print":
+    return PrintSink()
+  if chrome_path(spec) is not None:
+    return ChromeTraceSink(chrome_path(spec))
+  if spec.startswith("thread:"):
+    return ThreadedSink(stream_opener(spec[len("thread:"):]))
+  return BufferedSink(stream_opener(spec))
+
+# Check the spec without creating the sink (e.g., at dump time).
+def check_spec(spec: str):
+  if spec.startswith("dedup:"):
+    return check_spec(spec[len("dedup:"):])
+  if spec == "print" or chrome_path(spec) is not None:
+    return
+  if spec.startswith("thread:"):
+    spec = spec[len("thread:"):]
+  stream_opener(spec)
+
+# Stands for the sink of METAP_SINK until something is logged, at which point
+# it creates it and replaces itself with it. Until then, there's nothing to
+# flush or close.
+class EnvSink(Sink):
+  def __init__(self):
+    self.lock = threading.Lock()
+
+  def build(self) -> Sink:
+    global _sink
+    with self.lock:
+      # Another thread may have built it or the sink may have been set.
+      if _sink is self:
+        _sink = from_spec(os.environ.get('METAP_SINK', 'print'))
+      return _sink
+    # END WITH #
+
+  def write(self, text: str):
+    self.build().write(text)
+
+  def close_on_signal(self):
+    pass
+
+_sink = EnvSink()
+
+def get_sink() -> Sink:
+  if isinstance(_sink, EnvSink):
+    return _sink.build()
+  return _sink
+
+# `sink` is a spec or a Sink object.
+def set_sink(sink):
+  global _sink
+  if isinstance(sink, str):
+    sink = from_spec(sink)
+  old = _sink
+  _sink = sink
+  old.close()
+
+# Called by the generated program when a sink was given at dump time.
+def init_sink(spec: str):
+  if 'METAP_SINK' not in os.environ:
+    set_sink(spec)
+
+def flush():
+  _sink.flush()
+
+### HELPERS called from the generated program ###
+
+def log(msg: str):
+  _sink.write(msg + "\n")
+
+atexit.register(lambda: _sink.close())
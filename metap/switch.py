@@ -0,0 +1,39 @@
+import os
+
+# The runtime kill switch. A program generated with `switch=True` (e.g.,
+# `mp.dump(switch=True)`) guards every log site with the global `_metap_on`:
+#
+#   if _metap_on:
+#     metap.log('metap::Break(ln=5)')
+#
+# So, when the switch is off, a site costs a global load and a branch. All the
+# generated modules share the same state, which is set with enable() and
+# disable(). It starts from the METAP_ENABLED environment variable (on by
+# default; "0" turns it off).
+
+_enabled = os.environ.get('METAP_ENABLED', '1') != '0'
+# The globals of the generated modules.
+_modules = []
+
+def is_enabled() -> bool:
+  return _enabled
+
+def set_enabled(on: bool):
+  global _enabled
+  _enabled = on
+  for globs in _modules:
+    globs['_metap_on'] = on
+  ### END FOR ###
+
+def enable():
+  set_enabled(True)
+
+def disable():
+  set_enabled(False)
+
+### HELPERS called from the generated program ###
+
+# Returns the current state, which the generated module keeps in `_metap_on`.
+def register_switch(globs):
+  _modules.append(globs)
+  return _enabled
@@ -0,0 +1,144 @@
+import atexit
+import time
+from array import array
+
+from .sink import log
+
+# Per-site latencies of log_calls_start_end(timing=True). The generated code
+# takes a timestamp right before and right after every call it logs, and
+# passes both to log_start_end_timed(), which adds the duration to the Timer of
+# the site. The timers of a generated module are created once, at the top:
+#
+#   _metap_timers = metap.make_timers([['3:json.dump', False]])
+#
+# A timer keeps the count, the total, the min and the max, and a histogram
+# with fixed buckets, from which we get the percentiles: 4 buckets per power
+# of 2, so a percentile is off by at most ~12%. The statistics of all the
+# sites are logged at exit, or on demand with dump_timings(). The updates are
+# not atomic, so with threads some durations may be lost.
+
+now_ns = time.perf_counter_ns
+
+SUB_BITS = 2
+SUB = 1 << SUB_BITS
+NUM_BUCKETS = 64 * SUB
+
+def bucket(ns):
+  exp = ns.bit_length() - 1
+  if exp < SUB_BITS:
+    return max(ns, 0)
+  return (exp << SUB_BITS) | ((ns >> (exp - SUB_BITS)) & (SUB - 1))
+
+# The middle of the durations that fall in bucket `idx`.
+def bucket_value(idx):
+  if idx < SUB:
+    return idx
+  exp, sub = idx >> SUB_BITS, idx & (SUB - 1)
+  low = (SUB | sub) << (exp - SUB_BITS)
+  return low + (1 << (exp - SUB_BITS)) // 2
+
+class Timer:
+  __slots__ = ('name', 'log_durations', 'count', 'total', 'min', 'max',
+               'buckets')
+
+  def __init__(self, name, log_durations=False):
+    self.name = name
+    self.log_durations = log_durations
+    self.count = 0
+    self.total = 0
+    self.min = None
+    self.max = 0
+    self.buckets = array('Q', bytes(8 * NUM_BUCKETS))
+
+  def add(self, ns):
+    self.count += 1
+    self.total += ns
+    if self.min is None or ns < self.min:
+      self.min = ns
+    if ns > self.max:
+      self.max = ns
+    self.buckets[bucket(ns)] += 1
+    if self.log_durations:
+      log(f"metap: Took {fmt_ns(ns)}: {self.name}")
+
+  # `q` in [0, 1].
+  def percentile(self, q):
+    if self.count == 0:
+      return None
+    rank = max(1, round(q * self.count))
+    seen = 0
+    for idx, n in enumerate(self.buckets):
+      seen += n
+      if seen >= rank:
+        # The real value is within the min and the max.
+        return min(max(bucket_value(idx), self.min), self.max)
+    ### END FOR ###
+    return self.max
+
+  def stats(self):
+    return {
+      "count": self.count,
+      "total": self.total,
+      "min": self.min,
+      "max": self.max,
+      "p50": self.percentile(0.5),
+      "p99": self.percentile(0.99),
+    }
+
+def fmt_ns(ns):
+  if ns is None:
+    return "-"
+  if ns < 1_000:
+    return f"{ns}ns"
+  if ns < 1_000_000:
+    return f"{ns / 1_000:.1f}us"
+  if ns < 1_000_000_000:
+    return f"{ns / 1_000_000:.2f}ms"
+  return f"{ns / 1_000_000_000:.2f}s"
+
+_timers = []
+
+### HELPERS called from the generated program ###
+
+# `configs` is a list of [name, log_durations].
+def make_timers(configs):
+  res = [Timer(name, log_durations) for name, log_durations in configs]
+  _timers.extend(res)
+  return res
+
+def log_start_end_timed(started_print, start, val, end, finished_print, timer):
+  assert not started_print
+  assert not finished_print
+  timer.add(end - start)
+  return val
+
+### END HELPERS ###
+
+# A list of (name, stats) for all the sites that ran, slowest (in total)
+# first.
+def get_timings():
+  res = [(t.name, t.stats()) for t in _timers if t.count != 0]
+  res.sort(key=lambda ns: -ns[1]["total"])
+  return res
+
+# Write the statistics to `out`, or log them, if `out` is None.
+def dump_timings(out=None):
+  cols = ["count", "total", "min", "p50", "p99", "max"]
+  timings = get_timings()
+  width = max([len(name) for name, _ in timings] + [4])
+  lines = ["metap: Timings:",
+           f"{'site':<{width}}" + "".join(f"{c:>10}" for c in cols)]
+  for name, stats in timings:
+    vals = [str(stats["count"])] + [fmt_ns(stats[c]) for c in cols[1:]]
+    lines.append(f"{name:<{width}}" + "".join(f"{v:>10}" for v in vals))
+  ### END FOR ###
+  if out is None:
+    for line in lines:
+      log(line)
+  else:
+    out.write("\n".join(lines) + "\n")
+
+@atexit.register
+def report_timings():
+  if any(t.count != 0 for t in _timers):
+    dump_timings()
@@ -0,0 +1,162 @@
+import itertools
+import os
+import random
+import threading
+import weakref
+
+from . import errors_warns
+
+# How dyn_typecheck() checks the elements of containers (`List[...]` and
+# `Dict[...]`), with `mp.dyn_typecheck(container_check=...)`:
+# - "full" (default): Check all the elements, stopping at the first one that
+#   has the wrong type.
+# - "first_k": Check only the first `container_k` elements.
+# - "random_k": Check `container_k` random elements. The generator is seeded
+#   (with METAP_TYPECHECK_SEED, or 0), so runs are repeatable. A dict can't
+#   be indexed, so for dicts this is the same as "first_k".
+# - "once_per_object": Check all the elements, but only the first time an
+#   object is checked. The objects that passed are remembered by id(), the
+#   last MAX_CHECKED of them. A list or dict can't have weak references, so we
+#   keep them alive, which ensures that their id() is not reused. To bound the
+#   memory that this holds on to, we keep only the last ones that have up to
+#   MAX_RETAINED elements in total (METAP_TYPECHECK_RETAIN overrides it), and
+#   a bigger one is checked every time. Other objects are forgotten when they
+#   die. Changes to an object after it has been checked are not caught.
+#
+# The last three make the cost of a check independent of the size of the
+# container.
+#
+# The checks can also be turned off:
+# - With `debug_only`, every check is guarded by `__debug__`, so `python -O`
+#   removes it when it compiles the module.
+# - With `toggle`, every check is guarded by the global `_metap_typecheck` of
+#   the generated module:
+#
+#     _metap_typecheck = metap.register_typecheck(globals())
+#     ...
+#     if _metap_typecheck and not isinstance(x, int):
+#
+#   which is set per module, with enable_typechecks() and disable_typechecks().
+#   It starts from the METAP_TYPECHECK environment variable: "1" (default)
+#   turns on the checks of all modules, "0" turns them off, and a
+#   comma-separated list of module names turns on only those modules.
+
+CONTAINER_CHECKS = ["full", "first_k", "random_k", "once_per_object"]
+MAX_CHECKED = 1024
+MAX_RETAINED = int(os.environ.get('METAP_TYPECHECK_RETAIN', str(1 << 20)))
+
+def check_container_check(container_check, container_k):
+  if container_check not in CONTAINER_CHECKS:
+    raise errors_warns.APIError(f"Unknown container_check: {container_check!r}. "
+                                f"Expected one of: {', '.join(CONTAINER_CHECKS)}.")
+  if (isinstance(container_k, bool) or not isinstance(container_k, int) or
+      container_k < 1):
+    raise errors_warns.APIError(f"container_k must be a positive int, not {container_k!r}.")
+
+_rng = random.Random(int(os.environ.get('METAP_TYPECHECK_SEED', '0')))
+
+def seed_typecheck(seed):
+  _rng.seed(seed)
+
+# id() -> the object or a weak reference to it, oldest first.
+_checked = dict()
+# id() -> the number of elements (plus one) of the objects that we keep alive.
+_retained = dict()
+_retained_total = 0
+_lock = threading.Lock()
+
+# Called when a weakly referenced object dies, maybe while we hold the lock.
+def forget(key):
+  _checked.pop(key, None)
+
+def parse_env(value):
+  if value in ("0", "1"):
+    return value == "1", dict()
+  return False, {name: True for name in value.split(",") if name != ""}
+
+# The state of the modules that don't have their own, and of those that do.
+_default, _overrides = parse_env(os.environ.get('METAP_TYPECHECK', '1'))
+# The globals of the generated modules.
+_modules = []
+
+def typechecks_enabled(module=None) -> bool:
+  if module is None:
+    return _default
+  return _overrides.get(module, _default)
+
+# If `module` (a module name) is None, for all the modules.
+def set_typechecks(on: bool, module=None):
+  global _default
+  if module is None:
+    _default = on
+    _overrides.clear()
+  else:
+    _overrides[module] = on
+  for globs in _modules:
+    if module is None or globs.get('__name__') == module:
+      globs['_metap_typecheck'] = on
+  ### END FOR ###
+
+def enable_typechecks(module=None):
+  set_typechecks(True, module)
+
+def disable_typechecks(module=None):
+  set_typechecks(False, module)
+
+### HELPERS called from the generated program ###
+
+# Returns the state of the module, which it keeps in `_metap_typecheck`.
+def register_typecheck(globs):
+  _modules.append(globs)
+  return typechecks_enabled(globs.get('__name__'))
+
+first_k = itertools.islice
+
+def random_k(xs, k):
+  if not isinstance(xs, list):
+    return itertools.islice(xs, k)
+  if len(xs) <= k:
+    return xs
+  return [xs[i] for i in _rng.sample(range(len(xs)), k)]
+
+def was_checked(obj):
+  return id(obj) in _checked
+
+# Remember `obj` if it passed the check (`ok`), and return `ok`.
+def mark_checked(obj, ok):
+  global _retained_total
+  if not ok:
+    return ok
+  key = id(obj)
+  try:
+    entry = weakref.ref(obj, lambda _: forget(key))
+    size = 0
+  except TypeError:
+    entry = obj
+    size = len(obj) + 1
+    if size > MAX_RETAINED:
+      return ok
+  with _lock:
+    _retained_total -= _retained.pop(key, 0)
+    # Make it the newest.
+    _checked.pop(key, None)
+    _checked[key] = entry
+    if size != 0:
+      _retained[key] = size
+      _retained_total += size
+    while len(_checked) > MAX_CHECKED or _retained_total > MAX_RETAINED:
+      oldest = next(iter(_checked))
+      _checked.pop(oldest, None)
+      _retained_total -= _retained.pop(oldest, 0)
+    ### END WHILE ###
+  # END WITH #
+  return ok
+
+### END HELPERS ###
+
+def reset_checked():
+  global _retained_total
+  with _lock:
+    _checked.clear()
+    _retained.clear()
+    _retained_total = 0
@@ -0,0 +1,163 @@
+import atexit
+import collections
+import itertools
+import json
+import os
+import reprlib
+import threading
+import time
+
+from . import errors_warns
+from .sink import log
+
+# The record mode of the checks (e.g., `mp.dyn_typecheck(on_violation="record")`
+# or `mp.expand_asserts(on_violation="record")`). Instead of printing the
+# values and failing an assert, a failed check records a violation and the
+# program continues:
+#
+#   if not isinstance(x, int):
+#     metap.record_violation('metap::TypeCheck(ln=3,var=x)', x)
+#
+# A violation is a (time, site, type names, repr) tuple, where the repr is
+# truncated, so that a huge value costs little. The last MAX_VIOLATIONS of them
+# are kept in memory (METAP_VIOLATIONS_MAX overrides it), and every site also
+# counts its violations. The counts are logged at exit, or on demand with
+# dump_violations(). The counts are not atomic, so with threads some may be
+# lost.
+#
+# With flush_violations(), or the METAP_VIOLATIONS environment variable (a
+# path), the violations are also appended to a file, as JSON lines, by a
+# background thread every METAP_VIOLATIONS_INTERVAL seconds (default: 10), and
+# at exit. Violations that are pushed out of memory before that are lost, but
+# still counted.
+
+ON_VIOLATION = ["assert", "record"]
+MAX_VIOLATIONS = int(os.environ.get('METAP_VIOLATIONS_MAX', '1024'))
+DEFAULT_INTERVAL = 10.0
+
+def check_on_violation(on_violation):
+  if on_violation not in ON_VIOLATION:
+    raise errors_warns.APIError(f"Unknown on_violation: {on_violation!r}. "
+                                f"Expected one of: {', '.join(ON_VIOLATION)}.")
+
+_repr = reprlib.Repr()
+_repr.maxstring = 80
+_repr.maxother = 80
+MAX_REPR = 200
+
+def short_repr(value):
+  try:
+    res = _repr.repr(value)
+  except Exception as e:
+    res = f"<repr failed: {type(e).__name__}>"
+  if len(res) > MAX_REPR:
+    res = res[:MAX_REPR - 3] + "..."
+  return res
+
+# Every violation gets a sequence number, so that the flusher knows which ones
+# it hasn't written.
+_seq = itertools.count()
+_violations = collections.deque(maxlen=MAX_VIOLATIONS)
+_counts = collections.Counter()
+
+### HELPERS called from the generated program ###
+
+# `values` are the values that failed the check (e.g., the two sides of a
+# failed `==`).
+def record_violation(site, *values):
+  types = ", ".join(type(v).__name__ for v in values)
+  reprs = ", ".join(short_repr(v) for v in values)
+  _violations.append((next(_seq), time.time(), site, types, reprs))
+  _counts[site] += 1
+
+### END HELPERS ###
+
+# The violations in memory, oldest first, as (time, site, type names, repr).
+def get_violations():
+  return [v[1:] for v in list(_violations)]
+
+# A list of (site, count), most frequent first.
+def violation_counts():
+  return sorted(_counts.items(), key=lambda sc: (-sc[1], sc[0]))
+
+def reset_violations():
+  _violations.clear()
+  _counts.clear()
+
+# Write the counts per site, and the last violation of each one, to `out`, or
+# log them, if `out` is None.
+def dump_violations(out=None):
+  last = dict()
+  for _, _, site, types, reprs in list(_violations):
+    last[site] = (types, reprs)
+  lines = ["metap: Violations:"]
+  for site, count in violation_counts():
+    line = f"{count:>12} {site}"
+    if site in last:
+      types, reprs = last[site]
+      line += f" last: {reprs} ({types})"
+    lines.append(line)
+  ### END FOR ###
+  if out is None:
+    for line in lines:
+      log(line)
+  else:
+    out.write("\n".join(lines) + "\n")
+
+class Flusher:
+  def __init__(self, path, interval):
+    self.path = path
+    self.interval = interval
+    # The sequence number of the next violation to write.
+    self.next_seq = 0
+    self.lock = threading.Lock()
+    self.stopped = threading.Event()
+    self.thread = threading.Thread(target=self.run, name="metap-violations",
+                                   daemon=True)
+    self.thread.start()
+
+  def run(self):
+    while not self.stopped.wait(self.interval):
+      self.flush()
+    ### END WHILE ###
+
+  def flush(self):
+    with self.lock:
+      new = [v for v in list(_violations) if v[0] >= self.next_seq]
+      if len(new) == 0:
+        return
+      self.next_seq = new[-1][0] + 1
+      with open(self.path, 'a') as fp:
+        for _, ts, site, types, reprs in new:
+          fp.write(json.dumps({"time": ts, "site": site, "types": types,
+                               "repr": reprs}) + "\n")
+      # END WITH #
+    # END WITH #
+
+  def stop(self):
+    self.stopped.set()
+    self.thread.join()
+    self.flush()
+
+_flusher = None
+
+# Append the violations to `path` every `interval` seconds, and at exit.
+def flush_violations(path, interval=DEFAULT_INTERVAL):
+  global _flusher
+  if _flusher is not None:
+    _flusher.stop()
+  _flusher = Flusher(path, interval)
+
+if 'METAP_VIOLATIONS' in os.environ:
+  flush_violations(os.environ['METAP_VIOLATIONS'],
+                   float(os.environ.get('METAP_VIOLATIONS_INTERVAL',
+                                        DEFAULT_INTERVAL)))
+
+@atexit.register
+def report_violations():
+  global _flusher
+  if _flusher is not None:
+    _flusher.stop()
+    _flusher = None
+  if len(_counts) != 0:
+    dump_violations()
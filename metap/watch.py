@@ -0,0 +1,223 @@
+import ast
+import hashlib
+import io
+import os
+import sys
+import time
+import traceback
+
+from . import emit
+from . import metap as metap_
+from . import sink as sink_mod
+from .emit import flatten_stmts
+from .recipe import Recipe, PATH_ARGS, normalize_recipe, recipe_key
+
+# Watch mode: regenerate the output whenever the meta-program changes, but only
+# re-transform the top-level definitions (or statements) whose source changed.
+# The output of the rest is reused and everything is spliced together. E.g.:
+#
+#   metap.Watcher("test_mp.py", ["compile", "log_returns"]).run()
+#
+# A top-level statement is transformed on its own, so anything that is
+# numbered per-file (e.g., the temporaries of dyn_typecheck()) is numbered per
+# statement instead. The exception is what the module sets up at the top (e.g.,
+# `_metap_counts`): the sites of every statement are numbered after those of
+# the statements before it and the module has a single prologue, which is
+# built from the sites of all the statements (see Sites.fork()). A
+# statement's output is reused only if its source, its first line and the
+# number of sites before it are the same, because the logs include line
+# numbers.
+
+class Segment:
+  def __init__(self, first, last, text):
+    self.first = first
+    self.last = last
+    self.text = text
+
+# Split the source into the (line ranges of) top-level statements. Statements
+# that share a line (e.g., `a = 1; b = 2`) go in the same segment.
+def split_segments(source: str):
+  tree = ast.parse(metap_.replace_directives(source))
+  lines = source.splitlines(keepends=True)
+  spans = []
+  for stmt in tree.body:
+    first = min([stmt.lineno] + [d.lineno for d in
+                                 getattr(stmt, 'decorator_list', [])])
+    last = stmt.end_lineno
+    if len(spans) != 0 and first <= spans[-1][1]:
+      spans[-1][1] = max(spans[-1][1], last)
+    else:
+      spans.append([first, last])
+  ### END FOR ###
+  return [Segment(first, last, "".join(lines[first-1:last]))
+          for first, last in spans]
+
+# `first` and `last` are the first and last printed statements, which decide
+# what goes between this and the segments around it. `sites` are the sites of
+# the segment, forked from those of the segments before it, when they had
+# `offsets`.
+class SegmentOutput:
+  def __init__(self, text, first, last, sites=None, offsets=None,
+               long_lines=False):
+    self.text = text
+    self.first = first
+    self.last = last
+    self.sites = sites
+    self.offsets = offsets
+    self.long_lines = long_lines
+
+def stmts_output(stmts, emitter, **kwargs):
+  stmts = flatten_stmts(stmts)
+  if len(stmts) == 0:
+    return SegmentOutput("", None, None, **kwargs)
+  out = io.StringIO()
+  emit.write(ast.Module(body=stmts, type_ignores=[]), out, emitter)
+  return SegmentOutput(out.getvalue(), stmts[0], stmts[-1], **kwargs)
+
+# Join the outputs of the segments the same way `emitter` would print them as a
+# single module.
+def splice(outputs, emitter):
+  res = []
+  prev = None
+  for out in outputs:
+    if len(out.text) == 0:
+      continue
+    if prev is not None:
+      res.append(emitter.sep(prev.last, out.first))
+    res.append(out.text)
+    prev = out
+  ### END FOR ###
+  return "".join(res)
+
+# `emitter` and `sink` are as in MetaP.dump().
+class Watcher:
+  def __init__(self, filename, recipe: Recipe, out_filename=None,
+               emitter="astor", sink=None):
+    self.filename = filename
+    self.recipe = normalize_recipe(recipe)
+    if out_filename is None:
+      out_filename = filename.split('.')[0] + ".metap.py"
+    self.out_filename = out_filename
+    # Fail early if they're wrong.
+    emit.get_emitter(emitter)
+    if sink is not None:
+      sink_mod.check_spec(sink)
+    self.emitter = emitter
+    self.sink = sink
+
+    self.deps = [filename]
+    for _, kwargs in self.recipe:
+      for arg in PATH_ARGS:
+        if kwargs.get(arg) is not None:
+          self.deps.append(kwargs[arg])
+    ### END FOR ###
+
+    self.mtimes = None
+    self.digest = None
+    # Segment key -> SegmentOutput, for the segments of the last build.
+    self.outputs = dict()
+    self.transformed = 0
+    self.reused = 0
+
+  def segment_key(self, seg: Segment, rkey: bytes, offsets):
+    h = hashlib.sha256(rkey)
+    h.update(f"\0{seg.first}\0{offsets}\0".encode())
+    h.update(seg.text.encode())
+    return h.digest()
+
+  # `sites` are the sites of the segments before it.
+  def transform_segment(self, seg: Segment, sites) -> SegmentOutput:
+    mp = metap_.MetaP(filename=self.filename, source=seg.text)
+    mp.sites = sites.fork()
+    ast.increment_lineno(mp.ast, seg.first - 1)
+    for name, kwargs in self.recipe:
+      getattr(mp, name)(**kwargs)
+    mp.run_passes()
+    emitter = emit.get_emitter(self.emitter, long_lines=mp.log_se_called)
+    return stmts_output(mp.ast.body, emitter, sites=mp.sites,
+                        offsets=sites.offsets(), long_lines=mp.log_se_called)
+
+  def build(self, source: str, rkey: bytes):
+    outputs = dict()
+    ordered = []
+    sites = metap_.Sites()
+    long_lines = False
+    self.transformed = 0
+    self.reused = 0
+    for seg in split_segments(source):
+      key = self.segment_key(seg, rkey, sites.offsets())
+      out = outputs.get(key)
+      if out is None:
+        out = self.outputs.get(key)
+      if out is None:
+        out = self.transform_segment(seg, sites)
+        self.transformed += 1
+      else:
+        self.reused += 1
+      sites.join(out.sites, out.offsets)
+      long_lines = long_lines or out.long_lines
+      outputs[key] = out
+      ordered.append(out)
+    ### END FOR ###
+    # Forget the segments that no longer exist.
+    self.outputs = outputs
+    # The same as MetaP.final_ast().
+    prologue = [ast.Import(names=[ast.alias(name="metap", asname=None)])]
+    if self.sink is not None:
+      init = ast.Call(
+        func=ast.Attribute(value=ast.Name(id="metap"), attr='init_sink'),
+        args=[ast.Constant(value=self.sink)],
+        keywords=[]
+      )
+      prologue.append(ast.Expr(value=init))
+    prologue.extend(sites.prologue())
+    emitter = emit.get_emitter(self.emitter, long_lines=long_lines)
+    return splice([stmts_output(prologue, emitter)] + ordered, emitter)
+
+  def current_mtimes(self):
+    res = []
+    for dep in self.deps:
+      try:
+        res.append(os.stat(dep).st_mtime_ns)
+      except OSError:
+        res.append(None)
+    ### END FOR ###
+    return res
+
+  # Rebuild if anything changed. Returns whether it rebuilt.
+  def check(self):
+    mtimes = self.current_mtimes()
+    if mtimes == self.mtimes:
+      return False
+    self.mtimes = mtimes
+
+    with open(self.filename, 'rb') as fp:
+      raw = fp.read()
+    rkey = recipe_key(self.recipe)
+    digest = hashlib.sha256(rkey + b"\0" + raw).digest()
+    # E.g., the file was saved but not changed.
+    if digest == self.digest:
+      return False
+
+    src = self.build(raw.decode('utf-8'), rkey)
+    with open(self.out_filename, 'w') as fp:
+      fp.write(src)
+    self.digest = digest
+    return True
+
+  def run(self, interval=0.5, out=sys.stdout):
+    while True:
+      start = time.perf_counter()
+      try:
+        rebuilt = self.check()
+      except Exception as e:
+        # Keep watching. The user will probably fix it in the next save.
+        err = "".join(traceback.format_exception_only(type(e), e)).strip()
+        print(f"metap: {self.filename}: {err}", file=out)
+        rebuilt = False
+      if rebuilt:
+        secs = time.perf_counter() - start
+        print(f"metap: {self.out_filename}: {self.transformed} transformed, "
+              f"{self.reused} reused, {secs:.3f}s", file=out)
+      time.sleep(interval)
+    ### END WHILE ###
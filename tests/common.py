@@ -1,6 +1,17 @@
 import os
 import metap
 
+# Write the meta-program `src` to `test_mp.py` in `tmp_path` (the directory of
+# pytest's `tmp_path` fixture).
+def write_src(tmp_path, src):
+  path = tmp_path / "test_mp.py"
+  path.write_text(src)
+  return path
+
+# A MetaP for the meta-program `src` (see write_src()).
+def tmp_mp(tmp_path, src):
+  return metap.MetaP(filename=str(write_src(tmp_path, src)))
+
 def boiler(src, mid_func):
   fname = 'test.py'
   with open(fname, 'w') as fp:
@@ -0,0 +1,172 @@
+import pytest
+import io
+import os
+import metap
+import metap.binary_trace as binary_trace
+import common
+
+SRC = """
+def foo(x):
+  if x:
+    return bar(x)
+  else:
+    return 2
+
+def bar(x):
+  for i in range(x):
+    if i == 1:
+      continue
+    if i == 2:
+      break
+  return x
+
+for i in range(3):
+  foo(i)
+"""
+
+def setup(mp):
+  mp.log_calls()
+  mp.log_func_defs()
+  mp.log_ifs()
+  mp.log_returns()
+  mp.log_breaks()
+  mp.log_continues()
+
+@pytest.fixture
+def src(tmp_path):
+  return common.write_src(tmp_path, SRC)
+
+def text_logs(src, capsys):
+  mp = metap.MetaP(filename=str(src))
+  setup(mp)
+  exec(mp.to_code(), {})
+  return capsys.readouterr().out
+
+def run_traced(src, trace_path):
+  mp = metap.MetaP(filename=str(src))
+  setup(mp)
+  exec(mp.to_code(trace=str(trace_path)), {})
+  metap.flush_trace()
+
+def test_decode(src, tmp_path, capsys):
+  expected = text_logs(src, capsys)
+
+  trace_path = tmp_path / "run.trace"
+  run_traced(src, trace_path)
+  # Nothing is logged as text.
+  assert capsys.readouterr().out == ""
+  assert os.path.exists(str(trace_path) + ".sites.json")
+
+  out = io.StringIO()
+  metap.decode_trace(str(trace_path), out=out)
+  assert out.getvalue() == expected
+  n_records = len(expected.splitlines())
+  assert os.path.getsize(trace_path) == \
+    len(binary_trace.MAGIC) + binary_trace.DIGEST_LEN + \
+    n_records * binary_trace.RECORD.size
+
+def test_records(src, tmp_path):
+  trace_path = tmp_path / "run.trace"
+  run_traced(src, trace_path)
+  records = list(binary_trace.read_records(str(trace_path)))
+  times = [ts for _, ts, _ in records]
+  assert times == sorted(times)
+  assert len(set(tid for _, _, tid in records)) == 1
+
+def test_partial_record(src, tmp_path):
+  trace_path = tmp_path / "run.trace"
+  run_traced(src, trace_path)
+  n = len(list(binary_trace.read_records(str(trace_path))))
+  with open(trace_path, 'ab') as fp:
+    fp.write(b"\0" * 5)
+  assert len(list(binary_trace.read_records(str(trace_path)))) == n
+
+def test_wrong_sites(src, tmp_path):
+  trace_path = tmp_path / "run.trace"
+  run_traced(src, trace_path)
+  sites = tmp_path / "other.json"
+  sites.write_text("[]")
+  with pytest.raises(metap.errors_warns.APIError):
+    metap.decode_trace(str(trace_path), out=io.StringIO(), sites=str(sites))
+
+def test_late_trace(src, tmp_path):
+  mp = metap.MetaP(filename=str(src))
+  setup(mp)
+  mp.to_source()
+  with pytest.raises(metap.errors_warns.APIError):
+    mp.to_source(trace=str(tmp_path / "run.trace"))
+
+THREADS_SRC = """
+import threading
+
+# Keep all the threads alive together, so that their ids are different.
+barrier = threading.Barrier(4)
+
+def work(n):
+  barrier.wait()
+  for i in range(n):
+    if i % 2:
+      continue
+  return n
+
+ts = [threading.Thread(target=work, args=(1000,)) for _ in range(4)]
+for t in ts:
+  t.start()
+for t in ts:
+  t.join()
+"""
+
+def test_threads(tmp_path):
+  mp = common.tmp_mp(tmp_path, THREADS_SRC)
+  mp.log_continues()
+  mp.log_returns()
+  trace_path = tmp_path / "run.trace"
+  exec(mp.to_code(trace=str(trace_path)), {})
+  metap.flush_trace()
+
+  records = list(binary_trace.read_records(str(trace_path)))
+  assert len(records) == 4 * (500 + 1)
+  assert len(set(tid for _, _, tid in records)) == 4
+
+def test_two_modules(tmp_path, capsys):
+  srcs = {
+    "mod_a": """
+def foo(x):
+  if x:
+    return 1
+  return 2
+""",
+    "mod_b": """
+def bar(x):
+  for i in range(x):
+    if i == 1:
+      break
+  return x
+""",
+  }
+  expected = dict()
+  funcs = dict()
+  for name, src in srcs.items():
+    path = tmp_path / f"{name}.py"
+    path.write_text(src)
+    mp = metap.MetaP(filename=str(path))
+    setup(mp)
+    globs = {}
+    exec(mp.to_code(), globs)
+    globs['foo' if name == "mod_a" else 'bar'](3)
+    expected[name] = capsys.readouterr().out
+    mp = metap.MetaP(filename=str(path))
+    setup(mp)
+    globs = {}
+    exec(mp.to_code(trace=str(tmp_path / f"{name}.trace")), globs)
+    funcs[name] = globs['foo' if name == "mod_a" else 'bar']
+  ### END FOR ###
+  # Both modules are initialized before either runs.
+  funcs["mod_a"](3)
+  funcs["mod_b"](3)
+  metap.flush_trace()
+  for name in srcs:
+    out = io.StringIO()
+    metap.decode_trace(str(tmp_path / f"{name}.trace"), out=out)
+    assert out.getvalue() == expected[name]
+  ### END FOR ###
@@ -0,0 +1,113 @@
+import pytest
+import os
+import sys
+import types
+import metap
+import metap.cache as cache_mod
+import common
+
+SRC = """
+def foo():
+  return 2
+
+x = foo()
+"""
+
+MACROS = """
+def _ret_two(x):
+  stmt : NODE = {
+return 2
+}
+  return stmt
+"""
+
+@pytest.fixture
+def env(tmp_path):
+  src = common.write_src(tmp_path, SRC)
+  cache = metap.TransformCache(directory=str(tmp_path / "cache"))
+  return src, cache
+
+def forbid_transform(monkeypatch):
+  def fail(*args, **kwargs):
+    assert False
+  monkeypatch.setattr(cache_mod.TransformCache, "transform", fail)
+
+def test_source_hit(env, monkeypatch):
+  src, cache = env
+  recipe = ["log_returns"]
+
+  mp = metap.MetaP(filename=str(src))
+  mp.log_returns()
+  expected = mp.to_source()
+
+  assert cache.source(str(src), recipe) == expected
+  forbid_transform(monkeypatch)
+  assert cache.source(str(src), recipe) == expected
+
+def test_code_hit(env, monkeypatch):
+  src, cache = env
+  recipe = ["log_returns"]
+  cache.code(str(src), recipe)
+  forbid_transform(monkeypatch)
+  globs = {}
+  exec(cache.code(str(src), recipe), globs)
+  assert globs['x'] == 2
+
+# The code compiled without -O is not used with -O.
+def test_code_optimize(env, monkeypatch):
+  src, cache = env
+  cache.code(str(src), ["log_returns"])
+  monkeypatch.setattr(sys, "flags", types.SimpleNamespace(optimize=1))
+  forbid_transform(monkeypatch)
+  with pytest.raises(AssertionError):
+    cache.code(str(src), ["log_returns"])
+
+def test_key(env, tmp_path):
+  src, cache = env
+  source = src.read_bytes()
+  k = cache.key(source, ["log_returns"])
+  assert k == cache.key(source, [("log_returns", {})])
+  assert k != cache.key(source + b"\n", ["log_returns"])
+  assert k != cache.key(source, [("log_returns", {"range": [3]})])
+  assert k != cache.key(source, ["log_returns", "log_calls"])
+  assert k != cache.key(source, ["log_calls", "log_returns"])
+
+  # The contents of the macro file are part of the key.
+  macros = tmp_path / "macro_defs.py"
+  macros.write_text(MACROS)
+  recipe = [("compile", {"macro_defs_path": str(macros)})]
+  k1 = cache.key(source, recipe)
+  macros.write_text(MACROS.replace("return 2", "return 3"))
+  assert k1 != cache.key(source, recipe)
+
+def test_eviction(env, tmp_path):
+  src, cache = env
+  cache.put("aa" + "0" * 62, "py", b"x" * 100)
+  os.utime(cache.entry_path("aa" + "0" * 62, "py"), (1, 1))
+  cache.put("bb" + "0" * 62, "py", b"x" * 100)
+  os.utime(cache.entry_path("bb" + "0" * 62, "py"), (2, 2))
+  assert cache.get("aa" + "0" * 62, "py") is not None
+  assert cache.size() == 200
+
+  # `aa` was just used, so `bb` goes first.
+  cache.max_size = 250
+  cache.put("cc" + "0" * 62, "py", b"x" * 100)
+  assert cache.get("bb" + "0" * 62, "py") is None
+  assert cache.get("aa" + "0" * 62, "py") is not None
+  assert cache.get("cc" + "0" * 62, "py") is not None
+
+# A put doesn't scan the cache until it's full.
+def test_put_no_scan(env, monkeypatch):
+  src, cache = env
+  cache.max_size = 1000
+  scans = []
+  entries = cache.entries
+  monkeypatch.setattr(cache, "entries", lambda: scans.append(1) or entries())
+  for i in range(9):
+    cache.put(f"{i:02}" + "0" * 62, "py", b"x" * 100)
+  assert len(scans) == 1
+  # Full: evict down to 900 bytes.
+  cache.put("10" + "0" * 62, "py", b"x" * 200)
+  assert len(scans) == 2
+  assert cache.size() <= 900
+  assert cache.total == cache.size()
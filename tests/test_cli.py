@@ -0,0 +1,68 @@
+import pytest
+import io
+import metap.cli as cli
+
+GOOD = """
+def foo():
+  return 2
+"""
+
+BAD = """
+def foo(:
+"""
+
+@pytest.fixture
+def src_tree(tmp_path):
+  src = tmp_path / "src"
+  (src / "pkg").mkdir(parents=True)
+  (src / "a.py").write_text(GOOD)
+  (src / "pkg" / "b.py").write_text(GOOD)
+  (src / "pkg" / "bad.py").write_text(BAD)
+  (src / "notes.txt").write_text("not python")
+  return src
+
+def test_batch(src_tree, tmp_path):
+  out_dir = tmp_path / "out"
+  out = io.StringIO()
+  results = cli.run_batch(str(src_tree), str(out_dir), ["log_returns"],
+                          jobs=2, out=out)
+
+  assert sorted(str(rel) for rel in results) == ["a.py", "pkg/b.py", "pkg/bad.py"]
+  assert (out_dir / "a.py").read_text() == \
+    "import metap\n\n\ndef foo():\n  return metap.log_ret(2, 'metap::Return(ln=3)')\n"
+  assert (out_dir / "pkg" / "b.py").exists()
+  assert not (out_dir / "pkg" / "bad.py").exists()
+
+  _, err = results[[rel for rel in results if rel.name == "bad.py"][0]]
+  assert "SyntaxError" in err
+  report = out.getvalue()
+  assert "FAIL" in report and "bad.py" in report
+  assert "2 succeeded, 1 failed" in report
+
+def test_main(src_tree, tmp_path, capsys):
+  out_dir = tmp_path / "out"
+  ret = cli.main([str(src_tree), str(out_dir), "-g", "*.py",
+                  "-t", "compile", "-t", 'log_returns:{"range": [[1, 2]]}',
+                  "--cache-dir", str(tmp_path / "cache")])
+  assert ret == 0
+  assert (out_dir / "a.py").read_text() == \
+    "import metap\n\n\ndef foo():\n  return 2\n"
+  assert not (out_dir / "pkg").exists()
+
+def test_bad_step(src_tree, tmp_path):
+  with pytest.raises(SystemExit):
+    cli.main([str(src_tree), str(tmp_path / "out"), "-t", "compile:[1]"])
+
+def test_emitter(src_tree, tmp_path):
+  out_dir = tmp_path / "out"
+  ret = cli.main([str(src_tree), str(out_dir), "-g", "*.py",
+                  "-t", "log_returns", "-e", "unparse"])
+  assert ret == 0
+  assert (out_dir / "a.py").read_text() == \
+    "import metap\n\ndef foo():\n  return metap.log_ret(2, 'metap::Return(ln=3)')\n"
+
+@pytest.mark.parametrize("flags", [["--cache-dir", "cache"], ["-j", "2"]])
+def test_watch_rejects(src_tree, tmp_path, flags):
+  with pytest.raises(SystemExit):
+    cli.main([str(src_tree / "a.py"), str(tmp_path / "a.py"), "-t", "compile",
+              "--watch"] + flags)
@@ -0,0 +1,84 @@
+import io
+import pytest
+import metap
+import metap.counters as counters
+import common
+
+SRC = """
+def foo(x):
+  for i in range(x):
+    if i % 2 == 0:
+      continue
+    if i == 5:
+      break
+  return x
+
+for j in range(10):
+  foo(j)
+"""
+
+# The counters of the tests are forgotten, so that they are not reported at
+# exit.
+@pytest.fixture(autouse=True)
+def reset(monkeypatch):
+  monkeypatch.setattr(counters, "_groups", [])
+
+def gen(tmp_path):
+  return common.tmp_mp(tmp_path, SRC)
+
+def test_source(tmp_path):
+  mp = gen(tmp_path)
+  mp.log_breaks(mode="count")
+  mp.log_returns(mode="count")
+  assert mp.to_source() == """import metap
+_metap_counts = metap.make_counters(['metap::Break(ln=7)',
+    'metap::Return(ln=8)'])
+
+
+def foo(x):
+  for i in range(x):
+    if i % 2 == 0:
+      continue
+    if i == 5:
+      _metap_counts[0] += 1
+      break
+  _metap_counts[1] += 1
+  return x
+
+
+for j in range(10):
+  foo(j)
+"""
+
+def test_counts(tmp_path, capsys):
+  mp = gen(tmp_path)
+  mp.log_ifs(mode="count")
+  mp.log_continues(mode="count")
+  mp.log_breaks(mode="count")
+  mp.log_returns(mode="count")
+  exec(mp.to_code(), {})
+  assert capsys.readouterr().out == ""
+
+  counts = dict(metap.get_counts())
+  assert counts == {
+    'metap::If(ln=4)': 21,
+    'metap::Continue(ln=5)': 21,
+    'metap::If(ln=6)': 4,
+    'metap::Break(ln=7)': 4,
+    'metap::Return(ln=8)': 10,
+  }
+
+  out = io.StringIO()
+  metap.dump_counts(out)
+  lines = out.getvalue().splitlines()
+  assert lines[0] == "metap: Counts:"
+  assert lines[-1].split() == ['4', 'metap::If(ln=6)']
+
+def test_bad_mode(tmp_path):
+  mp = gen(tmp_path)
+  with pytest.raises(metap.errors_warns.APIError):
+    mp.log_ifs(mode="counts")
+  with pytest.raises(metap.errors_warns.APIError):
+    mp.log_returns(mode="count", sample=10)
+  with pytest.raises(metap.errors_warns.APIError):
+    mp.log_ifs(mode="count", indent=True)
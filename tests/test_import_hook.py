@@ -0,0 +1,99 @@
+import pytest
+import os
+import subprocess
+import sys
+import metap
+import metap.import_hook as import_hook
+
+MOD = """
+line = "# test"
+if _cvar(line.startswith('# '), hlvl, 1):
+  x = hlvl
+
+def foo(s: str):
+  return s
+"""
+
+@pytest.fixture
+def hook_env(tmp_path, monkeypatch):
+  pkg = tmp_path / "hookpkg"
+  pkg.mkdir()
+  (pkg / "__init__.py").write_text("")
+  (pkg / "mod.py").write_text(MOD)
+  monkeypatch.syspath_prepend(str(tmp_path))
+  monkeypatch.setattr(sys, "dont_write_bytecode", False)
+  finders = []
+  def install(recipe):
+    finder = metap.install_import_hook(recipe, ["hookpkg.*"])
+    finders.append(finder)
+    return finder
+  yield pkg, install
+  for finder in finders:
+    metap.uninstall_import_hook(finder)
+  for name in ["hookpkg", "hookpkg.mod"]:
+    sys.modules.pop(name, None)
+
+def test_import_transforms(hook_env):
+  pkg, install = hook_env
+  install(["compile", "dyn_typecheck"])
+
+  import hookpkg.mod as mod
+  assert mod.x == 1
+  assert mod.foo("a") == "a"
+  with pytest.raises(AssertionError):
+    mod.foo(2)
+
+  assert os.path.exists(import_hook.cache_path(str(pkg / "mod.py")))
+
+def test_import_cache(hook_env, monkeypatch):
+  pkg, install = hook_env
+  finder = install(["compile"])
+
+  import hookpkg.mod
+  del sys.modules["hookpkg.mod"]
+
+  # Unchanged source and recipe: no transformation.
+  def fail(*args, **kwargs):
+    assert False
+  monkeypatch.setattr(import_hook, "apply_recipe", fail)
+  import hookpkg.mod as mod
+  assert mod.x == 1
+  del sys.modules["hookpkg.mod"]
+
+  # A different recipe misses the cache.
+  metap.uninstall_import_hook(finder)
+  install(["compile", "dyn_typecheck"])
+  with pytest.raises(AssertionError):
+    import hookpkg.mod
+
+def test_bad_recipe():
+  with pytest.raises(metap.errors_warns.APIError):
+    metap.install_import_hook(["not_a_transform"], ["*"])
+
+# The code cached without -O is not used with -O, where the checks of
+# `debug_only` are removed.
+def test_import_optimize(tmp_path):
+  pkg = tmp_path / "hookpkg"
+  pkg.mkdir()
+  (pkg / "__init__.py").write_text("")
+  (pkg / "mod.py").write_text(MOD)
+  root = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+  code = ("import metap\n"
+          "metap.install_import_hook(['compile', ('dyn_typecheck', {'debug_only': True})], ['hookpkg.*'])\n"
+          "import hookpkg.mod as mod\n"
+          "try:\n"
+          "  mod.foo(2)\n"
+          "  print('unchecked')\n"
+          "except AssertionError:\n"
+          "  print('checked')\n")
+  env = dict(os.environ, PYTHONPATH=os.pathsep.join([root, str(tmp_path)]))
+  env.pop('PYTHONDONTWRITEBYTECODE', None)
+  def run(*flags):
+    res = subprocess.run([sys.executable, *flags, "-c", code], env=env,
+                         capture_output=True, text=True)
+    return res.stdout.split()[-1]
+  assert run() == "checked"
+  assert run("-O") == "unchecked"
+  assert run() == "checked"
+  assert os.path.exists(import_hook.cache_path(str(pkg / "mod.py"), 0))
+  assert os.path.exists(import_hook.cache_path(str(pkg / "mod.py"), 1))
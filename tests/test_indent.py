@@ -0,0 +1,68 @@
+import threading
+import metap
+import common
+
+SRC = """
+import asyncio
+
+async def work(name):
+  if name:
+    await asyncio.sleep(0)
+    if name:
+      await asyncio.sleep(0)
+  return name
+
+async def main():
+  return await asyncio.gather(work('a'), work('b'))
+
+res = asyncio.run(main())
+"""
+
+def test_asyncio_tasks(tmp_path, capsys):
+  mp = common.tmp_mp(tmp_path, SRC)
+  mp.log_ifs(indent=True)
+  globs = mp.exec()
+  assert globs['res'] == ['a', 'b']
+  # With a single depth for all the tasks, the second task would be indented.
+  assert capsys.readouterr().out == """metap::If(ln=5)
+metap::If(ln=5)
+  metap::If(ln=7)
+  metap::If(ln=7)
+"""
+
+def test_threads():
+  barrier = threading.Barrier(2)
+  depths = []
+
+  def work():
+    metap.indent_enter()
+    try:
+      barrier.wait()
+      depths.append(metap.indent_depth.get())
+      barrier.wait()
+    finally:
+      metap.indent_exit()
+
+  threads = [threading.Thread(target=work) for _ in range(2)]
+  for t in threads:
+    t.start()
+  for t in threads:
+    t.join()
+  assert depths == [1, 1]
+  assert metap.indent_depth.get() == 0
+
+def test_exception_restores_depth():
+  try:
+    metap.indent_enter()
+    try:
+      raise ValueError
+    finally:
+      metap.indent_exit()
+  except ValueError:
+    pass
+  assert metap.indent_depth.get() == 0
+
+def test_indent_ctx():
+  with metap.indent_ctx():
+    assert metap.indent_depth.get() == 1
+  assert metap.indent_depth.get() == 0
@@ -0,0 +1,108 @@
+import io
+import threading
+import pytest
+import metap
+from metap import profiler
+import common
+
+SRC = """
+class A:
+  def m(self):
+    "doc"
+    return fib(5)
+
+  def gen(self):
+    yield 1
+
+def fib(n):
+  if n < 2:
+    return n
+  return fib(n - 1) + fib(n - 2)
+
+def main():
+  list(A().gen())
+  return A().m()
+
+res = main()
+"""
+
+@pytest.fixture(autouse=True)
+def reset():
+  metap.reset_profile()
+  yield
+  metap.reset_profile()
+
+def gen(tmp_path, **kwargs):
+  mp = common.tmp_mp(tmp_path, SRC)
+  mp.profile_funcs(**kwargs)
+  return mp
+
+def test_source(tmp_path):
+  src = gen(tmp_path, range=[(2, 9)]).to_source()
+  assert src.startswith("""import metap
+
+
+class A:
+
+  def m(self):
+    \"\"\"doc\"\"\"
+    _metap_start = metap.prof_enter('test_mp:A.m')
+    try:
+      return fib(5)
+    finally:
+      metap.prof_exit(_metap_start)
+
+  def gen(self):
+    yield 1
+""")
+  assert "'test_mp:fib'" not in src
+
+def test_profile(tmp_path):
+  globs = gen(tmp_path).exec()
+  assert globs['res'] == 5
+
+  folded, funcs = metap.get_profile()
+  assert set(folded) == {
+    "test_mp:main",
+    "test_mp:main;test_mp:A.m",
+  } | {"test_mp:main;test_mp:A.m;" + ";".join(["test_mp:fib"] * d)
+       for d in range(1, 6)}
+  assert funcs["test_mp:fib"]["calls"] == 15
+  assert funcs["test_mp:main"]["calls"] == 1
+  # fib doesn't call anything else.
+  assert funcs["test_mp:fib"]["inclusive"] == funcs["test_mp:fib"]["exclusive"]
+  assert (funcs["test_mp:main"]["inclusive"] >=
+          funcs["test_mp:A.m"]["inclusive"] >= funcs["test_mp:fib"]["inclusive"])
+  assert sum(folded.values()) == funcs["test_mp:main"]["inclusive"]
+
+  out = io.StringIO()
+  metap.dump_profile(out)
+  lines = out.getvalue().splitlines()
+  assert lines[0] == "metap: Profile:"
+  assert lines[2].split()[:2] == ["test_mp:main", "1"]
+
+def test_folded_file(tmp_path):
+  out = tmp_path / "prof.folded"
+  mp = gen(tmp_path, out=str(out))
+  assert "metap.init_profile(" in mp.to_source().splitlines()[1]
+  profiler.init_profile(str(out))
+  try:
+    mp.exec()
+    with open(out, 'w') as fp:
+      profiler.write_folded(fp)
+  finally:
+    profiler.init_profile(None)
+  for line in out.read_text().splitlines():
+    stack, us = line.rsplit(" ", 1)
+    assert stack.startswith("test_mp:main") and int(us) > 0
+
+def test_threads(tmp_path):
+  code = gen(tmp_path).to_code()
+  threads = [threading.Thread(target=exec, args=(code, {})) for _ in range(4)]
+  for t in threads:
+    t.start()
+  for t in threads:
+    t.join()
+  _, funcs = metap.get_profile()
+  assert funcs["test_mp:main"]["calls"] == 4
+  assert funcs["test_mp:fib"]["calls"] == 60
@@ -0,0 +1,75 @@
+import pytest
+import metap
+import metap.sampling as sampling
+import common
+
+SRC = """
+def foo(x):
+  return x
+
+for i in range(10):
+  foo(i)
+"""
+
+# The samplers of the tests are forgotten, so that they are not reported at
+# exit.
+@pytest.fixture(autouse=True)
+def reset(monkeypatch):
+  monkeypatch.setattr(sampling, "_samplers", [])
+
+def run(tmp_path, setup):
+  mp = common.tmp_mp(tmp_path, SRC)
+  setup(mp)
+  exec(mp.to_code(), {})
+
+def test_every():
+  s = sampling.Sampler(sample=3)
+  assert [s() for _ in range(7)] == [True, False, False, True, False, False, True]
+  assert (s.dropped, s.total) == (4, 7)
+
+def test_prob(monkeypatch):
+  vals = iter([0.1, 0.9, 0.4])
+  monkeypatch.setattr(sampling.random, 'random', lambda: next(vals))
+  s = sampling.Sampler(sample=0.5)
+  assert [s() for _ in range(3)] == [True, False, True]
+
+def test_max_per_sec(monkeypatch):
+  now = [100.0]
+  monkeypatch.setattr(sampling.time, 'monotonic', lambda: now[0])
+  s = sampling.Sampler(max_per_sec=2)
+  assert [s() for _ in range(4)] == [True, True, False, False]
+  now[0] += 1.0
+  assert [s() for _ in range(3)] == [True, True, False]
+
+def test_log_returns(tmp_path, capsys):
+  run(tmp_path, lambda mp: mp.log_returns(sample=4))
+  assert capsys.readouterr().out == "metap::Return(ln=3)\n" * 3
+
+def test_log_calls(tmp_path, capsys):
+  dropped, total = metap.sampling_stats()
+  run(tmp_path, lambda mp: mp.log_calls(range=[6], max_per_sec=1000, sample=5))
+  assert capsys.readouterr().out == "metap::Call(ln=6,call=foo(i))\n" * 2
+  new_dropped, new_total = metap.sampling_stats()
+  assert (new_dropped - dropped, new_total - total) == (8, 10)
+
+def test_generated(tmp_path):
+  mp = common.tmp_mp(tmp_path, SRC)
+  mp.log_returns(sample=0.25)
+  assert mp.to_source() == """import metap
+_metap_samplers = metap.make_samplers([[0.25, None]])
+
+
+def foo(x):
+  return metap.log_ret(x, 'metap::Return(ln=3)', _metap_samplers[0])
+
+
+for i in range(10):
+  foo(i)
+"""
+
+@pytest.mark.parametrize("kwargs", [{"sample": 0}, {"sample": 1.5},
+                                    {"sample": "1"}, {"max_per_sec": 0},
+                                    {"sample": True}])
+def test_bad_config(kwargs):
+  with pytest.raises(metap.errors_warns.APIError):
+    metap.MetaP(filename=__file__).log_returns(**kwargs)
@@ -0,0 +1,263 @@
+import json
+import os
+import pytest
+import signal
+import subprocess
+import sys
+import threading
+import metap
+import metap.sink as sink_mod
+import common
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+
+SRC = """
+def foo(x):
+  if x:
+    return 1
+  return 2
+
+for i in range(3):
+  print(foo(i))
+"""
+
+@pytest.fixture(autouse=True)
+def restore_sink(monkeypatch):
+  monkeypatch.delenv('METAP_SINK', raising=False)
+  yield
+  metap.set_sink("print")
+
+def gen(tmp_path, **kwargs):
+  mp = common.tmp_mp(tmp_path, SRC)
+  mp.log_ifs()
+  mp.log_returns()
+  return mp.to_code(**kwargs)
+
+def test_print_interleaves(tmp_path, capsys):
+  exec(gen(tmp_path), {})
+  out = capsys.readouterr().out.splitlines()
+  assert out[:4] == ['metap::Return(ln=5)', '2', 'metap::If(ln=3)',
+                     'metap::Return(ln=4)']
+
+def test_buffered(capsys):
+  metap.set_sink("stdout")
+  metap.log("a")
+  metap.log("b")
+  assert capsys.readouterr().out == ""
+  metap.flush()
+  assert capsys.readouterr().out == "a\nb\n"
+
+def test_capacity(capsys):
+  metap.set_sink(sink_mod.BufferedSink(lambda: sys.stdout, capacity=2))
+  metap.log("a")
+  assert capsys.readouterr().out == ""
+  metap.log("b")
+  assert capsys.readouterr().out == "a\nb\n"
+
+# No record is lost when the threads flush while others write.
+def test_buffered_threads(tmp_path):
+  path = tmp_path / "trace.log"
+  metap.set_sink(sink_mod.BufferedSink(sink_mod.FileOpener(str(path)),
+                                       capacity=7))
+  def run(t):
+    for i in range(5000):
+      metap.log(f"{t}:{i}")
+  threads = [threading.Thread(target=run, args=(t,)) for t in range(4)]
+  for t in threads:
+    t.start()
+  for t in threads:
+    t.join()
+  metap.set_sink("print")
+  lines = path.read_text().splitlines()
+  assert sorted(lines) == sorted(f"{t}:{i}" for t in range(4) for i in range(5000))
+
+def test_file_thread(tmp_path):
+  path = tmp_path / "trace.log"
+  metap.set_sink(f"thread:file:{path}")
+  for i in range(10):
+    metap.log(str(i))
+  # Closes the old sink.
+  metap.set_sink("print")
+  assert path.read_text() == "".join(f"{i}\n" for i in range(10))
+
+def test_dump_time(tmp_path, capsys):
+  path = tmp_path / "trace.log"
+  exec(gen(tmp_path, sink=f"file:{path}"), {})
+  assert capsys.readouterr().out == "2\n1\n1\n"
+  metap.flush()
+  assert path.read_text().splitlines()[:2] == ['metap::Return(ln=5)',
+                                               'metap::If(ln=3)']
+
+def test_env_wins(tmp_path, capsys, monkeypatch):
+  monkeypatch.setenv('METAP_SINK', 'print')
+  exec(gen(tmp_path, sink="stderr"), {})
+  assert isinstance(metap.get_sink(), sink_mod.PrintSink)
+  assert 'metap::Return(ln=5)' in capsys.readouterr().out
+
+# METAP_SINK is only read when something is logged.
+def test_env_lazy(tmp_path):
+  out = tmp_path / "trace.json"
+  env = dict(os.environ, PYTHONPATH=ROOT, METAP_SINK=f"chrome:{out}")
+  res = subprocess.run([sys.executable, "-c", "import metap"], env=env)
+  assert res.returncode == 0
+  assert not out.exists()
+
+  code = "import metap\nmetap.log('metap: Started: 1:f')\n"
+  res = subprocess.run([sys.executable, "-c", code], env=env)
+  assert res.returncode == 0
+  assert [e["name"] for e in json.loads(out.read_text())] == ["1:f"]
+
+  env["METAP_SINK"] = "bogus"
+  res = subprocess.run([sys.executable, "-c", "import metap"], env=env)
+  assert res.returncode == 0
+  res = subprocess.run([sys.executable, "-c", code], env=env,
+                       capture_output=True, text=True)
+  assert res.returncode != 0
+  assert "Invalid sink: bogus" in res.stderr
+
+def test_invalid():
+  with pytest.raises(metap.errors_warns.APIError):
+    metap.set_sink("file:")
+
+CALLS_SRC = """
+import json, io
+
+def work(n):
+  json.dump(n, io.StringIO())
+  return n
+
+for i in range(3):
+  work(i)
+"""
+
+def test_chrome(tmp_path, capsys):
+  mp = common.tmp_mp(tmp_path, CALLS_SRC)
+  mp.log_calls_start_end(patt=r'(json\.dump|work)')
+  mp.log_func_defs(indent=True)
+  out = tmp_path / "trace.json"
+  exec(mp.to_code(sink=f"chrome:{out}"), {})
+  metap.set_sink("print")
+  events = json.loads(out.read_text())
+  assert [(e["ph"], e["name"]) for e in events[:4]] == [
+    ("B", "9:work"), ("i", "FuncDef(ln=4,func=work)"),
+    ("B", "5:json.dump"), ("E", "5:json.dump")]
+  assert len(events) == 15
+  assert all(set(e) >= {"ts", "pid", "tid"} for e in events)
+  ts = [e["ts"] for e in events]
+  assert ts == sorted(ts)
+
+def test_chrome_sigterm(tmp_path):
+  out = tmp_path / "trace.json"
+  code = (f"import os, signal, metap\n"
+          f"metap.set_sink('chrome:{out}')\n"
+          f"metap.log('metap: Started: 1:f')\n"
+          f"os.kill(os.getpid(), signal.SIGTERM)\n")
+  res = subprocess.run([sys.executable, "-c", code],
+                       env=dict(os.environ, PYTHONPATH=ROOT))
+  assert res.returncode == -signal.SIGTERM
+  events = json.loads(out.read_text())
+  assert [(e["ph"], e["name"]) for e in events] == [("B", "1:f")]
+
+# The signal arrives while the sink is flushing.
+def test_chrome_sigterm_in_flush(tmp_path):
+  out = tmp_path / "trace.json"
+  code = (f"import os, signal, metap\n"
+          f"metap.set_sink('chrome:{out}')\n"
+          f"metap.log('metap: Started: 1:f')\n"
+          f"metap.get_sink().lock.acquire()\n"
+          f"os.kill(os.getpid(), signal.SIGTERM)\n")
+  res = subprocess.run([sys.executable, "-c", code], timeout=10,
+                       env=dict(os.environ, PYTHONPATH=ROOT))
+  assert res.returncode == -signal.SIGTERM
+  assert out.read_text() == "[\n"
+
+# No event is lost when the threads flush while others write, and the parts of
+# a record are joined per thread.
+def test_chrome_threads(tmp_path):
+  out = tmp_path / "trace.json"
+  metap.set_sink(sink_mod.ChromeTraceSink(str(out), capacity=7))
+  def run(t):
+    for i in range(5000):
+      metap.get_sink().write(f"{t}:")
+      metap.log(f"{i}")
+  threads = [threading.Thread(target=run, args=(t,)) for t in range(4)]
+  # Switch threads as often as possible.
+  interval = sys.getswitchinterval()
+  sys.setswitchinterval(1e-6)
+  try:
+    for t in threads:
+      t.start()
+    for t in threads:
+      t.join()
+  finally:
+    sys.setswitchinterval(interval)
+  metap.set_sink("print")
+  names = [e["name"] for e in json.loads(out.read_text())]
+  assert sorted(names) == sorted(f"{t}:{i}" for t in range(4) for i in range(5000))
+
+LOOP_SRC = """
+for i in range(1000):
+  if i == 500:
+    print(i)
+  continue
+"""
+
+def test_dedup(tmp_path, capsys):
+  mp = common.tmp_mp(tmp_path, LOOP_SRC)
+  mp.log_continues()
+  exec(mp.to_code(sink="dedup:stdout"), {})
+  metap.flush()
+  assert capsys.readouterr().out.splitlines() == [
+    "500", "metap::Continue(ln=5) x 1000"]
+
+def test_dedup_runs(capsys):
+  metap.set_sink("dedup:print")
+  for text in ["a", "a", "b", "a", "a", "a"]:
+    metap.log(text)
+  # The run of the last record is still open.
+  assert capsys.readouterr().out == "a x 2\nb\n"
+  metap.flush()
+  assert capsys.readouterr().out == "a x 3\n"
+
+def test_dedup_indent(capsys):
+  metap.set_sink("dedup:print")
+  for depth in [1, 1, 2]:
+    metap.indent_depth.set(depth)
+    metap.indent_print()
+    metap.log("a")
+  metap.indent_depth.set(0)
+  metap.flush()
+  assert capsys.readouterr().out == "  a x 2\n    a\n"
+
+def test_dedup_threads(capsys):
+  metap.set_sink("dedup:stdout")
+  metap.log("a")
+  def run():
+    for _ in range(10000):
+      metap.log("a")
+  threads = [threading.Thread(target=run) for _ in range(4)]
+  for t in threads:
+    t.start()
+  for t in threads:
+    t.join()
+  metap.flush()
+  assert capsys.readouterr().out == "a x 40001\n"
+
+# Every run is credited to its own record, even when the threads interleave.
+def test_dedup_threads_mixed(capsys):
+  metap.set_sink("dedup:stdout")
+  def run(rec):
+    for _ in range(20000):
+      metap.log(rec)
+  threads = [threading.Thread(target=run, args=(rec,)) for rec in "abab"]
+  for t in threads:
+    t.start()
+  for t in threads:
+    t.join()
+  metap.flush()
+  counts = {"a": 0, "b": 0}
+  for line in capsys.readouterr().out.splitlines():
+    rec, _, n = line.partition(" x ")
+    counts[rec] += int(n) if n else 1
+  ### END FOR ###
+  assert counts == {"a": 40000, "b": 40000}
@@ -1,6 +1,7 @@
 import pytest
 import os
 import types
+import metap
 
 def exec_code(code, mod):
   # Note: Exec's update the module's dict
@@ -445,4 +446,138 @@ res, ns = _time_e(2 + 3)
   assert actual == expected
   assert isinstance(mod.__dict__['ns'], int)
   
-  del mod
\ No newline at end of file
+  del mod
+
+def exec_boiler(mprogram, setup):
+  fname = 'test.py'
+  with open(fname, 'w') as fp:
+    fp.write(mprogram)
+
+  mp = metap.MetaP(filename=fname)
+  setup(mp)
+  globs = mp.exec()
+  os.remove(fname)
+  assert not os.path.exists('test.metap.py')
+
+  return globs
+
+
+def test_exec_cvar():
+  mprogram = """
+line = "# test"
+if _cvar(line.startswith('# '), hlvl, 1) or _cvar(line.startswith('## '), hlvl, 2):
+  x = hlvl
+"""
+
+  globs = exec_boiler(mprogram, lambda mp: mp.compile())
+
+  assert globs['x'] == 1
+
+
+def test_exec_dyn_typecheck():
+  mprogram = """
+from typing import Dict, List, Optional
+
+def foo(d: Dict[str, List[int]]) -> Optional[int]:
+  x: int = len(d)
+  return x
+
+a = foo({'a': [1, 2]})
+"""
+
+  def setup(mp):
+    mp.compile()
+    mp.dyn_typecheck()
+
+  globs = exec_boiler(mprogram, setup)
+  assert globs['a'] == 1
+
+  with pytest.raises(AssertionError):
+    globs['foo']({'a': ['b']})
+
+
+def test_to_code_lineno():
+  mprogram = """
+def foo():
+  return 2
+
+x = foo()
+y = 1 / 0
+"""
+
+  fname = 'test.py'
+  with open(fname, 'w') as fp:
+    fp.write(mprogram)
+
+  mp = metap.MetaP(filename=fname)
+  mp.log_returns()
+  code = mp.to_code()
+  os.remove(fname)
+
+  assert code.co_filename == fname
+  try:
+    exec(code, {})
+    assert False
+  except ZeroDivisionError as e:
+    assert e.__traceback__.tb_next.tb_lineno == 6
+
+
+def test_unparse_log_calls_start_end(capsys):
+  mprogram = """
+def add(a, b):
+  return a + b
+
+x = add(add(1, 2), 3)
+"""
+
+  outs = []
+  for emitter in ["astor", "unparse"]:
+    client = f"""
+import metap
+
+mp = metap.MetaP(filename='test.py')
+mp.log_calls_start_end()
+mp.dump(emitter='{emitter}')
+"""
+    mod = boiler(mprogram, client)
+    assert mod.__dict__['x'] == 6
+    outs.append(capsys.readouterr().out)
+  ### END FOR ###
+
+  assert outs[0] == outs[1]
+  assert outs[0].count('Started: 5:add') == 2
+
+
+def test_log_calls_super(capsys):
+  mprogram = """
+def dec(x):
+  return lambda f: f
+
+class A:
+  def foo(self):
+    return 1
+
+@dec(1)
+class B(A):
+  def foo(self):
+    return super().foo() + 1
+
+x = B().foo()
+print(x)
+"""
+
+  client = """
+import metap
+
+mp = metap.MetaP(filename='test.py')
+mp.log_calls()
+mp.dump()
+"""
+  mod = boiler(mprogram, client)
+  assert mod.__dict__['x'] == 2
+  assert capsys.readouterr().out == """metap::Call(ln=9,call=dec(1))
+metap::Call(ln=14,call=B().foo())
+metap::Call(ln=12,call=super().foo())
+metap::Call(ln=15,call=print(x))
+2
+"""
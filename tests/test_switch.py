@@ -0,0 +1,203 @@
+import pytest
+import metap
+import metap.timing as timing
+import common
+
+SRC = """
+def foo(x):
+  for i in range(x):
+    if i == 1:
+      break
+  return x
+
+@dec(foo(1))
+def bar():
+  foo(2)
+  return foo(3)
+
+res = bar()
+"""
+
+@pytest.fixture(autouse=True)
+def restore_switch(monkeypatch):
+  # The timers of the tests are forgotten, so that they are not reported at
+  # exit.
+  monkeypatch.setattr(timing, "_timers", [])
+  yield
+  metap.enable()
+
+def gen(tmp_path, **kwargs):
+  mp = common.tmp_mp(tmp_path, SRC)
+  mp.log_calls()
+  mp.log_returns()
+  mp.log_breaks()
+  mp.log_ifs()
+  mp.log_func_defs(indent=True)
+  return mp
+
+def run(code):
+  globs = {'dec': lambda x: lambda f: f}
+  exec(code, globs)
+  return globs
+
+def test_source(tmp_path):
+  mp = common.tmp_mp(tmp_path, SRC)
+  mp.log_breaks()
+  mp.log_returns(range=[6])
+  assert mp.to_source(switch=True) == """import metap
+_metap_on = metap.register_switch(globals())
+
+
+def foo(x):
+  for i in range(x):
+    if i == 1:
+      if _metap_on:
+        metap.log('metap::Break(ln=5)')
+      break
+  return metap.log_ret(x, 'metap::Return(ln=6)') if _metap_on else x
+
+
+@dec(foo(1))
+def bar():
+  foo(2)
+  return foo(3)
+
+
+res = bar()
+"""
+
+def test_on_off(tmp_path, capsys):
+  code = gen(tmp_path).to_code(switch=True)
+  globs = run(code)
+  assert globs['res'] == 3
+  out = capsys.readouterr().out
+  assert out == run_plain(tmp_path, capsys)
+
+  metap.disable()
+  globs = run(code)
+  assert globs['res'] == 3
+  assert capsys.readouterr().out == ""
+
+  # Flipping the switch affects modules that already run.
+  bar = globs['bar']
+  metap.enable()
+  bar()
+  assert capsys.readouterr().out != ""
+  assert metap.is_enabled()
+
+def run_plain(tmp_path, capsys):
+  run(gen(tmp_path).to_code())
+  return capsys.readouterr().out
+
+def test_start_end(tmp_path, capsys):
+  mp = common.tmp_mp(tmp_path, SRC)
+  mp.log_calls_start_end()
+  code = mp.to_code(switch=True)
+  metap.disable()
+  assert run(code)['res'] == 3
+  assert capsys.readouterr().out == ""
+  metap.enable()
+  assert run(code)['res'] == 3
+  assert "metap: Started: 13:bar" in capsys.readouterr().out
+
+CALLS_SRC = """
+def work(n):
+  return n
+
+class A:
+  x = work(1)
+
+def main():
+  for i in range(4):
+    work(i)
+  return [work(j) for j in range(2)]
+
+res = main()
+"""
+
+# When the switch is off, the call runs as is.
+def test_start_end_source(tmp_path):
+  mp = common.tmp_mp(tmp_path, CALLS_SRC)
+  mp.log_calls_start_end(patt=r'work', range=[10])
+  assert mp.to_source(switch=True).splitlines()[-7:-4] == [
+    "    metap.log_start_end(",
+    "    metap.log('metap: Started: 10:work'), work(i), ",
+    "    metap.log('metap: Finished: 10:work')) if _metap_on else work(i)"]
+
+# The sites in the arguments are not repeated in the else branch.
+def test_start_end_nested(tmp_path):
+  mp = common.tmp_mp(tmp_path,
+                     "def f(x):\n  return x\n\nres = f(f(f(f(1))))\n")
+  mp.log_calls_start_end()
+  src = mp.to_source(switch=True)
+  assert src.count("Started") == 4
+  assert src.endswith(" if _metap_on else f(f(f(f(1))))\n")
+  metap.disable()
+  assert run(mp.to_code(switch=True))['res'] == 1
+
+@pytest.mark.parametrize("log_durations", [False, True])
+def test_start_end_timing(tmp_path, capsys, log_durations):
+  mp = common.tmp_mp(tmp_path, CALLS_SRC)
+  mp.log_calls_start_end(patt=r'work', timing=True,
+                         log_durations=log_durations)
+  code = mp.to_code(switch=True)
+  metap.disable()
+  assert run(code)['res'] == [0, 1]
+  assert capsys.readouterr().out == ""
+  assert all(t.count == 0 for t in timing._timers)
+
+  metap.enable()
+  assert run(code)['res'] == [0, 1]
+  out = capsys.readouterr().out
+  assert out.count("metap: Started: 10:work\nmetap: Finished: 10:work\n") == 4
+  counts = {t.name: t.count for t in timing._timers if t.count != 0}
+  assert counts == {"6:work": 1, "10:work": 4, "11:work": 2}
+  if log_durations:
+    assert out.count("metap: Took ") == 7
+
+INDENT_SRC = """
+def foo(flip):
+  if flip:
+    metap.disable() if metap.is_enabled() else metap.enable()
+  return 1
+
+def bar(flip):
+  return foo(flip)
+"""
+
+# The indentation is restored even if the switch flips during the call.
+@pytest.mark.parametrize("on", [False, True])
+def test_indent(tmp_path, capsys, on):
+  mp = common.tmp_mp(tmp_path, INDENT_SRC)
+  mp.log_func_defs(indent=True)
+  globs = {'metap': metap}
+  exec(mp.to_code(switch=True), globs)
+  metap.enable() if on else metap.disable()
+  assert metap.indent_depth.get() == 0
+  globs['bar'](True)
+  assert metap.indent_depth.get() == 0
+  globs['bar'](False)
+  assert metap.indent_depth.get() == 0
+  # Either the first call logs and turns it off, or it turns it on and the
+  # second one logs.
+  assert capsys.readouterr().out == ("metap::FuncDef(ln=7,func=bar)\n"
+                                     "  metap::FuncDef(ln=2,func=foo)\n")
+
+# When the switch is off, the indentation is not touched.
+def test_indent_off(tmp_path, monkeypatch):
+  mp = common.tmp_mp(tmp_path, INDENT_SRC)
+  mp.log_func_defs(indent=True)
+  globs = {'metap': metap}
+  exec(mp.to_code(switch=True), globs)
+  calls = []
+  monkeypatch.setattr(metap, 'indent_enter', lambda: calls.append("enter"))
+  monkeypatch.setattr(metap, 'indent_exit', lambda: calls.append("exit"))
+  metap.disable()
+  globs['bar'](False)
+  assert calls == []
+
+def test_too_late(tmp_path):
+  mp = gen(tmp_path)
+  mp.to_source()
+  with pytest.raises(metap.errors_warns.APIError):
+    mp.to_source(switch=True)
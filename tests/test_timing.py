@@ -0,0 +1,87 @@
+import io
+import itertools
+import pytest
+import metap
+import metap.timing as timing
+import common
+
+SRC = """
+def work(n):
+  return n
+
+for i in range(4):
+  work(i)
+"""
+
+# The timers of the tests are forgotten, so that they are not reported at exit.
+@pytest.fixture(autouse=True)
+def reset(monkeypatch):
+  monkeypatch.setattr(timing, "_timers", [])
+
+def gen(tmp_path, **kwargs):
+  mp = common.tmp_mp(tmp_path, SRC)
+  mp.log_calls_start_end(patt=r'work', **kwargs)
+  return mp
+
+@pytest.fixture
+def fake_clock(monkeypatch):
+  # Every call takes 10ns, 20ns, ...
+  ticks = itertools.count()
+  def now():
+    t = next(ticks)
+    return (t // 2) * 1000 + (t % 2) * (t // 2 + 1) * 10
+  monkeypatch.setattr(metap, 'now_ns', now)
+
+def test_source(tmp_path):
+  assert gen(tmp_path, timing=True).to_source() == """import metap
+_metap_timers = metap.make_timers([['6:work', False]])
+
+
+def work(n):
+  return n
+
+
+for i in range(4):
+  metap.log_start_end_timed(
+  metap.log('metap: Started: 6:work'), metap.now_ns(), work(i), metap.now_ns(), 
+  metap.log('metap: Finished: 6:work'), _metap_timers[0])
+"""
+
+def test_stats(tmp_path, capsys, fake_clock):
+  exec(gen(tmp_path, timing=True).to_code(), {})
+  assert capsys.readouterr().out == \
+    "metap: Started: 6:work\nmetap: Finished: 6:work\n" * 4
+  timer = [t for t in timing._timers if t.name == '6:work'][-1]
+  stats = timer.stats()
+  assert (stats["count"], stats["total"], stats["min"], stats["max"]) == \
+    (4, 100, 10, 40)
+  # The percentiles come from the buckets.
+  assert 20 <= stats["p50"] < 24 and stats["p99"] == 40
+
+def test_log_durations(tmp_path, capsys, fake_clock):
+  exec(gen(tmp_path, log_durations=True).to_code(), {})
+  out = capsys.readouterr().out.splitlines()
+  assert out[:3] == ['metap: Started: 6:work', 'metap: Finished: 6:work',
+                     'metap: Took 10ns: 6:work']
+
+def test_percentile():
+  t = timing.Timer("t")
+  for ns in range(1, 100_001):
+    t.add(ns * 1000)
+  for q in [0.5, 0.99]:
+    assert abs(t.percentile(q) / (q * 100_000_000) - 1) < 0.13
+  assert t.min <= t.percentile(0) and t.percentile(1) <= t.max
+
+def test_dump(tmp_path, capsys):
+  t = timing.Timer("3:json.dump")
+  t.add(2_500_000)
+  out = io.StringIO()
+  timing._timers.append(t)
+  try:
+    timing.dump_timings(out)
+  finally:
+    timing._timers.remove(t)
+  lines = out.getvalue().splitlines()
+  assert lines[0] == "metap: Timings:"
+  assert lines[1].split() == ["site", "count", "total", "min", "p50", "p99", "max"]
+  assert lines[2].split() == ["3:json.dump", "1"] + ["2.50ms"] * 5
@@ -0,0 +1,206 @@
+import ast
+import dis
+import typing
+import pytest
+import metap
+import common
+
+SRC = """
+def foo(xs: List[int], d: Dict[str, int]):
+  return len(xs)
+"""
+
+@pytest.fixture(autouse=True)
+def reset():
+  metap.seed_typecheck(0)
+  yield
+  metap.reset_checked()
+  metap.enable_typechecks()
+
+def gen_mp(tmp_path, src=SRC, **kwargs):
+  mp = common.tmp_mp(tmp_path, src)
+  mp.dyn_typecheck(**kwargs)
+  return mp
+
+def gen(tmp_path, name='test_mp', **kwargs):
+  globs = {'List': list, 'Dict': dict, '__name__': name}
+  exec(gen_mp(tmp_path, **kwargs).to_code(), globs)
+  return globs['foo']
+
+def caught(foo, xs, d=None):
+  try:
+    foo(xs, d if d is not None else {})
+  except AssertionError:
+    return True
+  return False
+
+def test_full(tmp_path, capsys):
+  foo = gen(tmp_path)
+  assert not caught(foo, list(range(100)))
+  assert caught(foo, list(range(100)) + ["a"])
+  assert caught(foo, [], {"a": 1, 2: 2})
+
+def test_first_k(tmp_path, capsys):
+  foo = gen(tmp_path, container_check="first_k", container_k=3)
+  assert caught(foo, [1, 2, "a", 4])
+  assert not caught(foo, [1, 2, 3, "a"])
+  assert not caught(foo, [], {"a": 1, "b": 2, "c": 3, 4: 4})
+
+def test_random_k(tmp_path, capsys):
+  foo = gen(tmp_path, container_check="random_k", container_k=10)
+  # All of them, if there are at most k.
+  assert caught(foo, list(range(9)) + ["a"])
+  bad = [i if i % 2 == 0 else "a" for i in range(1000)]
+  assert caught(foo, bad)
+  # Some other elements every time.
+  xs = list(range(1000))
+  xs[500] = "a"
+  assert any(caught(foo, xs) for _ in range(1000))
+
+def test_once_per_object(tmp_path, capsys):
+  foo = gen(tmp_path, container_check="once_per_object")
+  xs = list(range(10))
+  assert not caught(foo, xs)
+  # Changes after the first check are not caught.
+  xs.append("a")
+  assert not caught(foo, xs)
+  assert caught(foo, list(xs))
+  metap.reset_checked()
+  assert caught(foo, xs)
+
+def test_once_bounded():
+  xs = [[i] for i in range(metap.typecheck.MAX_CHECKED + 10)]
+  for x in xs:
+    metap.mark_checked(x, True)
+  assert not metap.was_checked(xs[0])
+  assert metap.was_checked(xs[-1])
+  assert len(metap.typecheck._checked) == metap.typecheck.MAX_CHECKED
+
+def test_once_retained(monkeypatch):
+  monkeypatch.setattr(metap.typecheck, "MAX_RETAINED", 100)
+  xs = [list(range(40)) for _ in range(3)]
+  for x in xs:
+    metap.mark_checked(x, True)
+  # 3 * 41 elements are too many.
+  assert not metap.was_checked(xs[0])
+  assert metap.was_checked(xs[1]) and metap.was_checked(xs[2])
+  assert metap.typecheck._retained_total == 82
+  # Too big to keep.
+  big = list(range(100))
+  metap.mark_checked(big, True)
+  assert not metap.was_checked(big)
+  assert metap.was_checked(xs[2])
+
+def test_once_weakref():
+  class Obj:
+    pass
+  metap.mark_checked(Obj(), True)
+  assert len(metap.typecheck._checked) == 0
+
+UNION_SRC = """
+def foo(x: Union[int, str, float, List[int], Dict[str, int]]):
+  return x
+"""
+
+@pytest.mark.parametrize("container_check", ["full", "first_k"])
+def test_long_union(tmp_path, capsys, container_check):
+  globs = {'List': list, 'Dict': dict, 'Union': typing.Union}
+  mp = gen_mp(tmp_path, src=UNION_SRC, container_check=container_check)
+  exec(mp.to_code(), globs)
+  foo = globs['foo']
+  for x in [1, "a", 1.0, [1, 2], {"a": 1}]:
+    foo(x)
+  for x in [None, ["a"], {"a": "b"}]:
+    with pytest.raises(AssertionError):
+      foo(x)
+  ### END FOR ###
+
+# Another annotation has the same first 8 hex digits.
+def test_checker_collision():
+  sites = metap.metap.Sites()
+  ann = ast.parse("List[int]", mode='eval').body
+  short = metap.metap.check_exp(ast.Name(id='x'), ann, sites, metap.metap.FULL_CHECK).func.id
+  other = metap.metap.Sites()
+  other.checkers[short] = sites.checkers[short]
+  other.checkers[short]._metap_key = "something else"
+  long = metap.metap.check_exp(ast.Name(id='x'), ann, other, metap.metap.FULL_CHECK).func.id
+  assert len(short) == len('_metap_check_') + 8
+  assert long.startswith(short) and long != short
+  assert list(other.checkers) == [short, long]
+
+def test_invalid(tmp_path):
+  with pytest.raises(metap.errors_warns.APIError):
+    gen(tmp_path, container_check="some")
+  with pytest.raises(metap.errors_warns.APIError):
+    gen(tmp_path, container_check="first_k", container_k=0)
+
+def test_debug_only(tmp_path, capsys):
+  src = gen_mp(tmp_path, debug_only=True).to_source()
+  assert "  if __debug__ and not _metap_check_c4e5537a(xs):" in src
+  assert caught(gen(tmp_path, debug_only=True), ["a"])
+  # Removed by `python -O`.
+  code = compile(src, "test_mp.py", "exec", optimize=1)
+  foo = [c for c in code.co_consts if getattr(c, 'co_name', None) == 'foo'][0]
+  loaded = [ins.argval for ins in dis.get_instructions(foo)]
+  assert "_metap_check_c4e5537a" not in loaded
+  assert "len" in loaded
+
+def test_toggle(tmp_path, capsys):
+  assert "_metap_typecheck = metap.register_typecheck(globals())" in \
+    gen_mp(tmp_path, toggle=True).to_source()
+  foo_a = gen(tmp_path, name='mod_a', toggle=True)
+  foo_b = gen(tmp_path, name='mod_b', toggle=True)
+  metap.disable_typechecks('mod_a')
+  assert not caught(foo_a, ["a"])
+  assert caught(foo_b, ["a"])
+  metap.disable_typechecks()
+  assert not caught(foo_b, ["a"])
+  metap.enable_typechecks('mod_b')
+  assert not caught(foo_a, ["a"])
+  assert caught(foo_b, ["a"])
+  # New modules get the current state.
+  assert caught(gen(tmp_path, name='mod_b', toggle=True), ["a"])
+  assert not caught(gen(tmp_path, name='mod_c', toggle=True), ["a"])
+
+def test_toggle_env():
+  assert metap.typecheck.parse_env("1") == (True, {})
+  assert metap.typecheck.parse_env("0") == (False, {})
+  assert metap.typecheck.parse_env("a,b.c") == (False, {"a": True, "b.c": True})
+
+RET_SRC = """
+def foo(x: int) -> str:
+  def inner():
+    return 1
+  if x == 0:
+    return "a"
+  elif x == 1:
+    return inner()
+  if x == 2:
+    return
+
+def gen(x: int) -> Dict[str, int]:
+  yield x
+
+class A:
+  def bar(self, x: int) -> int:
+    if x:
+      return x
+    raise ValueError()
+"""
+
+def test_ret_in_place(tmp_path, capsys):
+  mp = common.tmp_mp(tmp_path, RET_SRC)
+  mp.dyn_typecheck()
+  src = mp.to_source()
+  assert "__metap_foo" not in src
+  globs = {'Dict': dict}
+  exec(mp.to_code(), globs)
+  foo = globs['foo']
+  assert foo(0) == "a"
+  for x in [1, 2, 3]:
+    with pytest.raises(AssertionError):
+      foo(x)
+  assert list(globs['gen'](1)) == [1]
+  assert globs['A']().bar(2) == 2
+  with pytest.raises(ValueError):
+    globs['A']().bar(0)
@@ -0,0 +1,105 @@
+import io
+import json
+import time
+import pytest
+import metap
+import metap.violations as violations_mod
+import common
+
+SRC = """
+def foo(a: int, b: List[int]) -> int:
+  assert a == 1
+  return a
+
+for i in range(3):
+  foo(i, [str(i)] * 1000)
+"""
+
+@pytest.fixture(autouse=True)
+def reset():
+  yield
+  metap.reset_violations()
+
+def gen(tmp_path, **kwargs):
+  mp = common.tmp_mp(tmp_path, SRC)
+  mp.expand_asserts(**kwargs)
+  mp.dyn_typecheck(**kwargs)
+  return mp
+
+def test_source(tmp_path):
+  src = gen(tmp_path, on_violation="record").to_source()
+  # The `def` line depends on the version of astor.
+  assert src.split("\n")[9:] == """\
+  if not isinstance(a, int):
+    metap.record_violation('metap::TypeCheck(ln=2,var=a)', a)
+  if not _metap_check_c4e5537a(b):
+    metap.record_violation('metap::TypeCheck(ln=2,var=b)', b)
+  _metap_l = a
+  _metap_r = 1
+  if _metap_l != _metap_r:
+    metap.record_violation('metap::Assert(ln=3)', _metap_l, _metap_r)
+  __metap_retv = a
+  if not isinstance(__metap_retv, int):
+    metap.record_violation('metap::TypeCheck(ln=4,var=return)', __metap_retv)
+  return __metap_retv
+
+
+for i in range(3):
+  foo(i, [str(i)] * 1000)
+""".split("\n")
+
+def test_record(tmp_path):
+  exec(gen(tmp_path, on_violation="record").to_code(), {'List': list})
+  assert metap.violation_counts() == [('metap::TypeCheck(ln=2,var=b)', 3),
+                                      ('metap::Assert(ln=3)', 2)]
+  viols = metap.get_violations()
+  assert [v[1:3] for v in viols[:2]] == [('metap::TypeCheck(ln=2,var=b)', 'list'),
+                                         ('metap::Assert(ln=3)', 'int, int')]
+  assert viols[1][3] == '0, 1'
+  # Truncated.
+  assert len(viols[0][3]) < 100
+  out = io.StringIO()
+  metap.dump_violations(out)
+  assert out.getvalue() == """metap: Violations:
+           3 metap::TypeCheck(ln=2,var=b) last: ['2', '2', '2', '2', '2', '2', ...] (list)
+           2 metap::Assert(ln=3) last: 2, 1 (int, int)
+"""
+
+def test_assert(tmp_path, capsys):
+  with pytest.raises(AssertionError):
+    exec(gen(tmp_path).to_code(), {'List': list})
+
+def test_bounded():
+  for i in range(violations_mod.MAX_VIOLATIONS + 10):
+    metap.record_violation('site', i)
+  viols = metap.get_violations()
+  assert len(viols) == violations_mod.MAX_VIOLATIONS
+  assert viols[0][3] == '10'
+  assert metap.violation_counts() == [('site', violations_mod.MAX_VIOLATIONS + 10)]
+
+def test_bad_repr():
+  class Bad:
+    def __repr__(self):
+      raise ValueError()
+  metap.record_violation('site', Bad())
+  assert metap.get_violations()[0][3].startswith('<Bad instance at')
+
+def test_flush(tmp_path):
+  path = tmp_path / "violations.jsonl"
+  metap.flush_violations(str(path), interval=0.01)
+  try:
+    metap.record_violation('a', 1)
+    deadline = time.time() + 5
+    while not path.exists() and time.time() < deadline:
+      time.sleep(0.01)
+    metap.record_violation('b', "x")
+  finally:
+    violations_mod._flusher.stop()
+    violations_mod._flusher = None
+  lines = [json.loads(line) for line in path.read_text().splitlines()]
+  assert [(l["site"], l["types"], l["repr"]) for l in lines] == [
+    ('a', 'int', '1'), ('b', 'str', "'x'")]
+
+def test_invalid(tmp_path):
+  with pytest.raises(metap.errors_warns.APIError):
+    gen(tmp_path, on_violation="ignore")
@@ -0,0 +1,128 @@
+import pytest
+import os
+import metap
+import common
+
+SRC = """
+def foo(x):
+  if x:
+    return 1
+  return 2
+
+class A:
+  def bar(self):
+    return foo(1)
+a = 1; b = 2
+
+def baz():
+  for i in range(2):
+    @no_continue
+    continue
+  return 3
+"""
+
+@pytest.fixture
+def src(tmp_path):
+  return common.write_src(tmp_path, SRC)
+
+def full_source(path, recipe):
+  mp = metap.MetaP(filename=str(path))
+  metap.recipe.apply_recipe(mp, recipe)
+  return mp.to_source()
+
+def save(path, text):
+  path.write_text(text)
+  # Make sure the mtime changes even on coarse-grained filesystems.
+  st = os.stat(path)
+  os.utime(path, ns=(st.st_atime_ns, st.st_mtime_ns + 1_000_000_000))
+
+def test_same_as_full(src, tmp_path):
+  recipe = ["log_returns", "log_continues"]
+  out = tmp_path / "test.py"
+  w = metap.Watcher(str(src), recipe, str(out))
+  assert w.check()
+  assert out.read_text() == full_source(src, recipe)
+  assert w.transformed == 4
+  assert w.reused == 0
+
+def test_only_changed(src, tmp_path):
+  recipe = ["log_returns"]
+  out = tmp_path / "test.py"
+  w = metap.Watcher(str(src), recipe, str(out))
+  assert w.check()
+
+  save(src, SRC.replace("return 3", "return 4"))
+  assert w.check()
+  assert w.transformed == 1
+  assert w.reused == 3
+  assert out.read_text() == full_source(src, recipe)
+
+def test_emitter_sink(src, tmp_path):
+  recipe = ["log_returns"]
+  out = tmp_path / "test.py"
+  w = metap.Watcher(str(src), recipe, str(out), emitter="unparse",
+                    sink="stderr")
+  assert w.check()
+  mp = metap.MetaP(filename=str(src))
+  metap.recipe.apply_recipe(mp, recipe)
+  assert out.read_text() == mp.to_source(emitter="unparse", sink="stderr")
+
+def test_unchanged_save(src, tmp_path):
+  out = tmp_path / "test.py"
+  w = metap.Watcher(str(src), ["log_returns"], str(out))
+  assert w.check()
+  assert not w.check()
+  save(src, SRC)
+  assert not w.check()
+
+# The counters, samplers and timers of all the segments are set up once, at
+# the top, and numbered across the segments.
+@pytest.mark.parametrize("recipe", [
+  [("log_returns", {"mode": "count"}), ("log_continues", {"mode": "count"}),
+   ("log_calls", {"sample": 2})],
+  [("log_calls_start_end", {"timing": True}), ("log_returns", {"mode": "count"})],
+])
+def test_sites_same_as_full(src, tmp_path, recipe):
+  out = tmp_path / "test.py"
+  w = metap.Watcher(str(src), recipe, str(out))
+  assert w.check()
+  assert out.read_text() == full_source(src, recipe)
+  assert out.read_text().count("metap.make_counters(") == 1
+
+  # A new site in the first segment renumbers the sites after it.
+  save(src, SRC.replace("  return 2", "  if x == 2:\n    return 3\n  return 2"))
+  assert w.check()
+  assert out.read_text() == full_source(src, recipe)
+
+  # But not those before it.
+  save(src, SRC.replace("return 3", "return 4"))
+  assert w.check()
+  save(src, SRC.replace("return 3", "return 5"))
+  assert w.check()
+  assert w.transformed == 1
+  assert out.read_text() == full_source(src, recipe)
+
+TYPED_SRC = """
+def foo(xs: List[int]):
+  return len(xs)
+
+def bar(d: Dict[str, List[int]], ys: List[int]):
+  return d
+
+x = 1
+"""
+
+# The checkers of dyn_typecheck() are shared across the segments.
+def test_checkers_same_as_full(tmp_path):
+  src = common.write_src(tmp_path, TYPED_SRC)
+  out = tmp_path / "test.py"
+  w = metap.Watcher(str(src), ["dyn_typecheck"], str(out))
+  assert w.check()
+  assert out.read_text() == full_source(src, ["dyn_typecheck"])
+  assert out.read_text().count("def _metap_check_") == 2
+
+  # foo's checker is still needed when foo is reused.
+  save(src, TYPED_SRC.replace("return d", "return ys"))
+  assert w.check()
+  assert w.reused == 2
+  assert out.read_text() == full_source(src, ["dyn_typecheck"])
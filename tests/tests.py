@@ -1,4 +1,5 @@
 import unittest
+import ast
 import metap
 import os
 import sys
@@ -184,6 +185,70 @@ def baz():
 
 
 
+class Ranges(unittest.TestCase):
+  def test_normalize(self):
+    r = metap.LineRanges([(10, 12), 3, (4, 6), (11, 20), 30])
+    self.assertEqual(r.starts, [3, 10, 30])
+    self.assertEqual(r.ends, [6, 20, 30])
+    for ln in [3, 5, 6, 10, 15, 20, 30]:
+      self.assertIn(ln, r)
+    for ln in [1, 2, 7, 9, 21, 29, 31]:
+      self.assertNotIn(ln, r)
+    self.assertTrue(r.overlaps(1, 3))
+    self.assertTrue(r.overlaps(21, 40))
+    self.assertFalse(r.overlaps(7, 9))
+    self.assertFalse(r.overlaps(31, 40))
+
+  def test_empty(self):
+    r = metap.LineRanges([])
+    self.assertIn(1, r)
+    self.assertTrue(r.overlaps(100, 200))
+
+  def test_skip_funcs(self):
+    src = \
+"""
+def foo():
+  return 1
+
+class A:
+  def bar(self):
+    return 2
+
+@dec(baz())
+def baz():
+  return 3
+"""
+
+    expect = \
+"""import metap
+
+
+def foo():
+  return 1
+
+
+class A:
+
+  def bar(self):
+    return 2
+
+
+@metap.log_call_deco('metap::Call(ln=9,call=dec(baz()))')
+@dec(baz())
+def baz():
+  return 3
+"""
+
+    def call_range(fname):
+      mp = metap.MetaP(filename=fname)
+      mp.log_calls(range=[9])
+      mp.dump()
+
+    out = boiler(src, call_range)
+    self.assertEqual(out, expect)
+
+
+
 class LogCall(unittest.TestCase):
   def test_simple(self):
     src = \
@@ -206,8 +271,7 @@ def add_one(num):
 
 for x in xs:
   if x:
-    ret = metap.log_call(lambda : add_one(n),
-        'metap::Call(ln=7,call=add_one(n))')
+    ret = metap.log_call('metap::Call(ln=7,call=add_one(n))') or add_one(n)
 """
     
     out = boiler(src, log_call)
@@ -233,11 +297,13 @@ if z:
 """import metap
 for x in xs:
   if x:
-    metap.log_call(lambda : add_one(n), 'metap::Call(ln=4,call=add_one(n))')
+    metap.log_call('metap::Call(ln=4,call=add_one(n))')
+    add_one(n)
   if y:
     add_two(n)
 if z:
-  metap.log_call(lambda : add_three(), 'metap::Call(ln=10,call=add_three())')
+  metap.log_call('metap::Call(ln=10,call=add_three())')
+  add_three()
 """
 
     def call_range(fname):
@@ -265,7 +331,7 @@ for i in range(10):
 """import metap
 for i in range(10):
   if i == 3:
-    print('metap::Continue(ln=4)')
+    metap.log('metap::Continue(ln=4)')
     continue
 """
     
@@ -284,7 +350,7 @@ for i in range(10):
 """import metap
 for i in range(10):
   if i == 3:
-    print('metap::Break(ln=4)')
+    metap.log('metap::Break(ln=4)')
     break
 """
     
@@ -439,8 +505,8 @@ def foo():
 
 
 def foo():
-  return metap.log_ret(metap.log_call(lambda : bar(),
-      'metap::Call(ln=3,call=bar())'), 'metap::Return(ln=3)')
+  return metap.log_ret(metap.log_call('metap::Call(ln=3,call=bar())') or
+      bar(), 'metap::Return(ln=3)')
 """
 
     def compose_logret_and_logcall(fname):
@@ -454,6 +520,67 @@ def foo():
 
 
 
+class FusedPasses(unittest.TestCase):
+  def test_order(self):
+    src = \
+"""
+def foo(ns):
+  for n in ns:
+    if n:
+      continue
+    _ret_ifnn(helper(n))
+"""
+
+    # log_ifs() comes before compile(), so it should not see the `if` that the
+    # macro generates. log_returns() comes after, so it should see the `return`.
+    expect = \
+"""import metap
+
+
+def foo(ns):
+  for n in ns:
+    if n:
+      metap.log('metap::If(ln=4)')
+      metap.log('metap::Continue(ln=5)')
+      continue
+    _tmp = helper(n)
+    if _tmp is not None:
+      return metap.log_ret(_tmp, 'metap::Return(ln=3)')
+"""
+
+    def compose(fname):
+      mp = metap.MetaP(filename=fname)
+      mp.log_continues()
+      mp.log_ifs()
+      mp.compile()
+      mp.log_returns()
+      mp.dump()
+
+    out = boiler(src, compose)
+    self.assertEqual(out, expect)
+
+  def test_single_traversal(self):
+    class CountNames(metap.Pass):
+      def __init__(self):
+        metap.Pass.__init__(self)
+        self.count = 0
+
+      def visit_Name(self, name):
+        self.count += 1
+        return name
+
+    t = ast.parse("a = b + c\nfor x in y:\n  f(x)")
+    passes = [CountNames(), CountNames(), CountNames()]
+    pm = metap.PassManager()
+    for p in passes:
+      pm.add(p)
+    pm.run(t)
+    for p in passes:
+      self.assertEqual(p.count, 7)
+    self.assertFalse(pm.pending())
+
+
+
 class LogFuncDefs(unittest.TestCase):
   def test_visitor(self):
     src = \
@@ -478,20 +605,20 @@ class RandomVisitor(ast.NodeVisitor):
 
 
 def foo():
-  print('metap::FuncDef(ln=2,func=foo)')
+  metap.log('metap::FuncDef(ln=2,func=foo)')
   return 2
 
 
 class RandomVisitor(ast.NodeVisitor):
 
   def visit_Assign(self, asgn: ast.Assign):
-    print('metap::FuncDef(ln=6,func=visit_Assign)')
+    metap.log('metap::FuncDef(ln=6,func=visit_Assign)')
     for t in asgn.targets:
       self.visit(t)
     self.visit(asgn.value)
 
   def visit_BinOp(self, binop: ast.BinOp):
-    print('metap::FuncDef(ln=13,func=visit_BinOp)')
+    metap.log('metap::FuncDef(ln=13,func=visit_BinOp)')
     self.visit(binop.left)
 """
 
@@ -524,18 +651,24 @@ def foo(n):
 
 def bar():
   metap.indent_print()
-  print('metap::FuncDef(ln=2,func=bar)')
-  with metap.indent_ctx():
+  metap.log('metap::FuncDef(ln=2,func=bar)')
+  metap.indent_enter()
+  try:
     return 2
+  finally:
+    metap.indent_exit()
 
 
 def foo(n):
   metap.indent_print()
-  print('metap::FuncDef(ln=5,func=foo)')
-  with metap.indent_ctx():
+  metap.log('metap::FuncDef(ln=5,func=foo)')
+  metap.indent_enter()
+  try:
     if n == 2:
       return None
     return bar()
+  finally:
+    metap.indent_exit()
 """
 
     def log_func_def2(fname):
@@ -574,10 +707,10 @@ else:
     expect = \
 """import metap
 if True:
-  print('metap::If(ln=2)')
+  metap.log('metap::If(ln=2)')
   pass
 else:
-  print('metap::Else(ln=2)')
+  metap.log('metap::Else(ln=2)')
   pass
 """
 
@@ -600,13 +733,13 @@ else:
     expect = \
 """import metap
 if False:
-  print('metap::If(ln=2)')
+  metap.log('metap::If(ln=2)')
   pass
 elif True:
-  print('metap::If(ln=4)')
+  metap.log('metap::If(ln=4)')
   pass
 else:
-  print('metap::Else(ln=4)')
+  metap.log('metap::Else(ln=4)')
   pass
 """
 
@@ -629,14 +762,20 @@ else:
 """import metap
 if True:
   metap.indent_print()
-  print('metap::If(ln=2)')
-  with metap.indent_ctx():
+  metap.log('metap::If(ln=2)')
+  metap.indent_enter()
+  try:
     pass
+  finally:
+    metap.indent_exit()
 else:
   metap.indent_print()
-  print('metap::Else(ln=2)')
-  with metap.indent_ctx():
+  metap.log('metap::Else(ln=2)')
+  metap.indent_enter()
+  try:
     pass
+  finally:
+    metap.indent_exit()
 """
 
     out = boiler(src, log_if_indent)
@@ -660,23 +799,35 @@ else:
 """import metap
 if True:
   metap.indent_print()
-  print('metap::If(ln=2)')
-  with metap.indent_ctx():
+  metap.log('metap::If(ln=2)')
+  metap.indent_enter()
+  try:
     if False:
       metap.indent_print()
-      print('metap::If(ln=3)')
-      with metap.indent_ctx():
+      metap.log('metap::If(ln=3)')
+      metap.indent_enter()
+      try:
         pass
+      finally:
+        metap.indent_exit()
     else:
       metap.indent_print()
-      print('metap::Else(ln=3)')
-      with metap.indent_ctx():
+      metap.log('metap::Else(ln=3)')
+      metap.indent_enter()
+      try:
         pass
+      finally:
+        metap.indent_exit()
+  finally:
+    metap.indent_exit()
 else:
   metap.indent_print()
-  print('metap::Else(ln=2)')
-  with metap.indent_ctx():
+  metap.log('metap::Else(ln=2)')
+  metap.indent_enter()
+  try:
     pass
+  finally:
+    metap.indent_exit()
 """
 
     out = boiler(src, log_if_indent)
@@ -697,18 +848,27 @@ else:
 """import metap
 if True:
   metap.indent_print()
-  print('metap::If(ln=2)')
-  with metap.indent_ctx():
+  metap.log('metap::If(ln=2)')
+  metap.indent_enter()
+  try:
     if True:
       metap.indent_print()
-      print('metap::If(ln=3)')
-      with metap.indent_ctx():
+      metap.log('metap::If(ln=3)')
+      metap.indent_enter()
+      try:
         pass
+      finally:
+        metap.indent_exit()
+  finally:
+    metap.indent_exit()
 else:
   metap.indent_print()
-  print('metap::Else(ln=2)')
-  with metap.indent_ctx():
+  metap.log('metap::Else(ln=2)')
+  metap.indent_enter()
+  try:
     pass
+  finally:
+    metap.indent_exit()
 """
 
     out = boiler(src, log_if_indent)
@@ -754,8 +914,12 @@ def foo(s: Optional[str]):
 """import metap
 
 
+def _metap_check_d5f0ef9d(obj):
+  return isinstance(obj, str) or obj is None
+
+
 def foo(s: Optional[str]):
-  if not (isinstance(s, str) or s is None):
+  if not _metap_check_d5f0ef9d(s):
     print(s)
     print(type(s))
     assert False
@@ -780,8 +944,12 @@ def foo(s: Union[str, int]):
 """import metap
 
 
+def _metap_check_3fb8128d(obj):
+  return isinstance(obj, str) or isinstance(obj, int)
+
+
 def foo(s: Union[str, int]):
-  if not (isinstance(s, str) or isinstance(s, int)):
+  if not _metap_check_3fb8128d(s):
     print(s)
     print(type(s))
     assert False
@@ -806,9 +974,13 @@ def foo(s: Tuple[str, int, RandomClass]):
 """import metap
 
 
+def _metap_check_7a10acfd(obj):
+  return isinstance(obj, tuple) and (len(obj) == 3 and isinstance(obj[0],
+      str) and isinstance(obj[1], int) and isinstance(obj[2], RandomClass))
+
+
 def foo(s: Tuple[str, int, RandomClass]):
-  if not (isinstance(s, tuple) and (len(s) == 3 and isinstance(s[0], str) and
-      isinstance(s[1], int) and isinstance(s[2], RandomClass))):
+  if not _metap_check_7a10acfd(s):
     print(s)
     print(type(s))
     assert False
@@ -832,9 +1004,13 @@ def foo(s: List[str]):
 """import metap
 
 
+def _metap_check_bb502eee(obj):
+  return isinstance(obj, list) and all(isinstance(__metap_x1, str) for
+      __metap_x1 in obj)
+
+
 def foo(s: List[str]):
-  if not (isinstance(s, list) and all([isinstance(__metap_x1, str) for
-      __metap_x1 in s])):
+  if not _metap_check_bb502eee(s):
     print(s)
     print(type(s))
     assert False
@@ -856,11 +1032,15 @@ def foo(s:List[Optional[Tuple[str, int]]]):
 """import metap
 
 
-def foo(s: List[Optional[Tuple[str, int]]]):
-  if not (isinstance(s, list) and all([(isinstance(__metap_x1, tuple) and (
+def _metap_check_07830cdf(obj):
+  return isinstance(obj, list) and all(isinstance(__metap_x1, tuple) and (
       len(__metap_x1) == 2 and isinstance(__metap_x1[0], str) and
-      isinstance(__metap_x1[1], int)) or __metap_x1 is None) for __metap_x1 in
-      s])):
+      isinstance(__metap_x1[1], int)) or __metap_x1 is None for __metap_x1 in
+      obj)
+
+
+def foo(s: List[Optional[Tuple[str, int]]]):
+  if not _metap_check_07830cdf(s):
     print(s)
     print(type(s))
     assert False
@@ -884,11 +1064,15 @@ def foo(s: Optional[Tuple[List[str], List[int]]]):
 """import metap
 
 
+def _metap_check_b3fb2132(obj):
+  return isinstance(obj, tuple) and (len(obj) == 2 and (isinstance(obj[0],
+      list) and all(isinstance(__metap_x1, str) for __metap_x1 in obj[0])) and
+      (isinstance(obj[1], list) and all(isinstance(__metap_x2, int) for
+      __metap_x2 in obj[1]))) or obj is None
+
+
 def foo(s: Optional[Tuple[List[str], List[int]]]):
-  if not (isinstance(s, tuple) and (len(s) == 2 and (isinstance(s[0], list) and
-      all([isinstance(__metap_x1, str) for __metap_x1 in s[0]])) and (
-      isinstance(s[1], list) and all([isinstance(__metap_x2, int) for
-      __metap_x2 in s[1]]))) or s is None):
+  if not _metap_check_b3fb2132(s):
     print(s)
     print(type(s))
     assert False
@@ -966,14 +1150,18 @@ def foo(a: int, b: Dict[int, Optional[str]]):
 """import metap
 
 
+def _metap_check_fc1277d7(obj):
+  return isinstance(obj, dict) and all(isinstance(_metap_k1, int) and (
+      isinstance(_metap_v2, str) or _metap_v2 is None) for _metap_k1,
+      _metap_v2 in obj.items())
+
+
 def foo(a: int, b: Dict[int, Optional[str]]):
   if not isinstance(a, int):
     print(a)
     print(type(a))
     assert False
-  if not (isinstance(b, dict) and all([(isinstance(_metap_k1, int) and (
-      isinstance(_metap_v2, str) or _metap_v2 is None)) for _metap_k1,
-      _metap_v2 in b.items()])):
+  if not _metap_check_fc1277d7(b):
     print(b)
     print(type(b))
     assert False
@@ -997,14 +1185,18 @@ def foo(a: int, b: Dict[int, List[str]]):
 """import metap
 
 
+def _metap_check_1904bddb(obj):
+  return isinstance(obj, dict) and all(isinstance(_metap_k1, int) and (
+      isinstance(_metap_v2, list) and all(isinstance(__metap_x3, str) for
+      __metap_x3 in _metap_v2)) for _metap_k1, _metap_v2 in obj.items())
+
+
 def foo(a: int, b: Dict[int, List[str]]):
   if not isinstance(a, int):
     print(a)
     print(type(a))
     assert False
-  if not (isinstance(b, dict) and all([(isinstance(_metap_k1, int) and (
-      isinstance(_metap_v2, list) and all([isinstance(__metap_x3, str) for
-      __metap_x3 in _metap_v2]))) for _metap_k1, _metap_v2 in b.items()])):
+  if not _metap_check_1904bddb(b):
     print(b)
     print(type(b))
     assert False
@@ -1040,15 +1232,12 @@ class Test:
       assert False
     self.a = a
 
-  def __metap_foo(self, b: int) -> str:
+  def foo(self, b: int) -> str:
     if not isinstance(b, int):
       print(b)
       print(type(b))
       assert False
-    return str(self.a)
-
-  def foo(self, b: int) -> str:
-    __metap_retv = self.__metap_foo(b)
+    __metap_retv = str(self.a)
     if not isinstance(__metap_retv, str):
       print(__metap_retv)
       print(type(__metap_retv))
@@ -1124,16 +1313,13 @@ def foo(s: int) -> str:
 """import metap
 
 
-def __metap_foo(s: int) -> str:
+def foo(s: int) -> str:
   if not isinstance(s, int):
     print(s)
     print(type(s))
     assert False
   pass
-
-
-def foo(s: int) -> str:
-  __metap_retv = __metap_foo(s)
+  __metap_retv = None
   if not isinstance(__metap_retv, str):
     print(__metap_retv)
     print(type(__metap_retv))
@@ -1158,19 +1344,19 @@ def foo(s: int) -> Optional[Tuple[str, int]]:
 """import metap
 
 
-def __metap_foo(s: int) -> Optional[Tuple[str, int]]:
+def _metap_check_443734c6(obj):
+  return isinstance(obj, tuple) and (len(obj) == 2 and isinstance(obj[0],
+      str) and isinstance(obj[1], int)) or obj is None
+
+
+def foo(s: int) -> Optional[Tuple[str, int]]:
   if not isinstance(s, int):
     print(s)
     print(type(s))
     assert False
   pass
-
-
-def foo(s: int) -> Optional[Tuple[str, int]]:
-  __metap_retv = __metap_foo(s)
-  if not (isinstance(__metap_retv, tuple) and (len(__metap_retv) == 2 and
-      isinstance(__metap_retv[0], str) and isinstance(__metap_retv[1], int)
-      ) or __metap_retv is None):
+  __metap_retv = None
+  if not _metap_check_443734c6(__metap_retv):
     print(__metap_retv)
     print(type(__metap_retv))
     assert False
@@ -1191,8 +1377,14 @@ a: Optional[int] = 2
 
     expect = \
 """import metap
+
+
+def _metap_check_50044bd2(obj):
+  return isinstance(obj, int) or obj is None
+
+
 a: Optional[int] = 2
-if not (isinstance(a, int) or a is None):
+if not _metap_check_50044bd2(a):
   print(a)
   print(type(a))
   assert False
@@ -1224,13 +1416,17 @@ def foo(sch: Schema):
 """import metap
 
 
-def foo(sch: Dict[str, List[Tuple[str, Union[int, float, str]]]]):
-  if not (isinstance(sch, dict) and all([(isinstance(_metap_k1, str) and (
-      isinstance(_metap_v2, list) and all([(isinstance(__metap_x3, tuple) and
+def _metap_check_8912a4fc(obj):
+  return isinstance(obj, dict) and all(isinstance(_metap_k1, str) and (
+      isinstance(_metap_v2, list) and all(isinstance(__metap_x3, tuple) and
       (len(__metap_x3) == 2 and isinstance(__metap_x3[0], str) and (
       isinstance(__metap_x3[1], int) or isinstance(__metap_x3[1], float) or
-      isinstance(__metap_x3[1], str)))) for __metap_x3 in _metap_v2]))) for
-      _metap_k1, _metap_v2 in sch.items()])):
+      isinstance(__metap_x3[1], str))) for __metap_x3 in _metap_v2)) for 
+      _metap_k1, _metap_v2 in obj.items())
+
+
+def foo(sch: Dict[str, List[Tuple[str, Union[int, float, str]]]]):
+  if not _metap_check_8912a4fc(sch):
     print(sch)
     print(type(sch))
     assert False
@@ -1256,8 +1452,12 @@ def foo(t: Type[int]):
 """import metap
 
 
+def _metap_check_e10cbdee(obj):
+  return obj is int
+
+
 def foo(t: Type[int]):
-  if not t is int:
+  if not _metap_check_e10cbdee(t):
     print(t)
     print(type(t))
     assert False
@@ -1267,6 +1467,56 @@ def foo(t: Type[int]):
     out = boiler(src, dyn_typecheck)
     self.assertEqual(out, expect)
 
+  def test_shared_checker(self):
+    src = \
+"""
+def foo(a: List[int], b: List[int]):
+  pass
+
+class A:
+  def bar(self, c: List[int]):
+    pass
+"""
+
+    expect = \
+"""import metap
+
+
+def _metap_check_c4e5537a(obj):
+  return isinstance(obj, list) and all(isinstance(__metap_x1, int) for
+      __metap_x1 in obj)
+
+
+def foo(a: List[int], b: List[int]):
+  if not _metap_check_c4e5537a(a):
+    print(a)
+    print(type(a))
+    assert False
+  if not _metap_check_c4e5537a(b):
+    print(b)
+    print(type(b))
+    assert False
+  pass
+
+
+class A:
+
+  def bar(self, c: List[int]):
+    if not _metap_check_c4e5537a(c):
+      print(c)
+      print(type(c))
+      assert False
+    pass
+"""
+
+    out = boiler(src, dyn_typecheck)
+    self.assertEqual(out, expect)
+
+    code = compile(expect, "test.py", "exec")
+    globs = {'List': list}
+    exec(code, globs)
+    globs['A']().bar([1, 2])
+
 
 
 
@@ -1327,10 +1577,10 @@ def foo():
 
 def foo():
   return f"""{metap.log_start_end(
-  print('metap: Started: 3:bar'), bar(metap.log_start_end(
-  print('metap: Started: 3:baz'), baz(), 
-  print('metap: Finished: 3:baz'))), 
-  print('metap: Finished: 3:bar'))}"""
+  metap.log('metap: Started: 3:bar'), bar(metap.log_start_end(
+  metap.log('metap: Started: 3:baz'), baz(), 
+  metap.log('metap: Finished: 3:baz'))), 
+  metap.log('metap: Finished: 3:bar'))}"""
 '''
 
     out = boiler(src, log_calls_start_end3)
@@ -1351,8 +1601,8 @@ with open('d.json', 'w') as fp:
 """import metap
 with open('d.json', 'w') as fp:
   json.dump(metap.log_start_end(
-  print('metap: Started: 3:find_primes'), find_primes(1000000), 
-  print('metap: Finished: 3:find_primes')), fp)
+  metap.log('metap: Started: 3:find_primes'), find_primes(1000000), 
+  metap.log('metap: Finished: 3:find_primes')), fp)
 """
 
     out = boiler(src, log_calls_start_end1)
@@ -1370,8 +1620,8 @@ with open('d.json', 'w') as fp:
 """import metap
 with open('d.json', 'w') as fp:
   metap.log_start_end(
-  print('metap: Started: 3:json.dump'), json.dump(find_primes(1000000), fp), 
-  print('metap: Finished: 3:json.dump'))
+  metap.log('metap: Started: 3:json.dump'), json.dump(find_primes(1000000), fp), 
+  metap.log('metap: Finished: 3:json.dump'))
 """
 
     out = boiler(src, log_calls_start_end2)
@@ -1564,5 +1814,85 @@ metap: Error: @no_break directive used at line 4, but there's a `break` at line:
     self.assertEqual(stderr.strip(), expected_stderr.strip())
 
 
+class Emitters(unittest.TestCase):
+  def test_unparse(self):
+    src = \
+"""
+from typing import Optional
+
+def foo(a: Optional[int], b):
+  if _cvar(a, x, 1) or _cvar(b, x, 2):
+    return x
+  return 2
+class A:
+  def bar(self):
+    return foo(1, 2)
+a = A().bar()
+"""
+
+    expect = \
+"""import metap
+
+def _metap_check_50044bd2(obj):
+  return isinstance(obj, int) or obj is None
+from typing import Optional
+
+def foo(a: Optional[int], b):
+  if not _metap_check_50044bd2(a):
+    print(a)
+    print(type(a))
+    assert False
+  if metap.cvar(a, globals(), '__metap_x', lambda: 1) or metap.cvar(b, globals(), '__metap_x', lambda: 2):
+    if '__metap_x' in globals():
+      x = globals()['__metap_x']
+    return metap.log_ret(x, 'metap::Return(ln=6)')
+  return metap.log_ret(2, 'metap::Return(ln=7)')
+
+class A:
+
+  def bar(self):
+    return metap.log_ret(foo(1, 2), 'metap::Return(ln=10)')
+a = A().bar()
+"""
+
+    def unparse(fname):
+      mp = metap.MetaP(filename=fname)
+      mp.compile()
+      mp.dyn_typecheck()
+      mp.log_returns()
+      mp.dump(emitter="unparse")
+
+    out = boiler(src, unparse)
+    self.assertEqual(out, expect)
+
+  def test_stream(self):
+    src = \
+"""
+def foo():
+  return 1
+x = foo()
+y = x
+class A:
+  pass
+z = 1
+"""
+
+    def stream_and_whole(fname):
+      mp = metap.MetaP(filename=fname)
+      mp.log_returns()
+      mp.dump()
+      mp = metap.MetaP(filename=fname)
+      mp.log_returns()
+      # Print the whole module at once.
+      return metap.emit.AstorEmitter().stmt(mp.final_ast())
+
+    whole = boiler2(src, stream_and_whole)
+    out = boiler(src, stream_and_whole)
+    self.assertEqual(out, whole)
+
+  def test_unknown(self):
+    with self.assertRaises(metap.errors_warns.APIError):
+      metap.emit.get_emitter("foo")
+
 if __name__ == '__main__':
     unittest.main()
\ No newline at end of file